@@ -0,0 +1,143 @@
+'''
+Keeps the NIDM files of a directory loaded for a long running process such as rest-server.py
+
+A DatasetRegistry globs its files once at startup, opens them through Query.GetDataset so the
+union graph and the navigation index are built before the first request needs them, and then
+polls the files for additions, changes and removals.  A changed file set is loaded in the
+watcher thread and swapped in with a single attribute assignment, so requests that are already
+running keep using the snapshot they started with and nothing waits for a reload.
+'''
+import os
+import glob
+import time
+import logging
+import threading
+import collections
+from nidm.experiment import Query, Navigate, GraphCache, MemoryCache
+
+# seconds between two scans of the files, PYNIDM_POLL_INTERVAL, 0 disables watching
+POLL_INTERVAL = float(os.environ.get('PYNIDM_POLL_INTERVAL', 5))
+
+# files: tuple of the loaded files, fingerprints: file -> GraphCache.fileFingerprint
+RegistrySnapshot = collections.namedtuple('RegistrySnapshot', ['files', 'fingerprints', 'version', 'loaded'])
+
+
+class DatasetRegistry(object):
+    '''
+    The set of NIDM files matching a glob pattern, loaded and kept up to date in the background
+    '''
+
+    def __init__(self, pattern, poll_interval=POLL_INTERVAL):
+        '''
+        :param pattern: glob pattern of the NIDM files, ** matches subdirectories
+        :param poll_interval: seconds between scans for changed files, 0 to never rescan
+        '''
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.snapshot = RegistrySnapshot(files=(), fingerprints={}, version=0, loaded=None)
+        self.error = None
+        self.ready = threading.Event()
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # functions called with the new snapshot each time one is swapped in
+        self.listeners = []
+
+    @property
+    def files(self):
+        '''
+        The files of the current snapshot, in a stable order
+        '''
+        return self.snapshot.files
+
+    def scan(self):
+        '''
+        Finds the files matching the pattern
+
+        :return: dictionary of file -> fingerprint
+        '''
+        fingerprints = {}
+        for file in sorted(glob.glob(self.pattern, recursive=True)):
+            try:
+                fingerprints[file] = GraphCache.fileFingerprint(file)
+            except OSError:
+                # removed between the glob and the stat, the next scan will agree
+                continue
+        return fingerprints
+
+    def refresh(self):
+        '''
+        Scans the files and, if any were added, changed or removed, loads them and swaps the new
+        snapshot in.  If loading fails the old snapshot stays in place.
+
+        :return: True if a new snapshot was swapped in
+        '''
+        with self._reload_lock:
+            fingerprints = self.scan()
+            current = self.snapshot
+            if fingerprints == current.fingerprints and current.loaded is not None:
+                return False
+
+            # drop the results cached from a rewritten or deleted file now rather than when
+            # MemoryCache next checks it
+            stale = [file for file, fingerprint in current.fingerprints.items() if fingerprints.get(file) != fingerprint]
+            if stale:
+                MemoryCache.invalidateFiles(stale)
+
+            files = tuple(sorted(fingerprints))
+            try:
+                if files:
+                    Query.GetDataset(files).graph
+                    Navigate.getNavigationIndex(files)
+            except Exception as e:
+                logging.exception("Could not load NIDM files %s", files)
+                self.error = e
+                return False
+
+            self.error = None
+            self.snapshot = RegistrySnapshot(files=files, fingerprints=fingerprints, version=current.version + 1, loaded=time.time())
+            self.ready.set()
+            logging.info("Loaded %d NIDM files (version %d)", len(files), self.snapshot.version)
+            for listener in self.listeners:
+                try:
+                    listener(self.snapshot)
+                except Exception:
+                    logging.exception("Error in NIDM file reload listener %s", listener)
+            return True
+
+    def start(self, background=False):
+        '''
+        Loads the files and starts watching them for changes
+
+        :param background: load in the watcher thread instead of before returning, use ready to
+            find out when the files have been loaded
+        '''
+        if not background:
+            self.refresh()
+        if background or self.poll_interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.watch, args=(background,), name='nidm-dataset-registry', daemon=True)
+            self._thread.start()
+
+    def watch(self, load_first=False):
+        if load_first:
+            self.refresh()
+        while self.poll_interval > 0 and not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception("Error while checking NIDM files for changes")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def status(self):
+        '''
+        Summary of the registry for a readiness endpoint
+        '''
+        snapshot = self.snapshot
+        return {'ready': self.ready.is_set(), 'files': len(snapshot.files), 'version': snapshot.version,
+                'loaded': snapshot.loaded, 'error': str(self.error) if self.error else None}
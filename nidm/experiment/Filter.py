@@ -0,0 +1,353 @@
+'''
+Compiler and evaluator for the subject filter language used by the REST API, e.g.
+
+    instruments.AGE_AT_SCAN gt 12 and (instruments.SITE_ID eq 'CMU' or instruments.SITE_ID in (NYU, UCLA))
+
+A filter is parsed once into a small AST of FilterOp (and/or) and FilterTest nodes.  The AST is
+then either evaluated with pandas boolean masks against a long table of subject values, with one row
+per (subject, category, key, value), or translated by filterToSparql into a SPARQL FILTER expression
+so the whole filter is answered by a single query over the dataset.  Either way the filter is
+answered in one pass instead of once per subject.
+
+Comparison operators: eq, ne, lt, gt, le, ge and in.  Values may be quoted with ', " or ` and
+'in' takes a parenthesized, comma separated list.  'and' binds tighter than 'or'.
+'''
+import re
+import functools
+import collections
+import itertools
+import math
+import pandas as pd
+from rdflib import Literal
+from nidm.core import Constants
+
+FilterTest = collections.namedtuple('FilterTest', ['category', 'term', 'op', 'value'])
+FilterOp = collections.namedtuple('FilterOp', ['op', 'args'])
+
+CATEGORIES = ('instruments', 'derivatives')
+# the singular forms are used in the REST documentation examples
+CATEGORY_ALIASES = {'instrument': 'instruments', 'derivative': 'derivatives'}
+COMPARISON_OPS = ('eq', 'ne', 'lt', 'gt', 'le', 'ge', 'in')
+NUMERIC_OPS = {'lt': 'lt', 'gt': 'gt', 'le': 'le', 'ge': 'ge'}
+
+# columns of the table evaluateFilter works on
+TABLE_COLUMNS = ['subject', 'category', 'key', 'label', 'value']
+
+# rdflib answers true for NaN < x, so the casted value is always compared with > or >=
+SPARQL_OPS = {'lt': '{value} > {number}', 'gt': '{number} > {value}', 'le': '{value} >= {number}', 'ge': '{number} >= {value}'}
+SPARQL_PREFIXES = '''
+PREFIX prov: <{}>
+PREFIX nidm: <{}>
+PREFIX sio: <{}>
+PREFIX dct: <{}>
+PREFIX ndar: <{}>
+PREFIX xsd: <{}>
+'''.format(Constants.PROV, Constants.NIDM, Constants.SIO, Constants.DCT, Constants.NDAR, Constants.XSD)
+
+# graph patterns linking {subject} to the value ?value{n} of data element ?element{n}, matching the
+# way Query.GetSubjectDataTable finds instrument and derivative values
+SPARQL_PATTERNS = {
+    'instruments': '''
+        ?association{n} prov:agent {subject} .
+        ?acquisition{n} prov:qualifiedAssociation ?association{n} ;
+            a nidm:Acquisition .
+        ?entity{n} prov:wasGeneratedBy ?acquisition{n} ;
+            ?element{n} ?value{n} .''',
+    'derivatives': '''
+        ?association{n} prov:agent {subject} ;
+            prov:hadRole sio:Subject .
+        ?activity{n} prov:qualifiedAssociation ?association{n} , ?software_association{n} .
+        ?software_association{n} prov:agent ?software{n} .
+        ?software{n} a prov:SoftwareAgent .
+        ?entity{n} prov:wasGeneratedBy ?activity{n} ;
+            ?element{n} ?value{n} .''',
+}
+
+FILTER_TOKEN = re.compile(r'''\s*(?:(?P<punct>[(),])|'(?P<sq>[^']*)'|"(?P<dq>[^"]*)"|`(?P<bq>[^`]*)`|(?P<word>[^\s(),'"`]+))''')
+
+
+class FilterSyntaxError(ValueError):
+    '''
+    A filter string can't be parsed
+    '''
+    pass
+
+
+def tokenize(filter):
+    '''
+    Splits a filter string into (token, quoted) tuples
+
+    :param filter: filter string
+    :return: list of tuples
+    '''
+    tokens = []
+    pos = 0
+    filter = filter.strip()
+    while pos < len(filter):
+        match = FILTER_TOKEN.match(filter, pos)
+        if not match or match.end() == pos:
+            raise FilterSyntaxError("Can't parse filter '{}' at position {}".format(filter, pos))
+        pos = match.end()
+        if match.group('punct'):
+            tokens.append((match.group('punct'), False))
+        elif match.group('word') is not None:
+            tokens.append((match.group('word'), False))
+        else:
+            quoted = [g for g in (match.group('sq'), match.group('dq'), match.group('bq')) if g is not None][0]
+            tokens.append((quoted, True))
+    return tokens
+
+
+def splitField(field):
+    '''
+    Splits a filter field such as instruments.AGE or projects.subjects.derivatives.fsl:fsl_000032
+    into its category and term.  A term may be a full URI, which can contain dots.  Fields
+    without a known category get category None and never match any subject.
+
+    :param field: field string
+    :return: (category, term)
+    '''
+    uri = re.search(r'https?://\S+$', field)
+    if uri:
+        path = field[:uri.start()].rstrip('.').split('.')
+        term = uri.group(0)
+    else:
+        pieces = field.split('.')
+        path, term = pieces[:-1], pieces[-1]
+    category = CATEGORY_ALIASES.get(path[-1], path[-1]) if path else None
+    if category not in CATEGORIES:
+        category = None
+    return category, term
+
+
+class FilterParser(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, False)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FilterSyntaxError("Unexpected end of filter")
+        self.pos += 1
+        return token
+
+    def keyword(self, word):
+        token, quoted = self.peek()
+        if not quoted and token is not None and token.lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, punct):
+        token, quoted = self.next()
+        if quoted or token != punct:
+            raise FilterSyntaxError("Expected '{}' in filter but found '{}'".format(punct, token))
+
+    def expression(self):
+        args = [self.conjunction()]
+        while self.keyword('or'):
+            args.append(self.conjunction())
+        return args[0] if len(args) == 1 else FilterOp('or', tuple(args))
+
+    def conjunction(self):
+        args = [self.factor()]
+        while self.keyword('and'):
+            args.append(self.factor())
+        return args[0] if len(args) == 1 else FilterOp('and', tuple(args))
+
+    def factor(self):
+        if self.peek() == ('(', False):
+            self.next()
+            node = self.expression()
+            self.expect(')')
+            return node
+        return self.comparison()
+
+    def comparison(self):
+        field, quoted = self.next()
+        category, term = splitField(field)
+        op = self.next()[0].lower()
+        if op not in COMPARISON_OPS:
+            raise FilterSyntaxError("Unknown filter operator '{}'".format(op))
+        if op == 'in':
+            self.expect('(')
+            values = [self.next()[0]]
+            while self.peek() == (',', False):
+                self.next()
+                values.append(self.next()[0])
+            self.expect(')')
+            return FilterTest(category, term, op, tuple(values))
+        return FilterTest(category, term, op, self.next()[0])
+
+
+@functools.lru_cache(maxsize=256)
+def compileFilter(filter):
+    '''
+    Parses a filter string into an AST of FilterOp and FilterTest nodes
+
+    :param filter: filter string
+    :return: FilterOp | FilterTest
+    '''
+    parser = FilterParser(tokenize(filter))
+    node = parser.expression()
+    if parser.peek()[0] is not None:
+        raise FilterSyntaxError("Unexpected '{}' in filter".format(parser.peek()[0]))
+    return node
+
+
+def filterTests(node):
+    '''
+    Returns all the FilterTest leaves of a compiled filter
+    '''
+    if isinstance(node, FilterTest):
+        return [node]
+    return [test for arg in node.args for test in filterTests(arg)]
+
+
+def toNumber(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compareValues(values, numbers, op, value):
+    '''
+    Vectorized comparison of a column of values with a filter value
+
+    :param values: Series of string values
+    :param numbers: the same values as floats (NaN where not numeric)
+    :param op: comparison operator
+    :param value: filter value, a tuple of values for 'in'
+    :return: boolean Series
+    '''
+    if op in NUMERIC_OPS:
+        number = toNumber(value)
+        if number is None:
+            return pd.Series(False, index=values.index)
+        return getattr(numbers, NUMERIC_OPS[op])(number)
+
+    choices = value if op == 'in' else (value,)
+    mask = values.isin(choices)
+    # NaN never equals anything, and must not match the NaNs of non-numeric values
+    numeric_choices = [n for n in (toNumber(v) for v in choices) if n is not None and n == n]
+    if numeric_choices:
+        mask = mask | numbers.isin(numeric_choices)
+    return ~mask if op == 'ne' else mask
+
+
+def filterTestMask(test, table, synonyms):
+    '''
+    Finds the rows of the table matching a single FilterTest
+
+    :param test: FilterTest
+    :param table: long table with TABLE_COLUMNS
+    :param synonyms: function returning the list of keys a term may appear under in the table
+    :return: boolean Series over the table rows
+    '''
+    if test.category is None:
+        return pd.Series(False, index=table.index)
+    keys = synonyms(test.category, test.term)
+    rows = (table['category'] == test.category) & (table['key'].isin(keys) | table['label'].isin(keys))
+    if not rows.any():
+        return rows
+    matches = compareValues(table['value'], table['number'], test.op, test.value)
+    return rows & matches
+
+
+def evaluateFilter(node, table, subjects, synonyms):
+    '''
+    Evaluates a compiled filter for a set of subjects.  A test matches a subject if any of the
+    subject's values for that term satisfies it.
+
+    :param node: compiled filter from compileFilter
+    :param table: long table with TABLE_COLUMNS, as built by Query.GetSubjectDataTable
+    :param subjects: list of subject URIs to test
+    :param synonyms: function (category, term) -> list of keys the term may appear under
+    :return: boolean numpy array, one entry per subject
+    '''
+    subject_index = pd.Index([str(s) for s in subjects])
+    if 'number' not in table:
+        table = table.assign(number=pd.to_numeric(table['value'], errors='coerce'))
+
+    def mask(node):
+        if isinstance(node, FilterTest):
+            matched = table['subject'][filterTestMask(node, table, synonyms)].unique()
+            return subject_index.isin(matched)
+        masks = [mask(arg) for arg in node.args]
+        result = masks[0]
+        for m in masks[1:]:
+            result = (result & m) if node.op == 'and' else (result | m)
+        return result
+
+    return mask(node)
+
+
+def sparqlNumber(number):
+    if math.isinf(number):
+        return '"{}INF"^^xsd:double'.format('-' if number < 0 else '')
+    return '"{!r}"^^xsd:double'.format(number)
+
+
+def sparqlComparison(variable, op, value):
+    '''
+    Translates a comparison of a SPARQL variable with a filter value, following compareValues
+
+    :param variable: SPARQL variable holding the value, e.g. ?value0
+    :param op: comparison operator
+    :param value: filter value, a tuple of values for 'in'
+    :return: SPARQL boolean expression
+    '''
+    number = 'xsd:double(str({}))'.format(variable)
+    if op in NUMERIC_OPS:
+        value = toNumber(value)
+        if value is None or value != value:
+            return 'false'
+        return SPARQL_OPS[op].format(number=number, value=sparqlNumber(value))
+
+    tests = []
+    for choice in (value if op == 'in' else (value,)):
+        tests.append('str({}) = {}'.format(variable, Literal(str(choice)).n3()))
+        choice = toNumber(choice)
+        if choice is not None and choice == choice:
+            # values that aren't numbers make the cast fail, which must not fail the whole test
+            tests.append('COALESCE({} = {}, false)'.format(number, sparqlNumber(choice)))
+    match = '({})'.format(' || '.join(tests))
+    return '!' + match if op == 'ne' else match
+
+
+def filterToSparql(node, elements):
+    '''
+    Translates a compiled filter into a SPARQL group graph pattern binding the matching subjects to
+    ?subject.  Each test becomes a subquery over the subjects' instrument or derivative values, with
+    the same any-value-matches semantics as evaluateFilter; 'and' joins the subqueries and 'or' is a
+    UNION of them.  The subqueries don't depend on the rest of the query, so rdflib evaluates each
+    of them once instead of once per subject.  Values are compared as strings and, for numbers,
+    after casting them to xsd:double.
+
+    :param node: compiled filter from compileFilter
+    :param elements: function (FilterTest) -> list of data element URIs the term may appear under
+    :return: SPARQL group graph pattern string, or None if the filter can't match any subject
+    '''
+    counter = itertools.count()
+
+    def pattern(node):
+        if isinstance(node, FilterOp):
+            args = [pattern(arg) for arg in node.args]
+            if node.op == 'and':
+                return None if None in args else '{{ {} }}'.format(' '.join(args))
+            args = [arg for arg in args if arg is not None]
+            return '{{ {} }}'.format(' UNION '.join(args)) if args else None
+        uris = elements(node) if node.category is not None else []
+        if not uris:
+            return None
+        n = next(counter)
+        return '{{ SELECT DISTINCT ?subject WHERE {{{} FILTER(?element{} IN ({}) && {}) }} }}'.format(
+            SPARQL_PATTERNS[node.category].format(n=n, subject='?subject'), n,
+            ', '.join('<{}>'.format(uri) for uri in uris), sparqlComparison('?value{}'.format(n), node.op, node.value))
+
+    return pattern(node)
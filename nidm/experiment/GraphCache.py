@@ -0,0 +1,384 @@
+'''
+On-disk cache used by Query.OpenGraph and Query.getCDEs
+
+Cache entries live in CACHE_DIR (PYNIDM_CACHE_DIR, default: a pynidm_cache
+directory in the system temp dir) and are keyed on a cheap stat() fingerprint
+of the source file (path, size, mtime_ns, inode) plus the cache format and
+rdflib versions, so finding a cached graph never has to read the file itself.
+In strict mode (STRICT_CACHE or the PYNIDM_CACHE_STRICT environment variable)
+the MD5 of the file content is stored in a sidecar file next to each entry
+written and re-checked before a cached entry is trusted.
+
+Entries are written to a temporary file and renamed into place while holding a
+per-entry lock file, so concurrent processes never read a half written entry
+and only one of them builds it.  The cache is kept under CACHE_MAX_BYTES
+(PYNIDM_CACHE_MAX_BYTES, 0 disables the limit) by evicting the least recently
+used entries.  Each process counts the cache size once and then adds the
+entries it writes, so the directory is only listed again when the count goes
+over the limit.
+'''
+import os
+import re
+import shutil
+import pickle
+import hashlib
+import tempfile
+from contextlib import contextmanager
+import rdflib
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on this platform, atomic renames still protect readers
+    fcntl = None
+
+HASH_BLOCKSIZE = 65536
+CONTENT_HASH_SUFFIX = '.md5'
+LOCK_SUFFIX = '.lock'
+TMP_SUFFIX = '.tmp'
+
+# bump when the layout of cache entries changes
+CACHE_FORMAT_VERSION = 1
+ENTRY_KINDS = ('rdf_graph', 'cde_graph', 'nav_index', 'uuid_index', 'de_catalog', 'project_summary', 'type_closure', 'rest_response')
+
+STRICT_CACHE = os.environ.get('PYNIDM_CACHE_STRICT', '').lower() not in ('', '0', 'false', 'no')
+CACHE_DIR = os.environ.get('PYNIDM_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pynidm_cache'))
+
+
+def parseSize(size):
+    '''
+    Converts a size such as 4096, '512M' or '8G' to a number of bytes
+
+    :param size: int or string with an optional K, M, G or T suffix
+    :return: int
+    '''
+    match = re.match(r'^\s*(\d+)\s*([kmgt]?)i?b?\s*$', str(size), flags=re.IGNORECASE)
+    if not match:
+        raise ValueError("Can't parse cache size '{}'".format(size))
+    power = ' kmgt'.index(match.group(2).lower() or ' ')
+    return int(match.group(1)) * 1024 ** power
+
+
+CACHE_MAX_BYTES = parseSize(os.environ.get('PYNIDM_CACHE_MAX_BYTES', 8 * 1024 ** 3))
+
+
+def fileFingerprint(file):
+    '''
+    Returns a tuple that changes whenever the file is rewritten, without reading its content
+
+    :param file: filename
+    :return: (real path, size, mtime in ns, inode)
+    '''
+    st = os.stat(file)
+    return (os.path.realpath(file), st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def cacheKey(*files):
+    '''
+    Returns a hex digest usable in cache file names for one or more files
+
+    :param files: filenames
+    :return: string
+    '''
+    hasher = hashlib.md5()
+    # a new cache format or rdflib release must never pick up entries written by the old one
+    hasher.update('v{}-rdflib{}'.format(CACHE_FORMAT_VERSION, rdflib.__version__).encode('utf-8'))
+    for file in files:
+        hasher.update(repr(fileFingerprint(file)).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def contentHash(file):
+    '''
+    Returns the MD5 hex digest of the file content
+
+    :param file: filename
+    :return: string
+    '''
+    hasher = hashlib.md5()
+    with open(file, 'rb') as afile:
+        buf = afile.read(HASH_BLOCKSIZE)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = afile.read(HASH_BLOCKSIZE)
+    return hasher.hexdigest()
+
+
+def writeContentHash(cache_file, file):
+    '''
+    Stores the content hash of file in a sidecar next to cache_file
+
+    :param cache_file: the cache entry built from file
+    :param file: the source file
+    '''
+    with open(cache_file + CONTENT_HASH_SUFFIX, 'w') as f:
+        f.write(contentHash(file))
+
+
+def isValidEntry(cache_file, file, strict=None):
+    '''
+    Checks if cache_file can be used for file.  The entry name already encodes the stat
+    fingerprint so outside of strict mode an existing entry is valid.  In strict mode the
+    sidecar content hash must also match the current file content.
+
+    :param cache_file: the cache entry
+    :param file: the source file
+    :param strict: override STRICT_CACHE
+    :return: Boolean
+    '''
+    if not os.path.exists(cache_file):
+        return False
+
+    if strict is None:
+        strict = STRICT_CACHE
+    if not strict:
+        return True
+
+    sidecar = cache_file + CONTENT_HASH_SUFFIX
+    if not os.path.isfile(sidecar):
+        return False
+    with open(sidecar) as f:
+        return f.read().strip() == contentHash(file)
+
+
+#####################
+# Entry management
+#####################
+
+def entryPath(kind, key, extension):
+    '''
+    Returns the path of a cache entry, creating CACHE_DIR if needed
+
+    :param kind: one of ENTRY_KINDS
+    :param key: key from cacheKey
+    :param extension: 'pickle', 'sqlite' or 'snapshot' (a directory)
+    :return: path
+    '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return '{}/{}.{}.{}'.format(CACHE_DIR, kind, key, extension)
+
+
+@contextmanager
+def entryLock(cache_file):
+    '''
+    Holds an exclusive lock on cache_file while an entry is being built
+    '''
+    with open(cache_file + LOCK_SUFFIX, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def touch(cache_file):
+    '''
+    Marks an entry as recently used for LRU eviction
+    '''
+    try:
+        os.utime(cache_file, None)
+    except OSError:
+        pass
+
+
+def saveEntry(cache_file, obj, file=None):
+    '''
+    Pickles obj into cache_file behind a format header.  The entry is written to a temporary
+    file and renamed into place so readers never see a partial entry.
+
+    :param cache_file: the cache entry
+    :param obj: object to store
+    :param file: source file, if given its content hash is stored in a sidecar in strict mode
+    '''
+    tmp_file = '{}.{}{}'.format(cache_file, os.getpid(), TMP_SUFFIX)
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'format': CACHE_FORMAT_VERSION, 'rdflib': rdflib.__version__}, f)
+        pickle.dump(obj, f)
+    if file and STRICT_CACHE:
+        writeContentHash(cache_file, file)
+    os.replace(tmp_file, cache_file)
+    entryAdded(cache_file)
+
+
+def loadEntry(cache_file, file=None):
+    '''
+    Loads an entry written by saveEntry
+
+    :param cache_file: the cache entry
+    :param file: source file used for strict mode content verification
+    :return: the cached object or None if the entry is missing, stale or unreadable
+    '''
+    if file and not isValidEntry(cache_file, file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            header = pickle.load(f)
+            if not isinstance(header, dict) or header.get('format') != CACHE_FORMAT_VERSION \
+                    or header.get('rdflib') != rdflib.__version__:
+                return None
+            obj = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    touch(cache_file)
+    return obj
+
+
+def cachedObject(kind, key, build):
+    '''
+    Loads an object computed from some files, such as an index, building and saving it if it
+    isn't in the cache yet
+
+    :param kind: one of ENTRY_KINDS
+    :param key: key from cacheKey
+    :param build: function computing the object
+    :return: the object
+    '''
+    cache_file = entryPath(kind, key, 'pickle')
+    obj = loadEntry(cache_file)
+    if obj is not None:
+        return obj
+
+    with entryLock(cache_file):
+        # another process may have built the entry while we waited for the lock
+        obj = loadEntry(cache_file)
+        if obj is None:
+            obj = build()
+            saveEntry(cache_file, obj)
+    return obj
+
+
+def removeEntry(cache_file):
+    '''
+    Deletes an entry and its content hash sidecar.  The lock file is left in place: another
+    process may be holding or waiting on it, and a new lock file would let a second builder in.
+    '''
+    if os.path.isdir(cache_file):
+        shutil.rmtree(cache_file, ignore_errors=True)
+    for f in (cache_file, cache_file + CONTENT_HASH_SUFFIX):
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+
+def listEntries():
+    '''
+    Lists the entries in CACHE_DIR, least recently used first
+
+    :return: list of dicts with path, kind, bytes and last_used
+    '''
+    entries = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+
+    for name in os.listdir(CACHE_DIR):
+        match = re.match(r'^({})\.[0-9a-f]+\.(pickle|sqlite|snapshot)$'.format('|'.join(ENTRY_KINDS)), name)
+        if not match:
+            continue
+        cache_file = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(cache_file)
+            size = entrySize(cache_file)
+        except OSError:
+            continue
+        entries.append({'path': cache_file, 'kind': match.group(1), 'bytes': size, 'last_used': st.st_mtime})
+
+    return sorted(entries, key=lambda e: e['last_used'])
+
+
+def entrySize(cache_file):
+    '''
+    Returns the bytes used by an entry, including a snapshot directory's files and the content hash sidecar
+    '''
+    size = os.path.getsize(cache_file)
+    if os.path.isdir(cache_file):
+        size = sum(os.path.getsize(os.path.join(cache_file, f)) for f in os.listdir(cache_file))
+    sidecar = cache_file + CONTENT_HASH_SUFFIX
+    if os.path.isfile(sidecar):
+        size += os.path.getsize(sidecar)
+    return size
+
+
+def cacheStats():
+    '''
+    Summarizes the cache contents
+
+    :return: dict
+    '''
+    entries = listEntries()
+    stats = {'directory': CACHE_DIR, 'max_bytes': CACHE_MAX_BYTES, 'entries': len(entries),
+             'bytes': sum(e['bytes'] for e in entries)}
+    for kind in ENTRY_KINDS:
+        stats[kind] = len([e for e in entries if e['kind'] == kind])
+    return stats
+
+
+# bytes in each cache directory, as counted by this process plus the entries it wrote since
+cache_bytes = {}
+
+
+def entryAdded(cache_file):
+    '''
+    Adds a newly written entry to the cache size and prunes the cache if that goes over CACHE_MAX_BYTES
+
+    :param cache_file: the new entry
+    '''
+    if not CACHE_MAX_BYTES:
+        return
+    if CACHE_DIR in cache_bytes:
+        try:
+            cache_bytes[CACHE_DIR] += entrySize(cache_file)
+        except OSError:
+            pass
+    else:
+        cache_bytes[CACHE_DIR] = sum(e['bytes'] for e in listEntries())
+    if cache_bytes[CACHE_DIR] > CACHE_MAX_BYTES:
+        prune()
+
+
+def prune(max_bytes=None):
+    '''
+    Evicts least recently used entries until the cache fits in max_bytes
+
+    :param max_bytes: byte budget, defaults to CACHE_MAX_BYTES. 0 means no limit
+    :return: list of removed entry paths
+    '''
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    if not max_bytes:
+        return []
+
+    entries = listEntries()
+    total = sum(e['bytes'] for e in entries)
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        removeEntry(entry['path'])
+        total -= entry['bytes']
+        removed.append(entry['path'])
+    cache_bytes[CACHE_DIR] = total
+
+    return removed
+
+
+def clear():
+    '''
+    Removes every cache entry, including leftover temporary files
+
+    :return: number of entries removed
+    '''
+    entries = listEntries()
+    for entry in entries:
+        removeEntry(entry['path'])
+    cache_bytes[CACHE_DIR] = 0
+
+    # temporary files left behind by killed processes
+    if os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            if name.startswith(ENTRY_KINDS) and name.endswith(TMP_SUFFIX):
+                removeEntry(os.path.join(CACHE_DIR, name))
+
+    return len(entries)
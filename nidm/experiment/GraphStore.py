@@ -0,0 +1,591 @@
+'''
+On-disk rdflib Store implementations used by Query.OpenGraph
+
+The SQLiteStore keeps the triples of a single NIDM file in a SQLite database with
+SPO, POS and OSP indexes.  Once a file has been loaded into a store, later processes
+can open the database and answer triple patterns (and therefore SPARQL queries) in place
+without parsing the turtle file or materializing every triple as Python objects.
+
+The store is registered with rdflib as 'NIDMSQLite' so it can also be used directly:
+
+    g = Graph(store='NIDMSQLite')
+    g.open('/tmp/my_graph.sqlite', create=True)
+
+The SnapshotStore is a read-only, columnar snapshot of a graph: a sorted term
+dictionary (one UTF-8 blob plus offsets) and integer encoded triples sorted in SPO,
+POS and OSP order, all saved as NumPy arrays.  Snapshots are opened with mmap so
+every process that opens the same snapshot shares one copy of it in the page cache.
+'''
+import os
+import json
+import shutil
+import sqlite3
+import functools
+import numpy as np
+import rdflib
+from rdflib import Graph, util, plugin
+from rdflib.graph import ModificationException
+from rdflib.store import Store, VALID_STORE, NO_STORE
+from rdflib.term import URIRef, BNode, Literal
+
+# number of added triples buffered in memory before they are written to the database
+WRITE_BATCH_SIZE = 10000
+TERM_CACHE_SIZE = 65536
+
+URI_TERM = 'U'
+BNODE_TERM = 'B'
+LITERAL_TERM = 'L'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS terms (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        datatype TEXT NOT NULL DEFAULT '',
+        lang TEXT NOT NULL DEFAULT '',
+        UNIQUE (kind, value, datatype, lang)
+    );
+    CREATE TABLE IF NOT EXISTS triples (
+        s INTEGER NOT NULL,
+        p INTEGER NOT NULL,
+        o INTEGER NOT NULL,
+        PRIMARY KEY (s, p, o)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s);
+    CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p);
+    CREATE TABLE IF NOT EXISTS namespaces (
+        prefix TEXT PRIMARY KEY,
+        uri TEXT NOT NULL
+    );
+'''
+
+
+def encodeTerm(term):
+    '''
+    Splits an rdflib term into the (kind, value, datatype, lang) columns of the terms table
+
+    :param term: URIRef, BNode or Literal
+    :return: tuple
+    '''
+    if isinstance(term, Literal):
+        return (LITERAL_TERM, str(term), str(term.datatype or ''), str(term.language or ''))
+    if isinstance(term, BNode):
+        return (BNODE_TERM, str(term), '', '')
+    return (URI_TERM, str(term), '', '')
+
+
+def decodeTerm(kind, value, datatype, lang):
+    '''
+    Inverse of encodeTerm
+    '''
+    if kind == LITERAL_TERM:
+        return Literal(value, lang=lang or None, datatype=URIRef(datatype) if datatype else None)
+    if kind == BNODE_TERM:
+        return BNode(value)
+    return URIRef(value)
+
+
+class SQLiteStore(Store):
+    '''
+    A read-mostly, non context aware rdflib Store persisted in a SQLite database.
+
+    Terms are interned into an integer dictionary and triples are stored as integer
+    rows with covering indexes for the SPO, POS and OSP access paths.
+    '''
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None):
+        self.identifier = identifier
+        self._path = None
+        self._connection = None
+        self._pid = None
+        self._pending = []
+        self._ids = {}
+        self._next_id = None
+        # id -> term cache, kept per store so closing one store doesn't flush the others
+        self._decode = functools.lru_cache(maxsize=TERM_CACHE_SIZE)(self._decodeTerm)
+        super(SQLiteStore, self).__init__(configuration)
+
+    #####################
+    # Store lifecycle
+    #####################
+
+    def open(self, configuration, create=False):
+        '''
+        Opens the SQLite database at the path given by configuration
+
+        :param configuration: path to the database file
+        :param create: create the database (and schema) if it doesn't exist
+        :return: VALID_STORE or NO_STORE
+        '''
+        if not create and not os.path.isfile(configuration):
+            return NO_STORE
+
+        self._path = configuration
+        self._connect()
+        if create:
+            self._connection.executescript(SCHEMA)
+        elif not self._hasSchema():
+            self.close()
+            return NO_STORE
+
+        self._next_id = self._connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM terms').fetchone()[0]
+        return VALID_STORE
+
+    def close(self, commit_pending_transaction=True):
+        if self._connection is None:
+            return
+        if commit_pending_transaction:
+            self.commit()
+        self._connection.close()
+        self._connection = None
+        self._ids = {}
+        self._decode.cache_clear()
+
+    def commit(self):
+        self._flush()
+        if self._connection is not None:
+            self._connection.commit()
+
+    def destroy(self, configuration):
+        self.close(commit_pending_transaction=False)
+        if os.path.isfile(configuration):
+            os.remove(configuration)
+
+    def _connect(self):
+        # sqlite connections must not be shared across a fork, so reconnect in child processes
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=OFF')
+        self._connection.execute('PRAGMA synchronous=OFF')
+        self._pid = os.getpid()
+
+    def _db(self):
+        if self._pid != os.getpid() and self._path:
+            self._connect()
+            self._decode.cache_clear()
+        return self._connection
+
+    def _hasSchema(self):
+        row = self._connection.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='triples'").fetchone()
+        return row[0] == 1
+
+    def __getstate__(self):
+        # connections can't be pickled, the path is enough to reopen the store
+        return {'identifier': self.identifier, 'path': self._path}
+
+    def __setstate__(self, state):
+        self.__init__(identifier=state['identifier'])
+        if state['path']:
+            self.open(state['path'])
+
+    #####################
+    # Term dictionary
+    #####################
+
+    def _termId(self, term, create=False):
+        key = encodeTerm(term)
+        if key in self._ids:
+            return self._ids[key]
+
+        row = self._db().execute('SELECT id FROM terms WHERE kind=? AND value=? AND datatype=? AND lang=?', key).fetchone()
+        if row:
+            self._ids[key] = row[0]
+            return row[0]
+        if not create:
+            return None
+
+        term_id = self._next_id
+        self._next_id += 1
+        self._db().execute('INSERT INTO terms (id, kind, value, datatype, lang) VALUES (?,?,?,?,?)', (term_id,) + key)
+        self._ids[key] = term_id
+        return term_id
+
+    def _decodeTerm(self, term_id):
+        row = self._db().execute('SELECT kind, value, datatype, lang FROM terms WHERE id=?', (term_id,)).fetchone()
+        return decodeTerm(*row)
+
+    #####################
+    # Triple access
+    #####################
+
+    def add(self, triple, context=None, quoted=False):
+        s, p, o = triple
+        self._pending.append((self._termId(s, True), self._termId(p, True), self._termId(o, True)))
+        if len(self._pending) >= WRITE_BATCH_SIZE:
+            self._flush()
+
+    def addN(self, quads):
+        for s, p, o, c in quads:
+            self.add((s, p, o), c)
+
+    def _flush(self):
+        if self._pending:
+            self._db().executemany('INSERT OR IGNORE INTO triples (s, p, o) VALUES (?,?,?)', self._pending)
+            self._pending = []
+
+    def remove(self, triple_pattern, context=None):
+        self._flush()
+        where, params = self._where(triple_pattern)
+        if where is None:
+            return
+        self._db().execute('DELETE FROM triples' + where, params)
+
+    def _where(self, triple_pattern):
+        '''
+        Builds the WHERE clause for a triple pattern. Returns (None, None) if one of the bound
+        terms is not in the term dictionary, meaning nothing can match.
+        '''
+        clauses = []
+        params = []
+        for column, term in zip(('s', 'p', 'o'), triple_pattern):
+            if term is None:
+                continue
+            term_id = self._termId(term)
+            if term_id is None:
+                return None, None
+            clauses.append('{}=?'.format(column))
+            params.append(term_id)
+
+        if clauses:
+            return ' WHERE ' + ' AND '.join(clauses), params
+        return '', params
+
+    def triples(self, triple_pattern, context=None):
+        '''
+        A generator over all the triples matching the pattern. SQLite picks the SPO, POS or OSP
+        index depending on which positions are bound.
+        '''
+        self._flush()
+        where, params = self._where(triple_pattern)
+        if where is None:
+            return
+
+        decode = self._decode
+        for s, p, o in self._db().execute('SELECT s, p, o FROM triples' + where, params):
+            yield (decode(s), decode(p), decode(o)), iter(())
+
+    def __len__(self, context=None):
+        self._flush()
+        return self._db().execute('SELECT count(*) FROM triples').fetchone()[0]
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    #####################
+    # Namespaces
+    #####################
+
+    def bind(self, prefix, namespace):
+        # rdflib rebinds the default prefixes every time a Graph is created, don't take a write lock for those
+        if self.namespace(prefix) == URIRef(namespace):
+            return
+        self._db().execute('INSERT OR REPLACE INTO namespaces (prefix, uri) VALUES (?,?)', (prefix, str(namespace)))
+        self._db().commit()
+
+    def namespace(self, prefix):
+        row = self._db().execute('SELECT uri FROM namespaces WHERE prefix=?', (prefix,)).fetchone()
+        return URIRef(row[0]) if row else None
+
+    def prefix(self, namespace):
+        row = self._db().execute('SELECT prefix FROM namespaces WHERE uri=?', (str(namespace),)).fetchone()
+        return row[0] if row else None
+
+    def namespaces(self):
+        for prefix, uri in self._db().execute('SELECT prefix, uri FROM namespaces').fetchall():
+            yield prefix, URIRef(uri)
+
+
+plugin.register('NIDMSQLite', Store, 'nidm.experiment.GraphStore', 'SQLiteStore')
+
+
+def OpenSQLiteGraph(file, store_file):
+    '''
+    Returns a Graph backed by a SQLiteStore for the given NIDM file.  If store_file doesn't exist
+    yet the NIDM file is parsed into a temporary database which is then moved into place, so
+    concurrent readers never see a partially written store.  Only that first load holds the
+    parsed triples in memory.
+
+    :param file: NIDM file to load
+    :param store_file: path of the SQLite database for this file
+    :return: Graph
+    '''
+    store = SQLiteStore()
+    if store.open(store_file) != VALID_STORE:
+        tmp_file = '{}.{}.tmp'.format(store_file, os.getpid())
+        store.open(tmp_file, create=True)
+        # rdflib's turtle parser needs a formula aware store, so parse in memory once and copy over
+        parsed = Graph().parse(file, format=util.guess_format(file))
+        for prefix, namespace in parsed.namespaces():
+            store.bind(prefix, namespace)
+        for triple in parsed:
+            store.add(triple)
+        del parsed
+        store.close()
+        os.replace(tmp_file, store_file)
+        store.open(store_file)
+
+    return Graph(store=store)
+
+
+#####################
+# Columnar snapshots
+#####################
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_HEADER = 'header.json'
+SNAPSHOT_TERMS = 'terms.bin'
+SNAPSHOT_TERM_OFFSETS = 'term_offsets.npy'
+SNAPSHOT_NAMESPACES = 'namespaces.json'
+# each index is a (3, N) array whose rows are the triple positions in that order
+SNAPSHOT_INDEXES = {'spo': (0, 1, 2), 'pos': (1, 2, 0), 'osp': (2, 0, 1)}
+TERM_SEPARATOR = '\x1f'
+
+
+def encodeSnapshotTerm(term):
+    # the value goes last so it may contain the separator
+    kind, value, datatype, lang = encodeTerm(term)
+    return TERM_SEPARATOR.join((kind, datatype, lang, value)).encode('utf-8')
+
+
+def decodeSnapshotTerm(data):
+    kind, datatype, lang, value = data.decode('utf-8').split(TERM_SEPARATOR, 3)
+    return decodeTerm(kind, value, datatype, lang)
+
+
+def writeSnapshot(rdf_graph, snapshot_dir):
+    '''
+    Writes a columnar snapshot of rdf_graph.  The snapshot is built in a temporary directory
+    which is then renamed to snapshot_dir.  If another process renamed its snapshot into
+    place first, that snapshot is kept.
+
+    :param rdf_graph: Graph to snapshot
+    :param snapshot_dir: directory for the snapshot, must not exist yet
+    '''
+    terms = set()
+    for triple in rdf_graph:
+        terms.update(triple)
+    encoded = sorted(set(encodeSnapshotTerm(t) for t in terms))
+    ids = {data: i for i, data in enumerate(encoded)}
+    term_ids = {t: ids[encodeSnapshotTerm(t)] for t in terms}
+
+    dtype = np.int32 if len(encoded) < 2 ** 31 else np.int64
+    triples = np.array([[term_ids[s], term_ids[p], term_ids[o]] for s, p, o in rdf_graph], dtype=dtype).reshape(-1, 3).T
+
+    tmp_dir = '{}.{}.tmp'.format(snapshot_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    with open(os.path.join(tmp_dir, SNAPSHOT_TERMS), 'wb') as f:
+        for data in encoded:
+            f.write(data)
+    np.save(os.path.join(tmp_dir, SNAPSHOT_TERM_OFFSETS), np.cumsum([0] + [len(d) for d in encoded], dtype=np.int64))
+
+    for name, order in SNAPSHOT_INDEXES.items():
+        index = triples[list(order)]
+        # lexsort uses the last key as the primary one
+        index = index[:, np.lexsort(index[::-1])] if index.shape[1] else index
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(index))
+
+    with open(os.path.join(tmp_dir, SNAPSHOT_NAMESPACES), 'w') as f:
+        json.dump({prefix: str(uri) for prefix, uri in rdf_graph.namespaces()}, f)
+    with open(os.path.join(tmp_dir, SNAPSHOT_HEADER), 'w') as f:
+        json.dump({'format': SNAPSHOT_FORMAT_VERSION, 'rdflib': rdflib.__version__,
+                   'terms': len(encoded), 'triples': int(triples.shape[1])}, f)
+
+    try:
+        os.rename(tmp_dir, snapshot_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        store = SnapshotStore()
+        if store.open(snapshot_dir) != VALID_STORE:
+            raise
+        store.close()
+
+
+class SnapshotStore(Store):
+    '''
+    A read-only rdflib Store over a snapshot written by writeSnapshot.  All arrays are memory
+    mapped, so opening a snapshot costs almost nothing and the data is shared between processes.
+    '''
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None):
+        self.identifier = identifier
+        self._path = None
+        self._terms = None
+        self._offsets = None
+        self._indexes = {}
+        self._namespaces = {}
+        self._decode = functools.lru_cache(maxsize=TERM_CACHE_SIZE)(self._decodeTerm)
+        super(SnapshotStore, self).__init__(configuration)
+
+    def open(self, configuration, create=False):
+        '''
+        Memory maps the snapshot in the directory given by configuration
+
+        :param configuration: snapshot directory
+        :param create: not supported, snapshots are made with writeSnapshot
+        :return: VALID_STORE or NO_STORE
+        '''
+        header_file = os.path.join(configuration, SNAPSHOT_HEADER)
+        if not os.path.isfile(header_file):
+            return NO_STORE
+        with open(header_file) as f:
+            header = json.load(f)
+        if header.get('format') != SNAPSHOT_FORMAT_VERSION:
+            return NO_STORE
+
+        self._path = configuration
+        if header['terms']:
+            self._terms = np.memmap(os.path.join(configuration, SNAPSHOT_TERMS), dtype=np.uint8, mode='r')
+        else:
+            self._terms = np.zeros(0, dtype=np.uint8)
+        self._offsets = np.load(os.path.join(configuration, SNAPSHOT_TERM_OFFSETS), mmap_mode='r')
+        for name in SNAPSHOT_INDEXES:
+            self._indexes[name] = np.load(os.path.join(configuration, name + '.npy'), mmap_mode='r')
+        with open(os.path.join(configuration, SNAPSHOT_NAMESPACES)) as f:
+            self._namespaces = {prefix: URIRef(uri) for prefix, uri in json.load(f).items()}
+        return VALID_STORE
+
+    def close(self, commit_pending_transaction=False):
+        self._terms = self._offsets = None
+        self._indexes = {}
+        self._decode.cache_clear()
+
+    def __getstate__(self):
+        return {'identifier': self.identifier, 'path': self._path}
+
+    def __setstate__(self, state):
+        self.__init__(identifier=state['identifier'])
+        if state['path']:
+            self.open(state['path'])
+
+    #####################
+    # Term dictionary
+    #####################
+
+    def _termBytes(self, term_id):
+        return self._terms[self._offsets[term_id]:self._offsets[term_id + 1]].tobytes()
+
+    def _decodeTerm(self, term_id):
+        return decodeSnapshotTerm(self._termBytes(int(term_id)))
+
+    def _termId(self, term):
+        '''
+        Binary search of the sorted term dictionary
+
+        :return: term id or None if the term isn't in the snapshot
+        '''
+        key = encodeSnapshotTerm(term)
+        lo, hi = 0, len(self._offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._termBytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._offsets) - 1 and self._termBytes(lo) == key:
+            return lo
+        return None
+
+    #####################
+    # Triple access
+    #####################
+
+    def triples(self, triple_pattern, context=None):
+        '''
+        A generator over all the triples matching the pattern.  The index whose leading
+        positions are the bound ones is narrowed with binary searches.
+        '''
+        ids = []
+        for term in triple_pattern:
+            if term is None:
+                ids.append(None)
+            else:
+                term_id = self._termId(term)
+                if term_id is None:
+                    return
+                ids.append(term_id)
+
+        bound = tuple(i for i in range(3) if ids[i] is not None)
+        for name, order in SNAPSHOT_INDEXES.items():
+            if set(order[:len(bound)]) == set(bound):
+                break
+
+        index = self._indexes[name]
+        lo, hi = 0, index.shape[1]
+        for row, position in enumerate(order[:len(bound)]):
+            column = index[row, lo:hi]
+            start = int(np.searchsorted(column, ids[position], side='left'))
+            end = int(np.searchsorted(column, ids[position], side='right'))
+            lo, hi = lo + start, lo + end
+            if lo >= hi:
+                return
+
+        decode = self._decode
+        rows = np.asarray(index[:, lo:hi])
+        inverse = [order.index(i) for i in range(3)]
+        for column in range(rows.shape[1]):
+            yield (decode(rows[inverse[0], column]), decode(rows[inverse[1], column]), decode(rows[inverse[2], column])), iter(())
+
+    def __len__(self, context=None):
+        return self._indexes['spo'].shape[1]
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def add(self, triple, context=None, quoted=False):
+        raise ModificationException()
+
+    def addN(self, quads):
+        raise ModificationException()
+
+    def remove(self, triple_pattern, context=None):
+        raise ModificationException()
+
+    #####################
+    # Namespaces
+    #####################
+
+    def bind(self, prefix, namespace):
+        # namespace bindings aren't triples, keep them in memory so Graph() can set its defaults
+        self._namespaces[prefix] = URIRef(namespace)
+
+    def namespace(self, prefix):
+        return self._namespaces.get(prefix)
+
+    def prefix(self, namespace):
+        for prefix, uri in self._namespaces.items():
+            if uri == URIRef(namespace):
+                return prefix
+        return None
+
+    def namespaces(self):
+        for prefix, uri in list(self._namespaces.items()):
+            yield prefix, uri
+
+
+plugin.register('NIDMSnapshot', Store, 'nidm.experiment.GraphStore', 'SnapshotStore')
+
+
+def OpenSnapshotGraph(file, snapshot_dir):
+    '''
+    Returns a read-only Graph over the columnar snapshot of the given NIDM file, writing the
+    snapshot first if snapshot_dir doesn't exist yet.
+
+    :param file: NIDM file to load
+    :param snapshot_dir: directory of the snapshot for this file
+    :return: Graph
+    '''
+    store = SnapshotStore()
+    if store.open(snapshot_dir) != VALID_STORE:
+        if os.path.isdir(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        writeSnapshot(Graph().parse(file, format=util.guess_format(file)), snapshot_dir)
+        store.open(snapshot_dir)
+
+    return Graph(store=store)
@@ -0,0 +1,177 @@
+'''
+In-memory cache of query results that knows which NIDM files each result was computed from
+
+Functions decorated with memoize keep their recent results like functools.lru_cache, but every
+result is tagged with the GraphCache.fileFingerprint of the files it was read from.  A result
+is only returned while those files are unchanged, so a long running process never answers from
+a file that has since been rewritten.  Files are stat()ed at most once every CHECK_INTERVAL
+seconds (PYNIDM_CACHE_CHECK_INTERVAL), and invalidateFiles drops the results of some files
+straight away, e.g. when a DatasetRegistry notices they changed.
+
+The files of a call are found from one of its arguments: a tuple or list of files, a single
+file name, a NIDMDataset, or a graph opened by Query.OpenGraph or NIDMDataset, which remembers
+its files in a nidm_files attribute.  Results computed from anything else (e.g. a graph built
+in memory) are kept until they are evicted or the caches are cleared.
+'''
+import os
+import time
+import threading
+import collections
+import functools
+from nidm.experiment import GraphCache
+
+# seconds a file's fingerprint is trusted before it is checked again
+CHECK_INTERVAL = float(os.environ.get('PYNIDM_CACHE_CHECK_INTERVAL', 1))
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'invalidations'])
+
+# every memoized function, in the order they were defined
+CACHES = []
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def currentFingerprint(file):
+    '''
+    GraphCache.fileFingerprint of a file, checked at most once every CHECK_INTERVAL seconds
+
+    :raises OSError: if the file can't be stat()ed
+    '''
+    now = time.monotonic()
+    checked = _fingerprints.get(file)
+    if checked is not None and now - checked[0] < CHECK_INTERVAL:
+        return checked[1]
+    fingerprint = GraphCache.fileFingerprint(file)
+    with _fingerprints_lock:
+        _fingerprints[file] = (now, fingerprint)
+    return fingerprint
+
+
+def sourceFiles(value):
+    '''
+    :return: tuple of the NIDM files a memoized function's argument refers to, () if unknown
+    '''
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, (tuple, list)):
+        return tuple(value) if all(isinstance(file, str) for file in value) else ()
+    files = getattr(value, 'nidm_files', None)
+    if files is None:
+        files = getattr(value, 'files', None)
+    return tuple(files) if files is not None else ()
+
+
+class MemoizedFunction(object):
+    '''
+    Least recently used cache of a function's results, see memoize
+    '''
+
+    def __init__(self, function, maxsize, files):
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.maxsize = maxsize
+        self.files = files
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        key = args + tuple(sorted(kwargs.items())) if kwargs else args
+        files = sourceFiles(args[self.files]) if self.files is not None and len(args) > self.files else ()
+        try:
+            fingerprints = tuple(currentFingerprint(file) for file in files)
+        except OSError:
+            # a missing file, let the function report it
+            return self.function(*args, **kwargs)
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == fingerprints:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+                self.invalidations += 1
+            self.misses += 1
+
+        result = self.function(*args, **kwargs)
+        with self._lock:
+            self.entries[key] = (fingerprints, result)
+            if self.maxsize is not None:
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return result
+
+    def invalidate(self, files):
+        '''
+        Drops the results computed from any of the files
+
+        :param files: set of real paths of files
+        :return: number of results dropped
+        '''
+        with self._lock:
+            # fingerprints start with the real path of the file
+            stale = [key for key, entry in self.entries.items() if any(fingerprint[0] in files for fingerprint in entry[0])]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries), self.invalidations)
+
+    def cache_clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+
+def memoize(maxsize=128, files=0):
+    '''
+    Decorator caching a function's results in memory until the files they came from change
+
+    :param maxsize: number of results kept, None for no limit
+    :param files: position of the argument naming the files the function reads, None if it
+        doesn't read any
+    '''
+    def decorator(function):
+        cache = MemoizedFunction(function, maxsize, files)
+        CACHES.append(cache)
+        return cache
+    return decorator
+
+
+def invalidateFiles(files):
+    '''
+    Drops every cached result computed from any of the files
+
+    :param files: file names
+    :return: number of results dropped
+    '''
+    files = set(os.path.realpath(file) for file in files)
+    with _fingerprints_lock:
+        for file in list(_fingerprints):
+            if _fingerprints[file][1][0] in files:
+                del _fingerprints[file]
+    return sum(cache.invalidate(files) for cache in CACHES)
+
+
+def clearAll():
+    '''
+    Drops every cached result
+    '''
+    with _fingerprints_lock:
+        _fingerprints.clear()
+    for cache in CACHES:
+        cache.cache_clear()
+
+
+def stats():
+    '''
+    :return: dictionary of qualified function name -> CacheInfo
+    '''
+    return collections.OrderedDict(('{}.{}'.format(cache.__module__.split('.')[-1], cache.__name__), cache.cache_info())
+                                   for cache in CACHES)
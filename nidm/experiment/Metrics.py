@@ -0,0 +1,197 @@
+'''
+Metrics for finding out where a long running process such as the REST server spends its time
+
+Histograms and counters are kept in memory for the life of the process and rendered in the
+Prometheus text exposition format by render(), which rest-server.py serves at /metrics.  Query,
+Navigate and the REST layer record:
+
+- nidm_rest_request_seconds: time RestParser takes to answer a command, per route
+- nidm_graph_load_seconds: time spent parsing NIDM files, loading them from the graph cache and
+  building the union of several files
+- nidm_graph_cache_total: on-disk graph cache hits and misses of Query.OpenGraph
+- nidm_sparql_query_seconds / nidm_sparql_result_rows: duration and size of SPARQL queries, per
+  Query function
+- nidm_memory_cache_*: hits, misses, invalidations and size of the MemoryCache caches of Query
+  and Navigate, read when the metrics are rendered
+
+With PYNIDM_METRICS_LOG set every observation is also logged as a line of JSON to the
+nidm.metrics logger.  Each process has its own metrics, so the workers of a prefork server
+report separately.
+'''
+import os
+import sys
+import json
+import bisect
+import logging
+import threading
+import collections
+
+LOG_JSON = os.environ.get('PYNIDM_METRICS_LOG', '').lower() not in ('', '0', 'false', 'no')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger('nidm.metrics')
+_lock = threading.Lock()
+# name -> metric, in the order they were defined
+METRICS = collections.OrderedDict()
+# functions returning extra samples when the metrics are rendered, see render
+collectors = []
+
+
+def formatLabels(labels):
+    pairs = list(labels)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    '''
+    A count per combination of label values
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = collections.defaultdict(float)
+
+    def increment(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            self.values[key] += amount
+        if LOG_JSON:
+            logger.info(json.dumps(dict(labels, metric=self.name, increment=amount)))
+
+    def samples(self):
+        with _lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, zip(self.labels, key), value
+
+
+class Histogram(object):
+    '''
+    Distribution of observed values per combination of label values
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [count per bucket..., sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+        if LOG_JSON:
+            logger.info(json.dumps(dict(labels, metric=self.name, value=value)))
+
+    def samples(self):
+        with _lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            labels = list(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield self.name + '_bucket', labels + [('le', formatValue(float(bound)))], total
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, total
+
+
+def counter(name, help, labels=()):
+    return METRICS.setdefault(name, Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return METRICS.setdefault(name, Histogram(name, help, labels, buckets))
+
+
+REST_REQUEST_SECONDS = histogram('nidm_rest_request_seconds', 'Time RestParser takes to answer a command', ('route', 'response_cache'))
+GRAPH_LOAD_SECONDS = histogram('nidm_graph_load_seconds', 'Time spent loading NIDM graphs', ('source',))
+GRAPH_CACHE = counter('nidm_graph_cache_total', 'On-disk graph cache lookups of Query.OpenGraph', ('result',))
+SPARQL_SECONDS = histogram('nidm_sparql_query_seconds', 'Duration of SPARQL queries', ('function',))
+SPARQL_ROWS = histogram('nidm_sparql_result_rows', 'Rows returned by SPARQL queries', ('function',), SIZE_BUCKETS)
+
+
+def callerName(depth=2):
+    '''
+    :return: name of the function that called the caller of this function
+    '''
+    return sys._getframe(depth).f_code.co_name
+
+
+def observeQuery(function, seconds, rows):
+    '''
+    Records the duration and size of a SPARQL query run by a Query function
+    '''
+    SPARQL_SECONDS.observe(seconds, function=function)
+    SPARQL_ROWS.observe(rows, function=function)
+
+
+def memoryCacheSamples():
+    '''
+    Samples for the MemoryCache caches of Query and Navigate
+    '''
+    # the caches are registered when Query and Navigate are imported
+    from nidm.experiment import MemoryCache, Query, Navigate
+    for name, info in MemoryCache.stats().items():
+        labels = [('function', name)]
+        yield 'nidm_memory_cache_hits_total', labels, info.hits
+        yield 'nidm_memory_cache_misses_total', labels, info.misses
+        yield 'nidm_memory_cache_invalidations_total', labels, info.invalidations
+        yield 'nidm_memory_cache_entries', labels, info.currsize
+        if info.hits + info.misses:
+            yield 'nidm_memory_cache_hit_ratio', labels, float(info.hits) / (info.hits + info.misses)
+
+
+collectors.append(memoryCacheSamples)
+
+
+def render():
+    '''
+    :return: every metric in the Prometheus text exposition format
+    '''
+    lines = []
+    for metric in list(METRICS.values()):
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('{}{} {}'.format(name, formatLabels(labels), formatValue(value)))
+
+    # the samples of a metric have to be listed together
+    collected = collections.OrderedDict()
+    for collector in collectors:
+        for name, labels, value in collector():
+            collected.setdefault(name, []).append('{}{} {}'.format(name, formatLabels(labels), formatValue(value)))
+    for name, samples in collected.items():
+        lines.append('# TYPE {} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    '''
+    Forgets every observation, e.g. between tests
+    '''
+    with _lock:
+        for metric in METRICS.values():
+            metric.values.clear()
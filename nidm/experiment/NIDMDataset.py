@@ -0,0 +1,167 @@
+'''
+A set of NIDM files viewed as a single read-only graph
+
+NIDMDataset opens every file once (through Query.OpenGraph, so the on-disk graph
+cache and GRAPH_STORE backends are used) and answers triple patterns and SPARQL
+queries over the union of the files, so joins that span files are found.  With
+infer_types the union also holds the rdf:type closure over rdfs:subClassOf of each
+file (see Query.GetInferredTypes) as separate graphs.
+'''
+import time
+import collections
+from rdflib import BNode
+from rdflib.graph import Graph, ReadOnlyGraphAggregate
+from rdflib.paths import Path
+from nidm.experiment import Metrics
+from nidm.experiment.GraphStore import SQLiteStore, SnapshotStore
+
+
+class UnionGraph(ReadOnlyGraphAggregate):
+    '''
+    Read-only union of several graphs.  Unlike ReadOnlyGraphAggregate it keeps the
+    namespace bindings of its member graphs, evaluates property paths once over the
+    whole union and can be used as a MemoryCache key.
+    '''
+
+    def __init__(self, graphs):
+        super(UnionGraph, self).__init__(graphs)
+        for graph in graphs:
+            for prefix, namespace in graph.namespaces():
+                if self.store.namespace(prefix) is None and self.store.prefix(namespace) is None:
+                    self.store.bind(prefix, namespace)
+
+    def triples(self, triple):
+        s, p, o = triple
+        if isinstance(p, Path):
+            for s1, o1 in p.eval(self, s, o):
+                yield s1, p, o1
+        else:
+            for graph in self.graphs:
+                for t in graph.triples((s, p, o)):
+                    yield t
+
+    def namespaces(self):
+        for prefix, namespace in self.namespace_manager.namespaces():
+            yield prefix, namespace
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other
+
+
+def unionGraph(graphs):
+    '''
+    Combines graphs into one read-only graph.  Graphs built in memory may reuse blank node
+    labels, so an in-memory graph whose blank nodes clash with an earlier one is copied with
+    fresh blank nodes before it is added to the union.  SQLite and snapshot stores are not
+    scanned: they are written from a single parse, which already gives every blank node a
+    globally unique label.
+
+    :param graphs: list of rdflib Graphs
+    :return: Graph
+    '''
+    if len(graphs) == 1:
+        return graphs[0]
+
+    members = []
+    seen = set()
+    for graph in graphs:
+        if isinstance(graph.store, (SQLiteStore, SnapshotStore)):
+            members.append(graph)
+            continue
+        bnodes = set(t for triple in graph for t in triple[::2] if isinstance(t, BNode))
+        if bnodes & seen:
+            renamed = collections.defaultdict(BNode)
+            copy = Graph()
+            for prefix, namespace in graph.namespaces():
+                copy.bind(prefix, namespace)
+            for triple in graph:
+                copy.add(tuple(renamed[t] if isinstance(t, BNode) else t for t in triple))
+            graph = copy
+            bnodes = set(renamed.values())
+        seen |= bnodes
+        members.append(graph)
+
+    return UnionGraph(members)
+
+
+class NIDMDataset(object):
+    '''
+    One or more NIDM files that are queried together.  It can be passed to the Query and
+    Navigate functions anywhere a list of NIDM files is accepted.  Iterating over it gives
+    the file names, and it hashes like the tuple of its files so cached query results are
+    shared with callers that pass the plain file list.
+    '''
+
+    def __init__(self, nidm_file_list, infer_types=False):
+        '''
+        :param nidm_file_list: list of NIDM files or a single file name
+        :param infer_types: add the types implied by rdfs:subClassOf statements to the graph
+        '''
+        if isinstance(nidm_file_list, str):
+            nidm_file_list = nidm_file_list.split(',')
+        self.files = tuple(nidm_file_list)
+        self.infer_types = infer_types
+        self._graph = None
+
+    @property
+    def graph(self):
+        '''
+        The union of all the files, opened on first use
+        '''
+        if self._graph is None:
+            from nidm.experiment.Query import OpenGraph, GetInferredTypes
+            graphs = [OpenGraph(f) for f in self.files]
+            inferred = [GetInferredTypes(f) for f in self.files] if self.infer_types else []
+            # loading each file is recorded by OpenGraph, this is the time it takes to combine them
+            start = time.perf_counter()
+            self._graph = unionGraph(graphs)
+            if inferred:
+                # the inferred types share the resources of their file, so they skip the blank node check
+                members = self._graph.graphs if isinstance(self._graph, UnionGraph) else [self._graph]
+                self._graph = UnionGraph(members + inferred)
+            self._graph.nidm_files = self.files
+            Metrics.GRAPH_LOAD_SECONDS.observe(time.perf_counter() - start, source='union')
+        return self._graph
+
+    @property
+    def graphs(self):
+        '''
+        The graph of each file, in file order
+        '''
+        from nidm.experiment.Query import OpenGraph
+        return [OpenGraph(f) for f in self.files]
+
+    def triples(self, triple):
+        return self.graph.triples(triple)
+
+    def query(self, query):
+        return self.graph.query(query)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __hash__(self):
+        return hash(self.files)
+
+    def __eq__(self, other):
+        if isinstance(other, NIDMDataset):
+            return self.files == other.files
+        return self.files == other
+
+    def __getstate__(self):
+        # the union is rebuilt from the graph cache after unpickling
+        return {'files': self.files, 'infer_types': self.infer_types}
+
+    def __setstate__(self, state):
+        self.files = state['files']
+        self.infer_types = state.get('infer_types', False)
+        self._graph = None
+
+    def __repr__(self):
+        return 'NIDMDataset({})'.format(list(self.files))
@@ -1,8 +1,8 @@
 from nidm.core import Constants
-from nidm.experiment.Query import OpenGraph, URITail, trimWellKnownURIPrefix, getDataTypeInfo, ACQUISITION_MODALITY, \
+from nidm.experiment import GraphCache, MemoryCache
+from nidm.experiment.Query import OpenGraph, OpenDataset, URITail, trimWellKnownURIPrefix, getDataTypeInfo, ACQUISITION_MODALITY, \
     IMAGE_CONTRAST_TYPE, IMAGE_USAGE_TYPE, TASK, expandUUID, matchPrefix
 from rdflib import Graph, RDF, URIRef, util, term
-import functools
 import collections
 
 
@@ -11,6 +11,8 @@ isPartOf = Constants.DCT['isPartOf']
 ValueType = collections.namedtuple('ValueType',
                                    ['value', 'label', 'datumType', 'hasUnit', 'isAbout', 'measureOf', 'hasLaterality', 'dataElement', 'description', 'subject', 'project'])
 ActivityData = collections.namedtuple('ActivityData', ['category', 'uuid', 'data'])
+# project -> sessions, session -> acquisitions, acquisition -> subject, subject -> activities, activity -> generated entities
+NavigationIndex = collections.namedtuple('NavigationIndex', ['sessions', 'acquisitions', 'subject', 'activities', 'generated'])
 QUERY_CACHE_SIZE=64
 BIG_CACHE_SIZE=256
 
@@ -49,7 +51,17 @@ def expandID(id, namespace):
     return id
 
 
-@functools.lru_cache(maxsize=BIG_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def getNamespaceLookup(nidm_file_tuples):
+    names = {}
+    rdf_graph = OpenDataset(nidm_file_tuples)
+    for (prefix, uri) in rdf_graph.namespace_manager.namespaces():
+        if not str(uri) in names:
+            names[str(uri)] = prefix
+    return names
+
+
+@MemoryCache.memoize(maxsize=BIG_CACHE_SIZE)
 def simplifyURIWithPrefix(nidm_file_tuples, uri):
     '''
     Takes a URI and finds if there is a simple prefix for it in the graph
@@ -58,16 +70,6 @@ def simplifyURIWithPrefix(nidm_file_tuples, uri):
     :return: simple prefix or the original uri string
     '''
 
-    @functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
-    def getNamespaceLookup(nidm_file_tuples):
-        names = {}
-        for f in nidm_file_tuples:
-            rdf_graph = OpenGraph(f)
-            for (prefix, uri) in rdf_graph.namespace_manager.namespaces():
-                if not str(uri) in names:
-                    names[str(uri)] = prefix
-        return names
-
     names = getNamespaceLookup(tuple(nidm_file_tuples))
     # strip off the bit of URI after the last /
     trimed_uri = str(uri).split('/')[0:-1]
@@ -77,63 +79,82 @@ def simplifyURIWithPrefix(nidm_file_tuples, uri):
     else:
         return uri
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def buildNavigationIndex(rdf_graph):
+    '''
+    Walks the graph once and records the project/session/acquisition/subject/activity structure
+    that the functions below navigate
+
+    :param rdf_graph: Graph (usually the union of a dataset)
+    :return: NavigationIndex
+    '''
+    sessions = set(rdf_graph.subjects(isa, Constants.NIDM['Session']))
+    acquisitions = set(rdf_graph.subjects(isa, Constants.NIDM['Acquisition']))
+    activities = set(rdf_graph.subjects(isa, Constants.PROV['Activity']))
+
+    index = NavigationIndex(sessions={}, acquisitions={}, subject={}, activities={}, generated={})
+
+    for (part, container) in rdf_graph.subject_objects(isPartOf):
+        if part in sessions:
+            index.sessions.setdefault(container, []).append(part)
+        if part in acquisitions:
+            index.acquisitions.setdefault(container, []).append(part)
+
+    for (activity, blank) in rdf_graph.subject_objects(Constants.PROV['qualifiedAssociation']):
+        is_subject = (blank, Constants.PROV['hadRole'], Constants.SIO['Subject']) in rdf_graph
+        for agent in rdf_graph.objects(blank, Constants.PROV['agent']):
+            if is_subject and activity not in index.subject:
+                index.subject[activity] = agent
+            if activity in activities:
+                index.activities.setdefault(agent, set()).add(activity)
+
+    for (entity, activity) in rdf_graph.subject_objects(Constants.PROV['wasGeneratedBy']):
+        index.generated.setdefault(activity, []).append(entity)
+
+    return index
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def getNavigationIndex(nidm_file_tuples):
+    '''
+    Returns the NavigationIndex for a set of NIDM files.  The index is built once per dataset
+    and saved in the graph cache next to the parsed graphs, keyed on the fingerprints of the files.
+
+    :param nidm_file_tuples: tuple of NIDM files or a NIDMDataset
+    :return: NavigationIndex
+    '''
+    files = tuple(nidm_file_tuples)
+    if not all(isinstance(f, str) for f in files):
+        # graphs that didn't come from files can't be cached on disk
+        return buildNavigationIndex(OpenDataset(nidm_file_tuples))
+
+    return GraphCache.cachedObject('nav_index', GraphCache.cacheKey(*files), lambda: buildNavigationIndex(OpenDataset(nidm_file_tuples)))
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getProjects(nidm_file_tuples):
     projects = []
 
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        #find all the sessions
-        for (project, p, o) in rdf_graph.triples((None, isa, Constants.NIDM['Project'])):
-            projects.append(project)
+    rdf_graph = OpenDataset(nidm_file_tuples)
+    #find all the sessions
+    for (project, p, o) in rdf_graph.triples((None, isa, Constants.NIDM['Project'])):
+        projects.append(project)
 
     return projects
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getSessions(nidm_file_tuples, project_id):
     project_uri = expandID(project_id, Constants.NIIRI)
-    sessions = []
-
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        #find all the sessions
-        for (session, p, o) in rdf_graph.triples((None, isa, Constants.NIDM['Session'])):
-            #check if it is part of our project
-            if (session, isPartOf, project_uri) in rdf_graph:
-                sessions.append(session)
+    return list(getNavigationIndex(nidm_file_tuples).sessions.get(project_uri, []))
 
-    return sessions
-
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getAcquisitions(nidm_file_tuples, session_id):
     session_uri = expandID(session_id, Constants.NIIRI)
-    acquisitions = []
-
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        #find all the sessions
-        for (acq, p, o) in rdf_graph.triples((None, isPartOf, session_uri)):
-            #check if it is a acquisition
-            if (acq, isa, Constants.NIDM['Acquisition']) in rdf_graph:
-                acquisitions.append(acq)
-
-    return acquisitions
+    return list(getNavigationIndex(nidm_file_tuples).acquisitions.get(session_uri, []))
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getSubject(nidm_file_tuples, acquisition_id):
     acquisition_uri = expandID(acquisition_id, Constants.NIIRI)
-    subjects = []
-
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        #find all the sessions
-        for (acq, p, blank) in rdf_graph.triples((acquisition_uri, Constants.PROV['qualifiedAssociation'], None)):
-            for (s2, p2, sub) in rdf_graph.triples((blank, Constants.PROV['agent'], None)):
-                if (blank, Constants.PROV['hadRole'], Constants.SIO['Subject']) in rdf_graph:
-                    return sub
-    return None
+    return getNavigationIndex(nidm_file_tuples).subject.get(acquisition_uri)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getSubjects(nidm_file_tuples, project_id):
     subjects = set([])
     project_uri = expandID(project_id, Constants.NIIRI)
@@ -146,36 +167,26 @@ def getSubjects(nidm_file_tuples, project_id):
             subjects.add(sub)
     return subjects
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getSubjectIDfromUUID(nidm_file_tuples, subject_uuid):
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        id_generator = rdf_graph.objects(subject=subject_uuid, predicate=Constants.NDAR['src_subject_id'])
-        for id in id_generator:
-            return id
+    rdf_graph = OpenDataset(nidm_file_tuples)
+    id_generator = rdf_graph.objects(subject=subject_uuid, predicate=Constants.NDAR['src_subject_id'])
+    for id in id_generator:
+        return id
     return None
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getActivities(nidm_file_tuples, subject_id):
-    activities = set([])
     subject_uri = expandID(subject_id, Constants.NIIRI)
+    return set(getNavigationIndex(nidm_file_tuples).activities.get(subject_uri, []))
 
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        for blank_node in rdf_graph.subjects( predicate=Constants.PROV['agent'], object=subject_uri):
-            for activity in rdf_graph.subjects(predicate=Constants.PROV['qualifiedAssociation'], object=blank_node):
-                if (activity, isa, Constants.PROV['Activity']) in rdf_graph:
-                    activities.add(activity)
-    return activities
-
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def isAStatCollection(nidm_file_tuples, uri):
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        if ((uri, isa, Constants.NIDM['FSStatsCollection']) in rdf_graph ) or \
-            ((uri, isa, Constants.NIDM['FSLStatsCollection']) in rdf_graph) or \
-            ((uri, isa, Constants.NIDM['ANTSStatsCollection']) in rdf_graph) :
-            return True
+    rdf_graph = OpenDataset(nidm_file_tuples)
+    if ((uri, isa, Constants.NIDM['FSStatsCollection']) in rdf_graph ) or \
+        ((uri, isa, Constants.NIDM['FSLStatsCollection']) in rdf_graph) or \
+        ((uri, isa, Constants.NIDM['ANTSStatsCollection']) in rdf_graph) :
+        return True
     return False
 
 # def getDataElementInfo(nidm_file_list, id):
@@ -192,49 +203,48 @@ def isAStatCollection(nidm_file_tuples, uri):
 #
 #     return False
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getActivityData(nidm_file_tuples, acquisition_id):
     acquisition_uri = expandID(acquisition_id, Constants.NIIRI)
     result = []
     category = None
 
-    for file in nidm_file_tuples:
-        rdf_graph = OpenGraph(file)
-        # find everything generated by the acquisition
-        for (data_object, p1, o1) in rdf_graph.triples((None, Constants.PROV['wasGeneratedBy'], acquisition_uri)):
-            # make sure this is an acquisition object
-            if (data_object, isa, Constants.NIDM['AcquisitionObject']) in rdf_graph:
-                category = 'instrument'
-                # iterate over all the items in the acquisition object
-                for (s, p, o) in rdf_graph.triples((data_object, None, None)):
-
-                    dti = getDataTypeInfo(rdf_graph, p)
-                    if (dti):
-                        # there is a DataElement describing this predicate
-                        value_type = makeValueTypeFromDataTypeInfo(value=trimWellKnownURIPrefix(o), data_type_info_tuple=dti)
-                        result.append( value_type )
+    rdf_graph = OpenDataset(nidm_file_tuples)
+    # find everything generated by the acquisition
+    for data_object in getNavigationIndex(nidm_file_tuples).generated.get(acquisition_uri, []):
+        # make sure this is an acquisition object
+        if (data_object, isa, Constants.NIDM['AcquisitionObject']) in rdf_graph:
+            category = 'instrument'
+            # iterate over all the items in the acquisition object
+            for (s, p, o) in rdf_graph.triples((data_object, None, None)):
+
+                dti = getDataTypeInfo(rdf_graph, p)
+                if (dti):
+                    # there is a DataElement describing this predicate
+                    value_type = makeValueTypeFromDataTypeInfo(value=trimWellKnownURIPrefix(o), data_type_info_tuple=dti)
+                    result.append( value_type )
+                else:
+                    #Don't know exactly what this is so just set a label and be done.
+                    if (data_object, isa, Constants.ONLI['assessment-instrument']) in rdf_graph:
+                        result.append(makeValueType(value=trimWellKnownURIPrefix(o), label=simplifyURIWithPrefix(nidm_file_tuples, str(p))))
+                        #result[ simplifyURIWithPrefix(nidm_file_list, str(p)) ] = trimWellKnownURIPrefix(o)
                     else:
-                        #Don't know exactly what this is so just set a label and be done.
-                        if (data_object, isa, Constants.ONLI['assessment-instrument']) in rdf_graph:
-                            result.append(makeValueType(value=trimWellKnownURIPrefix(o), label=simplifyURIWithPrefix(nidm_file_tuples, str(p))))
-                            #result[ simplifyURIWithPrefix(nidm_file_list, str(p)) ] = trimWellKnownURIPrefix(o)
-                        else:
-                            result.append(makeValueType(value=trimWellKnownURIPrefix(o), label=URITail(str(p))))
-                            # result[ URITail(str(p))] = trimWellKnownURIPrefix(o)
-
-            # or maybe it's a stats collection
-            elif isAStatCollection (nidm_file_tuples, data_object):
-                category = 'derivative'
-                for (s, p, o) in rdf_graph.triples((data_object, None, None)):
-                        cde = getDataTypeInfo(rdf_graph,p )
-                        result.append(
-                            makeValueTypeFromDataTypeInfo(value=str(o), data_type_info_tuple=cde)
-                        )
-                        # result[ URITail(str(p)) ] = str(o)
+                        result.append(makeValueType(value=trimWellKnownURIPrefix(o), label=URITail(str(p))))
+                        # result[ URITail(str(p))] = trimWellKnownURIPrefix(o)
+
+        # or maybe it's a stats collection
+        elif isAStatCollection (nidm_file_tuples, data_object):
+            category = 'derivative'
+            for (s, p, o) in rdf_graph.triples((data_object, None, None)):
+                    cde = getDataTypeInfo(rdf_graph,p )
+                    result.append(
+                        makeValueTypeFromDataTypeInfo(value=str(o), data_type_info_tuple=cde)
+                    )
+                    # result[ URITail(str(p)) ] = str(o)
 
     return ActivityData(category=category, uuid=trimWellKnownURIPrefix(acquisition_uri),  data=result)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def GetProjectAttributes(nidm_files_tuple, project_id):
     result = {
         ACQUISITION_MODALITY: set([]),
@@ -245,15 +255,14 @@ def GetProjectAttributes(nidm_files_tuple, project_id):
 
     project_uuid = expandUUID(project_id)
 
-    for file in nidm_files_tuple:
-        rdf_graph = OpenGraph(file)
-        #find all the projects
-        for (project,pred,o) in rdf_graph.triples((None, None, Constants.NIDM['Project'])):
-            #check if it is our project
-            if str(project) == str(project_uuid):
-                # get all the basic data from the project
-                for (proj, predicate, object) in rdf_graph.triples((project, None, None)):
-                    result[ matchPrefix(str(predicate)) ] = str(object)
+    rdf_graph = OpenDataset(nidm_files_tuple)
+    #find all the projects
+    for (project,pred,o) in rdf_graph.triples((None, None, Constants.NIDM['Project'])):
+        #check if it is our project
+        if str(project) == str(project_uuid):
+            # get all the basic data from the project
+            for (proj, predicate, object) in rdf_graph.triples((project, None, None)):
+                result[ matchPrefix(str(predicate)) ] = str(object)
 
     # now drill into the acquisition objects to get some specific
     # elements: AcquisitionModality, ImageContrastType, ImageUsageType, Task
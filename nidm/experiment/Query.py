@@ -34,18 +34,48 @@ from rdflib import Graph, URIRef, util
 import pandas as pd
 import logging
 from nidm.core import Constants
+from nidm.experiment.GraphStore import OpenSQLiteGraph, OpenSnapshotGraph
+from nidm.experiment import GraphCache
+from nidm.experiment import Metrics
+from nidm.experiment import MemoryCache
+from nidm.experiment.NIDMDataset import NIDMDataset
+from nidm.experiment import Filter
 import re
 import tempfile
 from os import path
-import functools
+import collections
+import bisect
 import hashlib
+import time
 from urllib.request import urlretrieve
+from concurrent.futures import ProcessPoolExecutor
+from rapidfuzz import fuzz, process
 
 import pickle
 
-from joblib import Memory
-memory = Memory(tempfile.gettempdir(), verbose=0 )
 
+# on-disk backend OpenGraph uses to cache parsed files: 'pickle', 'sqlite' or 'snapshot'
+GRAPH_STORE = os.environ.get('PYNIDM_GRAPH_STORE', 'pickle')
+# add the rdf:type closure over rdfs:subClassOf to datasets, see GetInferredTypes
+INFER_TYPES = os.environ.get('PYNIDM_INFER_TYPES', '').lower() not in ('', '0', 'false', 'no')
+# name of the graph holding the inferred types of a file
+INFERRED_TYPES = URIRef('urn:pynidm:inferred-types')
+
+# wide table of a project's data built by GetProjectDataTable
+ProjectDataTable = collections.namedtuple('ProjectDataTable', ['values', 'numbers', 'elements'])
+# subjects of a project in one file, see GetProjectSummaries
+ProjectSummary = collections.namedtuple('ProjectSummary', ['subjects', 'age_min', 'age_max', 'genders', 'handedness'])
+# field names of a project's data elements, see GetSynonymIndex
+SynonymIndex = collections.namedtuple('SynonymIndex', ['terms', 'normalized_terms', 'synonyms'])
+# rapidfuzz score (0-100) a field name has to reach to match a data element that no term matches
+# exactly, 0 to turn fuzzy matching off
+FUZZY_FIELD_SCORE = float(os.environ.get('PYNIDM_FUZZY_FIELD_SCORE', 0))
+
+class AmbiguousUUIDError(ValueError):
+    '''
+    A partial UUID is the start of more than one identifier
+    '''
+    pass
 
 QUERY_CACHE_SIZE=64
 BIG_CACHE_SIZE=256
@@ -55,73 +85,110 @@ IMAGE_CONTRAST_TYPE = 'ImageContrastType'
 IMAGE_USAGE_TYPE = 'ImageUsageType'
 TASK = 'Task'
 
-def sparql_query_nidm(nidm_file_list,query, output_file=None, return_graph=False):
+def timedQuery(rdf_graph, query, function=None):
+    '''
+    Runs a SPARQL query and records its duration and number of rows in Metrics
+
+    :param rdf_graph: graph to query
+    :param query: SPARQL query string
+    :param function: name to record the query under, the calling function by default
+    :return: rdflib query result, with the rows already read
+    '''
+    start = time.perf_counter()
+    qres = rdf_graph.query(query)
+    # results are evaluated lazily, count the rows so the time spent finding them is included
+    rows = len(qres)
+    Metrics.observeQuery(function or Metrics.callerName(), time.perf_counter() - start, rows)
+    return qres
+
+def sparql_query_nidm(nidm_file_list,query, output_file=None, return_graph=False, jobs=1):
     '''
 
-    :param nidm_file_list: List of NIDM.ttl files to execute query on
+    :param nidm_file_list: List of NIDM.ttl files or a NIDMDataset to execute query on
     :param query:  SPARQL query string
     :param output_file:  Optional output file to write results
     :param return_graph: WIP - not working right now but for some queries we prefer to return a graph instead of a dataframe
+    :param jobs: if more than 1, run the query against each file separately in this many worker processes
+        (federated mode).  Each file is queried on its own, so joins across files are not found in this mode
     :return: dataframe | graph depending on return_graph parameter
     '''
 
-    #query result list
-    results = []
-
-
     logging.info("Query: %s" , query)
 
-    first_file=True
-    #cycle through NIDM files, adding query result to list
-    for nidm_file in nidm_file_list:
+    if hasattr(query, 'read'):
+        query = query.read()
 
-        # project=read_nidm(nidm_file)
-        #read RDF file into temporary graph
-        # rdf_graph = Graph()
-        # rdf_graph_parse = rdf_graph.parse(nidm_file,format=util.guess_format(nidm_file))
-        rdf_graph_parse = OpenGraph(nidm_file)
+    files = [] if isinstance(nidm_file_list, (str, Graph)) else list(nidm_file_list)
+    if jobs > 1 and not return_graph and len(files) > 1 and all(isinstance(f, str) for f in files):
+        start = time.perf_counter()
+        df = sparqlQueryFiles(files, query, jobs)
+        Metrics.observeQuery(Metrics.callerName(), time.perf_counter() - start, len(df))
+    else:
+        # the query runs once over the union of all the files so joins across files are found
+        rdf_graph = OpenDataset(nidm_file_list)
 
+        #execute query
+        qres = timedQuery(rdf_graph, query, Metrics.callerName())
 
-        if not return_graph:
-            #execute query
-            qres = rdf_graph_parse.query(query)
+        if return_graph:
+            #WIP: qres_graph = Graph().parse(data=qres.serialize(format='turtle'))
+            return qres.serialize(format='turtle')
 
-            #if this is the first file then grab the SPARQL bound variable names from query result for column headings of query result
-            if first_file:
-                #format query result as dataframe and return
-                #for dicts in qres._get_bindings():
-                columns = [str(var) for var in qres.vars]
-                first_file=False
-                #    break
+        #convert results list to Pandas DataFrame and return
+        columns = [str(var) for var in qres.vars]
+        df = pd.DataFrame([list(row) for row in qres],columns=columns)
 
-            #append result as row to result list
-            for row in qres:
-                results.append(list(row))
-        else:
-            #execute query
-            qres = rdf_graph_parse.query(query)
-
-            if first_file:
-                #create graph
-                #WIP: qres_graph = Graph().parse(data=qres.serialize(format='turtle'))
-                qres_graph = qres.serialize(format='turtle')
-                first_file=False
-            else:
-                #WIP qres_graph = qres_graph + Graph().parse(data=qres.serialize(format='turtle'))
-                qres_graph = qres_graph + qres.serialize(format='turtle')
+    #if output file parameter specified
+    if (output_file is not None):
+        df.to_csv(output_file)
+    return df
 
+def initQueryWorker(graph_store, cache_dir, infer_types=False):
+    '''
+    Runs in each sparqlQueryFiles worker process so it uses the same graph cache as the parent
+    '''
+    global GRAPH_STORE, INFER_TYPES
+    GRAPH_STORE = graph_store
+    INFER_TYPES = infer_types
+    GraphCache.CACHE_DIR = cache_dir
 
+def sparqlQueryFile(nidm_file, query):
+    '''
+    Runs a SPARQL query against a single NIDM file
 
-    if not return_graph:
-        #convert results list to Pandas DataFrame and return
-        df = pd.DataFrame(results,columns=columns)
+    :param nidm_file: NIDM file
+    :param query: SPARQL query string
+    :return: tuple of (column names, list of result rows)
+    '''
+    qres = OpenDataset(nidm_file).query(query)
+    return [str(var) for var in qres.vars], [list(row) for row in qres]
 
-        #if output file parameter specified
-        if (output_file is not None):
-            df.to_csv(output_file)
-        return df
-    else:
-        return qres_graph
+def sparqlQueryFiles(nidm_files, query, jobs):
+    '''
+    Runs a SPARQL query against each file in a pool of worker processes and combines the rows
+    into one dataframe.  Each worker opens its graph through OpenDataset so the on-disk graph cache
+    is shared between workers.
+
+    :param nidm_files: list of NIDM files
+    :param query: SPARQL query string
+    :param jobs: number of worker processes
+    :return: dataframe
+    '''
+    columns = None
+    results = []
+    with ProcessPoolExecutor(max_workers=min(jobs, len(nidm_files)), initializer=initQueryWorker,
+                             initargs=(GRAPH_STORE, GraphCache.CACHE_DIR, INFER_TYPES)) as executor:
+        # rows come back one file at a time, in file order
+        for file_columns, rows in executor.map(sparqlQueryFile, nidm_files, [query] * len(nidm_files)):
+            if columns is None:
+                columns = file_columns
+            results.extend(rows)
+
+    df = pd.DataFrame(results, columns=columns)
+    # rows repeated in several files are only removed per file by the workers
+    if re.search(r'\bselect\s+distinct\b', query, flags=re.IGNORECASE):
+        df = df.drop_duplicates().reset_index(drop=True)
+    return df
 
 
 def GetProjectsUUID(nidm_file_list,output_file=None):
@@ -225,10 +292,10 @@ def GetDataElementProperties(nidm_file_list):
         select distinct ?uuid ?DataElements ?property ?value
             where {
 
-                ?uuid a/rdfs:subClassOf* nidm:DataElement ;
+                ?uuid %s nidm:DataElement ;
                     ?property ?value .
 
-            }'''
+            }''' % typePath(nidm_file_list.split(','))
 
     df = sparql_query_nidm(nidm_file_list.split(','), query, output_file=None)
     return df
@@ -356,41 +423,45 @@ def GetParticipantDetails(nidm_file_list,project_id, participant_id, output_file
         PREFIX dct: <http://purl.org/dc/terms/>
 
 
-        SELECT DISTINCT ?uuid ?id ?activity
+        SELECT DISTINCT ?id ?activity
         WHERE {
 
             ?activity rdf:type prov:Activity ;
 		        prov:qualifiedAssociation _:blanknode .
 
 	        _:blanknode prov:hadRole %s ;
-                 prov:agent ?uuid  .
+                 prov:agent <%s>  .
 
-	        ?uuid %s ?id .
+	        <%s> %s ?id .
 
             ?proj a nidm:Project .
             ?sess dct:isPartOf ?proj .
             ?activity dct:isPartOf ?sess .
 
-            FILTER(regex(str(?uuid), "%s")).
-
         }
-    ''' %(Constants.NIDM_PARTICIPANT,Constants.NIDM_SUBJECTID, participant_id)
+    '''
 
-    df = sparql_query_nidm(nidm_file_list,query, output_file=output_file)
-    data = df.values
+    # the participant is looked up in the UUID index and bound in the query, a partial UUID that
+    # matches several identifiers raises AmbiguousUUIDError
+    uuid = resolveUUID(nidm_file_list, participant_id)
+    data = []
+    if uuid is not None:
+        df = sparql_query_nidm(nidm_file_list, query % (Constants.NIDM_PARTICIPANT, uuid, uuid, Constants.NIDM_SUBJECTID), output_file=output_file)
+        data = df.values
+        participant_id = uuid
 
-    uuid = ""
     id = ""
     if len(data) > 0:
-        uuid = data[0][0]
-        id = data[0][1]
+        id = data[0][0]
+    else:
+        uuid = ""
 
     result = { 'uuid' : str(uuid).replace(Constants.NIIRI, ""),
                'id' : str(id),
                'activity': [] }
 
     for row in data:
-        act = (str(row[2])).replace(str(Constants.NIIRI), "")
+        act = (str(row[1])).replace(str(Constants.NIIRI), "")
         (result['activity']).append( act )
 
     result["instruments"] = GetParticipantInstrumentData(nidm_file_list, project_id, participant_id)
@@ -423,7 +494,7 @@ def GetNameForDataElement(graph, uri):
 def GetParticipantInstrumentData(nidm_file_list ,project_id, participant_id):
     return GetParticipantInstrumentDataCached(tuple(nidm_file_list) ,project_id, participant_id)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def GetParticipantInstrumentDataCached(nidm_file_list: tuple ,project_id, participant_id):
     '''
     This query will return a list of all instrument data for prov:agent entity UUIDs that has
@@ -436,36 +507,30 @@ def GetParticipantInstrumentDataCached(nidm_file_list: tuple ,project_id, partic
         participant_id = Constants.NIIRI[participant_id]
 
     result = {}
-    names = []
-    for f in nidm_file_list:
-        rdf_graph = OpenGraph(f)
-        for n in rdf_graph.namespace_manager.namespaces():
-            if not n in names:
-                names.append(n)
+    rdf_graph = OpenDataset(nidm_file_list)
+    names = list(rdf_graph.namespace_manager.namespaces())
 
     isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
-    for f in nidm_file_list:
-        rdf_graph = OpenGraph(f)
-        # find all the instrument based assessments
-        for acquisition in rdf_graph.subjects(isa, Constants.NIDM['Acquisition']):
-            # verify that the assessment is linked to a subject through a blank node
-            for blanknode in rdf_graph.objects(subject=acquisition,predicate=Constants.PROV['qualifiedAssociation']):
-                # check to see if this assessment is about our participant
-                if ((blanknode, Constants.PROV['agent'], participant_id) in rdf_graph)  :
-                    # now we know that the assessment is one we want, find the actual assessment data
-                    for instrument in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=acquisition):
-                        #load up all the assement data into the result
-                        instrument_key = str(instrument).split('/')[-1]
-                        result[instrument_key] = {}
-                        for s,data_element,o in rdf_graph.triples((instrument, None, None)):
-                            # convert the random looking URIs to the prefix used in the ttl file, if any
-                            matches = [n[0] for n in names if n[1] == data_element]
-                            if len(matches) > 0:
-                                idx = str(matches[0])
-                            else:
-                                # idx = str(data_element)
-                                idx = GetNameForDataElement(rdf_graph, data_element)
-                            result[instrument_key][ idx ] = str(str(o))
+    # find all the instrument based assessments
+    for acquisition in rdf_graph.subjects(isa, Constants.NIDM['Acquisition']):
+        # verify that the assessment is linked to a subject through a blank node
+        for blanknode in rdf_graph.objects(subject=acquisition,predicate=Constants.PROV['qualifiedAssociation']):
+            # check to see if this assessment is about our participant
+            if ((blanknode, Constants.PROV['agent'], participant_id) in rdf_graph)  :
+                # now we know that the assessment is one we want, find the actual assessment data
+                for instrument in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=acquisition):
+                    #load up all the assement data into the result
+                    instrument_key = str(instrument).split('/')[-1]
+                    result[instrument_key] = {}
+                    for s,data_element,o in rdf_graph.triples((instrument, None, None)):
+                        # convert the random looking URIs to the prefix used in the ttl file, if any
+                        matches = [n[0] for n in names if n[1] == data_element]
+                        if len(matches) > 0:
+                            idx = str(matches[0])
+                        else:
+                            # idx = str(data_element)
+                            idx = GetNameForDataElement(rdf_graph, data_element)
+                        result[instrument_key][ idx ] = str(str(o))
 
 
     return result
@@ -473,12 +538,12 @@ def GetParticipantInstrumentDataCached(nidm_file_list: tuple ,project_id, partic
 def GetParticipantUUIDsForProject(nidm_file_list: tuple, project_id, filter, output_file=None):
     return GetParticipantUUIDsForProjectCached(tuple(nidm_file_list), project_id, filter, output_file=None)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def GetParticipantUUIDsForProjectCached(nidm_file_list:tuple, project_id, filter, output_file=None):
     '''
     This query will return a list of all prov:agent entity UUIDs within a single project
     that prov:hadRole sio:Subject or Constants.NIDM_PARTICIPANT
-    :param filter:
+    :param filter: filter string, pushed down into the SPARQL query (see GetProjectSubjectsMatchingFilter)
     :param nidm_file_list: List of one or more NIDM files to query across for list of Projects
     :return: list of Constants.NIDM_PARTICIPANT UUIDs and Constants.NIDM_SUBJECTID
     '''
@@ -489,44 +554,7 @@ def GetParticipantUUIDsForProjectCached(nidm_file_list:tuple, project_id, filter
     if project_id.find('http') < 0:
         project = Constants.NIIRI[project_id]
 
-    ### added by DBK changed to dictionary to support subject ids along with uuids
-    #participants = []
-    participants = {}
-    participants["uuid"] = []
-    participants["subject id"] = []
-
-
-    for file in nidm_file_list:
-        rdf_graph = OpenGraph(file)
-        #find all the sessions
-        for (session, p, o) in rdf_graph.triples((None, None, Constants.NIDM['Session'])): #rdf_graph.subjects(object=isa, predicate=Constants.NIDM['Session']):
-            #check if it is part of our project
-            if (session, Constants.DCT['isPartOf'], project) in rdf_graph:
-                #find all the activities/acquisitions/etc that are part of this session
-                for activity in rdf_graph.subjects(predicate=Constants.DCT['isPartOf'], object=session):
-                    # look to see if the activity is linked to a subject via blank node
-                    for blank in rdf_graph.objects(subject=activity, predicate=Constants.PROV['qualifiedAssociation']):
-                        if (blank, Constants.PROV['hadRole'], Constants.SIO['Subject']):
-                            for participant in rdf_graph.objects(subject=blank, predicate=Constants.PROV['agent']):
-                                uuid = (str(participant)).split('/')[-1]  # srip off the http://whatever/whatever/
-                                if (not uuid in participants) and \
-                                        ( (not filter) or CheckSubjectMatchesFilter( tuple([file]) , project, participant, filter) ):
-                                    ### added by DBK for subject IDs as well ###
-                                    for id in rdf_graph.objects(subject=participant,predicate=URIRef(Constants.NIDM_SUBJECTID.uri)):
-                                        subid = (str(id)).split('/')[-1]  # srip off the http://whatever/whatever/
-
-                                    ### added by DBK for subject IDs as well ###
-                                    #participants.append(uuid)
-                                    try:
-                                        participants['uuid'].append(uuid)
-                                        participants['subject id'].append(subid)
-                                    # just in case there's no subject id in the file...
-                                    except:
-                                        #participants.append(uuid)
-                                        participants['uuid'].append(uuid)
-                                        participants['subject id'].append('')
-
-    return participants
+    return GetProjectSubjectsMatchingFilter(nidm_file_list, project, filter)
 
 
 # if this isn't already a URI, make it one.
@@ -543,42 +571,150 @@ def expandUUID(partial_uuid):
     return uuid
 
 
+def GetUUIDIndex(nidm_file_list):
+    return GetUUIDIndexCached(tuple(nidm_file_list))
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetUUIDIndexCached(nidm_file_list: tuple):
+    '''
+    Returns the sorted UUIDs (the bit after the NIIRI prefix) of every NIIRI identifier in the
+    files, which resolveUUID searches.  The index is saved in the graph cache, like the
+    navigation index, keyed on the fingerprints of the files.
+
+    :param nidm_file_list: tuple of NIDM files or a NIDMDataset
+    :return: tuple of UUIDs
+    '''
+    files = tuple(nidm_file_list)
+    if not all(isinstance(f, str) for f in files):
+        # graphs that didn't come from files can't be cached on disk
+        return buildUUIDIndex(OpenDataset(nidm_file_list))
+
+    return GraphCache.cachedObject('uuid_index', GraphCache.cacheKey(*files), lambda: buildUUIDIndex(OpenDataset(nidm_file_list)))
+
+def buildUUIDIndex(rdf_graph):
+    '''
+    :param rdf_graph: Graph
+    :return: sorted tuple of the UUIDs of the NIIRI identifiers that are the subject of a triple
+    '''
+    niiri = str(Constants.NIIRI)
+    return tuple(sorted(set(str(s)[len(niiri):] for s in rdf_graph.subjects() if isinstance(s, URIRef) and s.startswith(niiri))))
+
+def resolveUUID(nidm_file_list, partial_uuid):
+    '''
+    Finds the identifier a full or partial UUID refers to with a binary search of the files'
+    UUID index
+
+    :param nidm_file_list: List of one or more NIDM files or a NIDMDataset
+    :param partial_uuid: full URI, UUID (the bit after the NIIRI prefix) or the start of one
+    :return: full URI, or None if no identifier matches
+    :raises AmbiguousUUIDError: if a partial UUID is the start of several identifiers
+    '''
+    partial_uuid = str(partial_uuid)
+    if partial_uuid.find('http') >= 0:
+        if not partial_uuid.startswith(str(Constants.NIIRI)):
+            # not a NIIRI identifier, there's nothing to expand
+            return URIRef(partial_uuid)
+        partial_uuid = partial_uuid[len(Constants.NIIRI):]
+
+    index = GetUUIDIndex(nidm_file_list)
+    position = bisect.bisect_left(index, partial_uuid)
+    if position < len(index) and index[position] == partial_uuid:
+        return Constants.NIIRI[partial_uuid]
+
+    matches = []
+    while position < len(index) and index[position].startswith(partial_uuid) and len(matches) < 2:
+        matches.append(index[position])
+        position += 1
+    if len(matches) > 1:
+        raise AmbiguousUUIDError("{} is the start of more than one UUID".format(partial_uuid))
+    return Constants.NIIRI[matches[0]] if matches else None
+
+
 def getProjectAcquisitionObjects(nidm_file_list, project_id):
     acq_objects = []
     isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
     project_uuid = expandUUID(project_id)
 
-    for file in nidm_file_list:
-        rdf_graph = OpenGraph(file)
-        #find all the projects
-        for (project,pred,o) in rdf_graph.triples((None, None, Constants.NIDM['Project'])):
-            #check if it is our project
-            if str(project) == project_uuid:
-                for (session,p2,o2) in rdf_graph.triples((None,isa, Constants.NIDM['Session'])):
-                    for (acquisition,p3,o3) in rdf_graph.triples((None, Constants.DCT['isPartOf'], session)):
-                        for (acq_obj, p4, o4) in rdf_graph.triples((None, Constants.PROV['wasGeneratedBy'], acquisition)):
-                            if (acq_obj, isa, Constants.NIDM['AcquisitionObject']):
-                                acq_objects.append(acq_obj)
+    rdf_graph = OpenDataset(nidm_file_list)
+    #find all the projects
+    for (project,pred,o) in rdf_graph.triples((None, None, Constants.NIDM['Project'])):
+        #check if it is our project
+        if str(project) == project_uuid:
+            for (session,p2,o2) in rdf_graph.triples((None,isa, Constants.NIDM['Session'])):
+                for (acquisition,p3,o3) in rdf_graph.triples((None, Constants.DCT['isPartOf'], session)):
+                    for (acq_obj, p4, o4) in rdf_graph.triples((None, Constants.PROV['wasGeneratedBy'], acquisition)):
+                        if (acq_obj, isa, Constants.NIDM['AcquisitionObject']):
+                            acq_objects.append(acq_obj)
     return acq_objects
 
-@functools.lru_cache(maxsize=LARGEST_CACHE_SIZE)
 def GetDatatypeSynonyms(nidm_file_list, project_id, datatype):
     '''
     Try to match a datatype string with any of the known info about a data element
     Returns all the possible synonyms for that datatype
     For example, if AGE_AT_SCAN is a data element prefix, return the label, datumType, measureOf URI, prefix, etc.
 
+    The datatype is looked up in the project's SynonymIndex, exactly first and then ignoring case,
+    whitespace and underscores.  With FUZZY_FIELD_SCORE set the closest term scoring at least that much is
+    used if nothing else matches.
+
     :param nidm_file_list:
     :param project_id:
     :param datatype:
     :return:
     '''
-    project_data_elements = GetProjectDataElements(nidm_file_list, project_id)
-    for dti in project_data_elements['data_type_info']:
-        if str(datatype) in [ str(x) for x in [dti['label'], dti['datumType'], dti['measureOf'], URITail(dti['measureOf']), dti['isAbout'], URITail(dti['isAbout']), dti['dataElement'], dti['dataElementURI'], dti['prefix']] ]:
-            return [str(dti['label']), str(dti['datumType']), str(dti['measureOf']), URITail(dti['measureOf']), str(dti['isAbout']), str(dti['dataElement']), str(dti['dataElementURI']), str(dti['prefix'])]
+    index = GetSynonymIndex(nidm_file_list, project_id)
+    elements = index.terms.get(str(datatype)) or index.normalized_terms.get(normalizeTerm(datatype))
+    if not elements and FUZZY_FIELD_SCORE > 0 and index.normalized_terms:
+        match = process.extractOne(normalizeTerm(datatype), list(index.normalized_terms), scorer=fuzz.ratio, score_cutoff=FUZZY_FIELD_SCORE)
+        if match is not None:
+            elements = index.normalized_terms[match[0]]
+    if elements:
+        # the first data element of the project that matches, as the synonyms have always been found
+        return list(index.synonyms[elements[0]])
     return [datatype]
 
+def normalizeTerm(term):
+    '''
+    :return: the term in lower case without whitespace, underscores or hyphens, for matching field names
+    '''
+    return ''.join(str(term).replace('_', ' ').replace('-', ' ').split()).lower()
+
+def GetSynonymIndex(nidm_file_list, project_id):
+    return GetSynonymIndexCached(tuple(nidm_file_list), project_id)
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetSynonymIndexCached(nidm_file_list: tuple, project_id):
+    '''
+    Builds the index GetDatatypeSynonyms looks field names up in, from the data elements of a project
+
+    :param nidm_file_list: List of one or more NIDM files or a NIDMDataset
+    :param project_id: project UUID (full URI or just the bit after the NIIRI prefix)
+    :return: SynonymIndex of
+        terms: dictionary of label, source variable, datumType, measureOf, isAbout, data element
+            URI or tail and prefix -> data element URIs described by it, in project order
+        normalized_terms: the same with the terms passed through normalizeTerm
+        synonyms: dictionary of data element URI -> its synonyms, as GetDatatypeSynonyms returns them
+    '''
+    terms = collections.OrderedDict()
+    normalized_terms = collections.OrderedDict()
+    synonyms = collections.OrderedDict()
+    for dti in GetProjectDataElements(nidm_file_list, project_id)['data_type_info']:
+        if not dti:
+            continue
+        element = dti['dataElementURI']
+        if element not in synonyms:
+            synonyms[element] = (str(dti['label']), str(dti['datumType']), str(dti['measureOf']), URITail(dti['measureOf']), str(dti['isAbout']),
+                                 str(dti['dataElement']), str(element), str(dti['prefix']))
+        for term in [dti['label'], dti.get('sourceVariable', ''), dti['datumType'], dti['measureOf'], URITail(dti['measureOf']), dti['isAbout'],
+                     URITail(dti['isAbout']), dti['dataElement'], element, dti['prefix']]:
+            term = str(term)
+            if term:
+                for index, key in ((terms, term), (normalized_terms, normalizeTerm(term))):
+                    if element not in index.setdefault(key, []):
+                        index[key].append(element)
+
+    return SynonymIndex(terms=terms, normalized_terms=normalized_terms, synonyms=synonyms)
+
 def GetProjectDataElements(nidm_file_list, project_id):
     ### added by DBK...changing to dictionary to support labels along with uuids
     #result = []
@@ -594,8 +730,8 @@ def GetProjectDataElements(nidm_file_list, project_id):
     if project_id.find('http') < 0:
         project = Constants.NIIRI[project_id]
 
-    for file in nidm_file_list:
-        rdf_graph = OpenGraph(file)
+    # data elements are looked up in the file that holds the project, so go file by file here
+    for rdf_graph in GetDataset(nidm_file_list).graphs:
         #find all the sessions
         for (session, cde_tuple, o) in rdf_graph.triples((None, None, Constants.NIDM['Session'])): #rdf_graph.subjects(object=isa, predicate=Constants.NIDM['Session']):
             #check if it is part of our project
@@ -669,6 +805,9 @@ def CheckSubjectMatchesFilter(nidm_file_list, project_uuid, subject_uuid, filter
     filter should look something like:
        instruments.AGE gt 12 and instruments.SITE_ID eq CMU
 
+    See nidm.experiment.Filter for the full filter language.  To test many subjects use
+    GetSubjectsMatchingFilter, which evaluates the filter for all of them in one pass.
+
     :param nidm_file_list:
     :param project_uuid:
     :param subject_uuid:
@@ -676,75 +815,226 @@ def CheckSubjectMatchesFilter(nidm_file_list, project_uuid, subject_uuid, filter
     :return:
     '''
 
-    # TODO: I need to fix this here.  When there is a space inside the value the splitter gets more than 3 values
-    # ex: 'projects.subjects.instruments.WISC_IV_VOCAB_SCALED eq \'not a match\''
-
     if filter == None:
         return True
 
-    # filter can have multiple and clauses, break them up and test each one
-    tests = filter.split('and')
-
-
-
-    for test in tests:
-        found_match = False
-        split_array = test.split(' ')
-        compound_sub = split_array[0]
-        op = split_array[1]
-        value = ' '.join(split_array[2:])
-
-        #if the value is a string, it will have quotes around it.  Strip them out now
-        for quote in ["'", "\"", "`"]:
-            if value[0] == quote and value[-1] == quote:
-                value = value[1:-1]
+    return len(GetSubjectsMatchingFilter(nidm_file_list, project_uuid, [subject_uuid], filter)) > 0
 
+def GetSubjectsMatchingFilter(nidm_file_list, project_uuid, subjects, filter):
+    '''
+    Returns the subjects that match a filter.  The filter is compiled once and evaluated with
+    vectorized comparisons against the table from GetSubjectDataTable.
+
+    :param nidm_file_list: List of one or more NIDM files or a NIDMDataset
+    :param project_uuid: project the subjects belong to, used to find data element synonyms
+    :param subjects: list of subject UUIDs (full URIs or just the bit after the NIIRI prefix)
+    :param filter: filter string, e.g. instruments.AGE gt 12 and derivatives.fsl_000032 lt 3
+    :return: list of the matching subjects, in the order given
+    '''
+    subjects = list(subjects)
+    if not filter:
+        return subjects
 
-        sub_pieces = splitSubject(compound_sub)
-        if len(sub_pieces) == 2 and sub_pieces[0] == 'instruments':
-            term = sub_pieces[1] # 'AGE_AT_SCAN' for example
-            synonyms = GetDatatypeSynonyms(tuple(nidm_file_list), project_uuid, term)
-            instrument_details = GetParticipantInstrumentData(nidm_file_list, project_uuid, subject_uuid)
-            for instrument_uuid in instrument_details:
-                for instrument_term in instrument_details[instrument_uuid]:
-                    if instrument_term in synonyms:
-                        found_match = filterCompare(instrument_details[instrument_uuid][instrument_term], op, value)
-                    if found_match:
-                        break
-
-        elif len(sub_pieces) == 2 and sub_pieces[0] == 'derivatives':
-            type = sub_pieces[1] # 'ilx:0102597' for example
-            derivatives_details = GetDerivativesDataForSubject(nidm_file_list, project_uuid, subject_uuid)
-            for key in derivatives_details:
-                derivatives = derivatives_details[key]['values']
-                for vkey in derivatives:  # values will be in the form { http://example.com/a/b/c#fs_00001 : { datumType: '', label: '', value: '', units:'' }, ... }
-                    short_key = URITail(vkey)
-                    if short_key == type:
-                        found_match = filterCompare(derivatives[vkey]['value'], op, value)
-                    if found_match:
-                        break
-
+    node = Filter.compileFilter(filter)
+    table = GetSubjectDataTable(nidm_file_list)
+    mask = Filter.evaluateFilter(node, table, [expandUUID(str(s)) for s in subjects], filterSynonyms(nidm_file_list, project_uuid))
+    return [s for s, matched in zip(subjects, mask) if matched]
 
+def filterSynonyms(nidm_file_list, project_uuid):
+    '''
+    Returns a function giving the keys a filter term may appear under, for Filter.evaluateFilter
+    '''
+    def synonyms(category, term):
+        if category == 'instruments':
+            return GetDatatypeSynonyms(tuple(nidm_file_list), str(project_uuid), term)
+        return [term, URITail(term)]
+    return synonyms
 
+def GetProjectSubjectsMatchingFilter(nidm_file_list, project_id, filter, acquisitions_only=False):
+    '''
+    Finds the subjects of a project that match a filter with a single SPARQL query over the dataset.
+    The filter is translated into a FILTER clause by Filter.filterToSparql, after its terms have been
+    resolved to the data element URIs they may appear under.
+
+    :param nidm_file_list: List of one or more NIDM files or a NIDMDataset
+    :param project_id: project UUID (full URI or just the bit after the NIIRI prefix)
+    :param filter: filter string, e.g. instruments.AGE gt 12 and derivatives.fsl_000032 lt 3, or None
+    :param acquisitions_only: only return agents with the sio:Subject role in an acquisition of the
+        project, as Navigate.getSubjects does, rather than every agent of an activity of the project
+    :return: dictionary with 'uuid' and 'subject id' lists
+    '''
+    project = expandUUID(str(project_id))
+
+    activity = ''
+    if acquisitions_only:
+        # matched through variables, so rdflib doesn't start the join from every acquisition
+        activity = '''?activity a ?activity_type .
+                ?blank prov:hadRole ?role .
+                FILTER (?activity_type = nidm:Acquisition && ?role = sio:Subject)'''
+    condition = ''
+    if filter:
+        elements = GetFilterElements(nidm_file_list)
+        synonyms = filterSynonyms(nidm_file_list, project)
+
+        def elementsFor(test):
+            keys = set(synonyms(test.category, test.term))
+            return sorted(uri for uri, names in elements[test.category].items() if names & keys)
+
+        condition = Filter.filterToSparql(Filter.compileFilter(filter), elementsFor)
+        if condition is None:
+            return {'uuid': [], 'subject id': []}
+
+    query = Filter.SPARQL_PREFIXES + '''
+    SELECT ?subject ?subject_id
+    WHERE {{
+        {{
+            SELECT DISTINCT ?subject
+            WHERE {{
+                ?session a nidm:Session ;
+                    dct:isPartOf <{project}> .
+                ?activity dct:isPartOf ?session ;
+                    prov:qualifiedAssociation ?blank .
+                ?blank prov:agent ?subject .
+                {activity}
+            }}
+        }}
+        {condition}
+        OPTIONAL {{ ?subject ndar:src_subject_id ?subject_id . }}
+    }}
+    '''.format(project=project, activity=activity, condition=condition)
+
+    subjects = collections.OrderedDict()
+    for row in timedQuery(OpenDataset(nidm_file_list), query):
+        uuid = str(row['subject']).split('/')[-1]  # srip off the http://whatever/whatever/
+        if not subjects.get(uuid):
+            subjects[uuid] = str(row['subject_id']).split('/')[-1] if row['subject_id'] is not None else ''
+
+    return {'uuid': list(subjects.keys()), 'subject id': list(subjects.values())}
+
+def GetFilterElements(nidm_file_list):
+    return GetFilterElementsCached(tuple(nidm_file_list))
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetFilterElementsCached(nidm_file_list: tuple):
+    '''
+    Finds the data elements that hold instrument and derivative values in the files, with the keys a
+    filter may refer to each of them by.  These are the same keys GetSubjectDataTable gives the values.
 
-        # check after each test if we got false because the tests are joined with 'and'
-        if not found_match:
-            return False
+    :param nidm_file_list: List of one or more NIDM files to query across
+    :return: {'instruments': {uri: set of keys}, 'derivatives': {uri: set of keys}}
+    '''
+    rdf_graph = OpenDataset(nidm_file_list)
+    names = list(rdf_graph.namespace_manager.namespaces())
+    elements = {'instruments': {}, 'derivatives': {}}
+
+    for category in elements:
+        query = Filter.SPARQL_PREFIXES + 'SELECT DISTINCT ?element0 WHERE {{ {} }}'.format(
+            Filter.SPARQL_PATTERNS[category].format(n=0, subject='?subject'))
+        for row in timedQuery(rdf_graph, query):
+            data_element = row[0]
+            if category == 'instruments':
+                matches = [n[0] for n in names if n[1] == data_element]
+                elements[category][str(data_element)] = {str(matches[0]) if len(matches) > 0 else GetNameForDataElement(rdf_graph, data_element)}
+            else:
+                dti = getDataTypeInfo(rdf_graph, data_element)
+                if dti:
+                    elements[category][str(data_element)] = {URITail(data_element), str(dti['label'])}
 
-    return True
+    return elements
 
-def filterCompare(left, op, right):
-    try:
-        if op == 'eq':
-            return (left == right)
-        elif op == 'lt':
-            return (float(left) < float(right))
-        elif op == 'gt':
-            return (float(left) > float(right))
-    except:
-        pass
+def GetSubjectDataTable(nidm_file_list):
+    return GetSubjectDataTableCached(tuple(nidm_file_list))
 
-    return None
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetSubjectDataTableCached(nidm_file_list: tuple):
+    '''
+    Builds a long table of every instrument and derivative value in the files, with one row per
+    (subject, category, key, label, value), along with the entity holding the value and the URI of
+    its data element.  Instrument keys are named like the keys of
+    GetParticipantInstrumentData and derivative keys are the tail of the data element URI, as in
+    GetDerivativesDataForSubject.  The whole graph is walked once for all the subjects.
+
+    :param nidm_file_list: List of one or more NIDM files to query across
+    :return: dataframe with the Filter.TABLE_COLUMNS, 'entity', 'element' and a numeric 'number' column
+    '''
+    isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+    rdf_graph = OpenDataset(nidm_file_list)
+    names = list(rdf_graph.namespace_manager.namespaces())
+    rows = []
+
+    # instrument data, found the same way as in GetParticipantInstrumentData
+    element_names = {}
+    for acquisition in rdf_graph.subjects(isa, Constants.NIDM['Acquisition']):
+        participants = [participant for blanknode in rdf_graph.objects(acquisition, Constants.PROV['qualifiedAssociation'])
+                        for participant in rdf_graph.objects(blanknode, Constants.PROV['agent'])]
+        if not participants:
+            continue
+        for instrument in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=acquisition):
+            for s, data_element, o in rdf_graph.triples((instrument, None, None)):
+                if data_element not in element_names:
+                    matches = [n[0] for n in names if n[1] == data_element]
+                    element_names[data_element] = str(matches[0]) if len(matches) > 0 else GetNameForDataElement(rdf_graph, data_element)
+                key = element_names[data_element]
+                for participant in participants:
+                    rows.append((str(participant), 'instruments', key, key, str(o), str(instrument), str(data_element)))
+
+    # derivatives, found the same way as in getDerivativesNodesForSubject
+    sw_agents = getSoftwareAgents(rdf_graph)
+    for blank in rdf_graph.subjects(Constants.PROV['hadRole'], Constants.SIO['Subject']):
+        participants = list(rdf_graph.objects(blank, Constants.PROV['agent']))
+        for activity in rdf_graph.subjects(predicate=Constants.PROV['qualifiedAssociation'], object=blank):
+            software = [software_agent for software_blank in rdf_graph.objects(activity, Constants.PROV['qualifiedAssociation'])
+                        for software_agent in rdf_graph.objects(software_blank, Constants.PROV['agent'])
+                        if activityIsSWAgent(rdf_graph, software_agent, sw_agents)]
+            if not software:
+                continue
+            for stats_collection in rdf_graph.subjects(predicate=Constants.PROV['wasGeneratedBy'], object=activity):
+                collection = getStatsCollectionForNode(rdf_graph, stats_collection)
+                for uri, measure in collection['values'].items():
+                    for participant in participants:
+                        rows.append((str(participant), 'derivatives', URITail(uri), measure['label'], measure['value'], str(stats_collection), uri))
+
+    table = pd.DataFrame(rows, columns=Filter.TABLE_COLUMNS + ['entity', 'element'])
+    table['number'] = pd.to_numeric(table['value'], errors='coerce')
+    return table
+
+def GetProjectDataTable(nidm_file_list, project_id):
+    return GetProjectDataTableCached(tuple(nidm_file_list), str(project_id))
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetProjectDataTableCached(nidm_file_list: tuple, project_id):
+    '''
+    Builds the wide table of a project's data, with a row for each subject and a column for each
+    instrument and derivative data element.  A subject with several instruments or stats collections
+    gets a row for each of them, so no values are lost.  The table is pivoted from GetSubjectDataTable
+    and is what the REST statistics and field queries read.
+
+    :param nidm_file_list: List of one or more NIDM files to query across
+    :param project_id: project UUID (full URI or just the bit after the NIIRI prefix)
+    :return: ProjectDataTable of
+        values: dataframe of value strings indexed by subject UUID (without the NIIRI prefix), with a column per data element URI
+        numbers: the same table of values as floats, NaN where there is no value or it isn't a number
+        elements: dataframe indexed by data element URI with the category, key, label, data_element and data_type_info of each column
+    '''
+    subjects = GetParticipantUUIDsForProject(nidm_file_list, expandUUID(project_id), None)['uuid']
+    table = GetSubjectDataTable(nidm_file_list)
+    table = table.assign(uuid=table['subject'].str.split('/').str[-1])
+    # an entity holding the same data element twice keeps the last value, as GetParticipantInstrumentData does
+    table = table[table['uuid'].isin(subjects)].drop_duplicates(['uuid', 'entity', 'element'], keep='last')
+
+    values = table.pivot(index=['uuid', 'entity'], columns='element', values='value')
+    numbers = table.pivot(index=['uuid', 'entity'], columns='element', values='number').astype(float)
+    for wide in (values, numbers):
+        wide.index = wide.index.get_level_values('uuid')
+        wide.columns.name = None
+
+    rdf_graph = OpenDataset(nidm_file_list)
+    elements = table.drop_duplicates('element').set_index('element')[['category', 'key', 'label']]
+    elements = elements.reindex(values.columns)
+    elements['data_type_info'] = [getDataTypeInfo(rdf_graph, URIRef(element)) for element in elements.index]
+    elements['data_element'] = [dti['dataElement'] if dti else None for dti in elements['data_type_info']]
+
+    return ProjectDataTable(values=values, numbers=numbers, elements=elements)
 
 def GetProjectsMetadata(nidm_file_list):
     '''
@@ -878,7 +1168,7 @@ def GetBrainVolumes(nidm_file_list):
 				?tool_entity prov:wasGeneratedBy ?tool_act ;
 					?measure ?volume .
 
-					?measure a/rdfs:subClassOf* nidm:DataElement ;
+					?measure %s nidm:DataElement ;
 						 rdfs:label ?softwareLabel;
 						 nidm:measureOf <http://uri.interlex.org/base/ilx_0112559> ;
 						 nidm:datumType <http://uri.interlex.org/base/ilx_0738276> .
@@ -886,7 +1176,7 @@ def GetBrainVolumes(nidm_file_list):
 					OPTIONAL {?measure nidm:hasLaterality ?laterality }.
 
             }
-            '''
+            ''' % typePath(nidm_file_list.split(','))
 
     df = sparql_query_nidm(nidm_file_list.split(','), query, output_file=None)
     return df
@@ -895,11 +1185,54 @@ def GetBrainVolumes(nidm_file_list):
 
 def ExtractProjectSummary(meta_data, nidm_file_list):
     '''
+    Adds the number of subjects, age range, genders and handednesses of each project to its
+    meta data.  The summaries are computed one file at a time (see GetProjectSummaries), so
+    only the files that changed since the last call are queried again.
 
     :param meta_data: a dictionary of projects containing their meta data as pulled from the nidm_file_list
     :param nidm_file_list: List of NIDM files
     :return:
     '''
+    projects = meta_data['projects']
+
+    key = str(Constants.NIDM_NUMBER_OF_SUBJECTS)
+    for project_id, project in projects.items():
+        project[key] = 0
+        project['age_max'] = 0
+        project['age_min'] = sys.maxsize
+        project[str(Constants.NIDM_GENDER)] = []
+        project[str(Constants.NIDM_HANDEDNESS)] = []
+
+    files = nidm_file_list.files if isinstance(nidm_file_list, NIDMDataset) else nidm_file_list
+    for file in files:
+        for project_id, summary in GetProjectSummaries(file).items():
+            project = projects.get(matchPrefix(project_id))
+            if project is None:
+                continue
+            project[key] += summary.subjects
+            if summary.age_min is not None:
+                project['age_min'] = min(summary.age_min, project['age_min'])
+                project['age_max'] = max(summary.age_max, project['age_max'])
+            for field, values in ((str(Constants.NIDM_GENDER), summary.genders), (str(Constants.NIDM_HANDEDNESS), summary.handedness)):
+                project[field].extend(value for value in values if value not in project[field])
+
+@MemoryCache.memoize(maxsize=BIG_CACHE_SIZE)
+def GetProjectSummaries(nidm_file):
+    '''
+    Summarizes the subjects of every project in a NIDM file.  The summaries are saved in the
+    graph cache next to the file, keyed on its fingerprint, so they are only computed again
+    once the file changes.  Each file is queried on its own, so the assessments of a project
+    have to be in the same file as its sessions, as pynidm writes them.
+
+    :param nidm_file: NIDM file name
+    :return: dictionary of project URI -> ProjectSummary
+    '''
+    return GraphCache.cachedObject('project_summary', GraphCache.cacheKey(nidm_file), lambda: buildProjectSummaries(nidm_file))
+
+def buildProjectSummaries(nidm_file):
+    '''
+    :return: dictionary of project URI -> ProjectSummary of the projects in a NIDM file
+    '''
     query = '''
     prefix ncicb: <http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl#>
     prefix ndar: <https://ndar.nih.gov/api/datadictionary/v2/dataelement/>
@@ -932,33 +1265,27 @@ def ExtractProjectSummary(meta_data, nidm_file_list):
     ORDER BY ?id
       '''
 
-    df = sparql_query_nidm(nidm_file_list, query, output_file=None)
-    projects = meta_data['projects']
-
-    arr = df.values
-    key = str(Constants.NIDM_NUMBER_OF_SUBJECTS)
-    for project_id, project in projects.items():
-        project[key] = 0
-        project['age_max'] = 0
-        project['age_min'] = sys.maxsize
-        project[str(Constants.NIDM_GENDER)] = []
-        project[str(Constants.NIDM_HANDEDNESS)] = []
-
-    for row in arr:
-        project_id = matchPrefix( str(row[8]) ) # 9th column is the project UUID
-        projects[project_id][str(Constants.NIDM_NUMBER_OF_SUBJECTS)] += 1
-
-        age = float(row[2])
-        projects[project_id]['age_min'] = min(age, projects[project_id]['age_min'])
-        projects[project_id]['age_max'] = max(age, projects[project_id]['age_max'])
-
-        gender = str(row[3])
-        if gender not in projects[project_id][str(Constants.NIDM_GENDER)]:
-            projects[project_id][str(Constants.NIDM_GENDER)].append(gender)
-
-        hand = str(row[4])
-        if hand not in projects[project_id][str(Constants.NIDM_HANDEDNESS)]:
-            projects[project_id][str(Constants.NIDM_HANDEDNESS)].append(hand)
+    df = sparql_query_nidm([nidm_file], query, output_file=None)
+
+    summaries = collections.OrderedDict()
+    if df.empty:
+        return summaries
+    df = pd.DataFrame({'project': df['project'].map(str),
+                       'age': pd.to_numeric(df['age'].map(str), errors='coerce'),
+                       'gender': df['gender'].map(str),
+                       'hand': df['hand'].map(str)})
+    grouped = df.groupby('project', sort=False)
+    counts = grouped.size()
+    ages = grouped['age'].agg(['min', 'max'])
+    genders = grouped['gender'].unique()
+    hands = grouped['hand'].unique()
+    for project in counts.index:
+        age_min, age_max = ages.at[project, 'min'], ages.at[project, 'max']
+        summaries[project] = ProjectSummary(subjects=int(counts[project]),
+                                            age_min=None if pd.isna(age_min) else float(age_min),
+                                            age_max=None if pd.isna(age_max) else float(age_max),
+                                            genders=tuple(genders[project]), handedness=tuple(hands[project]))
+    return summaries
 
 
 def expandNIDMAbbreviation(shortKey) -> str:
@@ -1030,7 +1357,7 @@ def activityIsSWAgent(rdf_graph, activity, sw_agents):
 
     return False
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def getDerivativesNodesForSubject (rdf_graph, subject):
     '''
     Finds all the URIs that were generated by software agents and linked to the subject
@@ -1061,68 +1388,121 @@ def getDerivativesNodesForSubject (rdf_graph, subject):
 
     return derivatives_uris
 
-@functools.lru_cache(maxsize=LARGEST_CACHE_SIZE)
 def getDataTypeInfo(source_graph, datatype):
     '''
-    Scans all the triples with subject of datatype (isa DataElement in the graph) and looks for entries
-    with specific predicates necessary to define it's type
+    Looks up the description of a data element: in the DataElement catalog of the graph if it is
+    a DataElement there, otherwise in the catalog of the CDE graph (see getDataElementCatalog)
 
     :param rdf_graph:
     :param dt: URI of the DataElement
-    :return: { 'label': label, 'hasUnit': hasUnit, 'typeURI': typeURI}
+    :return: { 'label': label, 'hasUnit': hasUnit, 'datumType': typeURI, ...} or False if it isn't found
     '''
-    isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
-
-
     expanded_datatype = datatype
     if expanded_datatype.find('http') < 0:
         expanded_datatype = Constants.NIIRI[expanded_datatype]
 
-
     # check to see if the datatype is in the main graph. If not, look in the CDE graph
-    if source_graph and  (expanded_datatype, isa, Constants.NIDM['DataElement']) in source_graph:
-        rdf_graph = source_graph
-    else:
-        rdf_graph = getCDEs()
+    info = None
+    if source_graph is not None:
+        info = getDataElementCatalog(source_graph).get(str(expanded_datatype))
+    if info is None:
+        info = getCDECatalog().get(str(expanded_datatype))
 
-    typeURI = ''
-    hasUnit = ''
-    label = ''
-    description = ''
-    measureOf = ''
-    isAbout = ''
-    structure = ''
-    prefix = ''
-
-    found = False
+    # callers add their own keys to the info
+    return dict(info) if info else False
 
+def describeDataElement(rdf_graph, data_element, namespaces):
+    '''
+    Reads the description of a data element from its triples
 
+    :param namespaces: list of (prefix, namespace) of the graph
+    :return: data type info, see getDataTypeInfo, or None if the graph has no triples about it
+    '''
+    info = None
     # have to scan all tripples because the label can be in any namespace
-    for s, p, o in rdf_graph.triples((expanded_datatype, None, None)):
-        found = True
-        if (re.search(r'label$', str(p)) != None):
-            label = o
-        if (re.search(r'description$', str(p)) != None):
-            description = o
-        if (re.search(r'hasUnit$', str(p), flags=re.IGNORECASE) != None):
-            hasUnit = o
-        if (re.search(r'datumType$', str(p)) != None):
-            typeURI = str(o).split('/')[-1]
-        if (re.search(r'measureOf$', str(p)) != None):
-            measureOf = o
-        if (re.search(r'isAbout$', str(p), flags=re.IGNORECASE) != None):
-            isAbout = o
-
-    possible_prefix = [x for x in rdf_graph.namespaces() if expanded_datatype.startswith(x[1])]
-    if (len(possible_prefix) > 0):
-        prefix = possible_prefix[0][0]
-
-
-    if not found:
-        return False
-    else:
-        return {'label': label, 'hasUnit': hasUnit, 'datumType': typeURI, 'measureOf': measureOf, 'isAbout': isAbout,
-                'dataElement': str(URITail(s)), 'dataElementURI': str(s), 'description': description, 'prefix': prefix }
+    for s, p, o in rdf_graph.triples((data_element, None, None)):
+        if info is None:
+            info = {'label': '', 'hasUnit': '', 'datumType': '', 'measureOf': '', 'isAbout': '', 'hasLaterality': '',
+                    'sourceVariable': '', 'dataElement': str(URITail(s)), 'dataElementURI': str(s), 'description': '', 'prefix': ''}
+        predicate = str(p)
+        lower_predicate = predicate.lower()
+        if predicate.endswith('label'):
+            info['label'] = o
+        if predicate.endswith('description'):
+            info['description'] = o
+        if lower_predicate.endswith('hasunit'):
+            info['hasUnit'] = o
+        if predicate.endswith('datumType'):
+            info['datumType'] = str(o).split('/')[-1]
+        if predicate.endswith('measureOf'):
+            info['measureOf'] = o
+        if lower_predicate.endswith('isabout'):
+            info['isAbout'] = o
+        if lower_predicate.endswith('haslaterality'):
+            info['hasLaterality'] = o
+        if predicate.endswith('source_variable'):
+            info['sourceVariable'] = o
+
+    if info is not None:
+        possible_prefix = [x for x in namespaces if data_element.startswith(x[1])]
+        if (len(possible_prefix) > 0):
+            info['prefix'] = possible_prefix[0][0]
+    return info
+
+def buildDataElementCatalog(rdf_graph, data_elements):
+    '''
+    :param data_elements: URIs of the data elements to describe
+    :return: dictionary of data element URI (as a str) -> data type info
+    '''
+    namespaces = list(rdf_graph.namespaces())
+    catalog = {}
+    for data_element in data_elements:
+        info = describeDataElement(rdf_graph, data_element, namespaces)
+        if info is not None:
+            catalog[str(data_element)] = info
+    return catalog
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def getDataElementCatalog(rdf_graph):
+    '''
+    Returns the description of every nidm:DataElement of a graph, built once per dataset instead
+    of scanning the triples of an element each time it is looked up.  Catalogs of graphs opened
+    from files are saved in the graph cache, keyed on the fingerprints of the files.
+
+    :param rdf_graph: Graph, e.g. from OpenGraph or OpenDataset
+    :return: dictionary of data element URI (as a str) -> data type info
+    '''
+    isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+
+    def build():
+        return buildDataElementCatalog(rdf_graph, set(rdf_graph.subjects(isa, Constants.NIDM['DataElement'])))
+
+    files = getattr(rdf_graph, 'nidm_files', None)
+    if not files or not all(isinstance(f, str) for f in files):
+        # graphs that didn't come from files can't be cached on disk
+        return build()
+    return GraphCache.cachedObject('de_catalog', GraphCache.cacheKey(*files), build)
+
+def getCDECatalog():
+    '''
+    Returns the description of every term of the CDE graph (see getCDEs), saved in the graph
+    cache next to the CDE graph
+
+    :return: dictionary of URI (as a str) -> data type info
+    '''
+    rdf_graph = getCDEs()
+    if getCDECatalog.cache is None or getCDECatalog.cache[0] is not rdf_graph:
+        def build():
+            return buildDataElementCatalog(rdf_graph, set(rdf_graph.subjects()))
+
+        if getCDEs.key is None:
+            catalog = build()
+        else:
+            catalog = GraphCache.cachedObject('de_catalog', getCDEs.key, build)
+        getCDECatalog.cache = (rdf_graph, catalog)
+    return getCDECatalog.cache[1]
+
+getCDECatalog.cache = None
 
 def getStatsCollectionForNode (rdf_graph, derivatives_node):
 
@@ -1139,13 +1519,18 @@ def getStatsCollectionForNode (rdf_graph, derivatives_node):
 
     return data
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def OpenGraph(file):
     '''
     Returns a parsed RDFLib Graph object for the given file
-    The file will be hashed and if a pickled copy is found in the TMP dir, that will be used
-    Otherwise the graph will be computed and then saved in the TMP dir as a pickle file
-    We also use functools.lru_cache to cache results in memory during a run
+    The file will be fingerprinted (see GraphCache) and if a cached copy is found in the cache dir, that will be used
+    Otherwise the graph will be computed and then saved in the cache dir
+    We also use MemoryCache to cache results in memory during a run, until the file changes
+
+    The on-disk format is picked with GRAPH_STORE (or the PYNIDM_GRAPH_STORE environment variable):
+    'pickle' saves the whole graph as a pickle file, 'sqlite' keeps it in an indexed SQLiteStore
+    which is opened lazily and queried in place, 'snapshot' writes a read-only columnar snapshot
+    that is memory mapped and shared between processes.
 
     :param file: filename
     :return: Graph
@@ -1154,32 +1539,178 @@ def OpenGraph(file):
     if isinstance(file, rdflib.graph.Graph):
         return file
 
-    BLOCKSIZE = 65536
-    hasher = hashlib.md5()
-    with open(file, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
-    hash = hasher.hexdigest()
+    rdf_graph = loadGraph(file)
+    # lets MemoryCache check the results of queries on this graph against the file
+    rdf_graph.nidm_files = (file,)
+    return rdf_graph
+
+def loadGraph(file):
+    '''
+    Opens a file with the GRAPH_STORE backend, see OpenGraph
+    '''
+    start = time.perf_counter()
+    # the cache key comes from a stat() fingerprint so a cache hit doesn't read the file
+    key = GraphCache.cacheKey(file)
+
+    if GRAPH_STORE in ('sqlite', 'snapshot'):
+        store_file = GraphCache.entryPath('rdf_graph', key, GRAPH_STORE)
+        with GraphCache.entryLock(store_file):
+            if path.exists(store_file) and not GraphCache.isValidEntry(store_file, file):
+                GraphCache.removeEntry(store_file)
+            new_entry = not path.exists(store_file)
+            if GRAPH_STORE == 'sqlite':
+                rdf_graph = OpenSQLiteGraph(file, store_file)
+            else:
+                rdf_graph = OpenSnapshotGraph(file, store_file)
+            if new_entry and GraphCache.STRICT_CACHE:
+                GraphCache.writeContentHash(store_file, file)
+        if new_entry:
+            GraphCache.entryAdded(store_file)
+        else:
+            GraphCache.touch(store_file)
+        Metrics.GRAPH_CACHE.increment(result='miss' if new_entry else 'hit')
+        Metrics.GRAPH_LOAD_SECONDS.observe(time.perf_counter() - start, source=GRAPH_STORE)
+        return rdf_graph
 
-    pickle_file = '{}/rdf_graph.{}.pickle'.format( tempfile.gettempdir(), hash)
-    if path.isfile(pickle_file):
-        return pickle.load(open(pickle_file, "rb"))
+    pickle_file = GraphCache.entryPath('rdf_graph', key, 'pickle')
+    rdf_graph = GraphCache.loadEntry(pickle_file, file)
+    if rdf_graph is not None:
+        Metrics.GRAPH_CACHE.increment(result='hit')
+        Metrics.GRAPH_LOAD_SECONDS.observe(time.perf_counter() - start, source='cache')
+        return rdf_graph
 
-    rdf_graph = Graph()
-    rdf_graph.parse(file, format=util.guess_format(file))
-    pickle.dump(rdf_graph, open(pickle_file, 'wb'))
+    with GraphCache.entryLock(pickle_file):
+        # another process may have built the entry while we waited for the lock
+        rdf_graph = GraphCache.loadEntry(pickle_file, file)
+        if rdf_graph is not None:
+            Metrics.GRAPH_CACHE.increment(result='hit')
+            Metrics.GRAPH_LOAD_SECONDS.observe(time.perf_counter() - start, source='cache')
+            return rdf_graph
 
-    # new graph, so to be safe clear out all cached entries
-    memory.clear(warn=False)
+        Metrics.GRAPH_CACHE.increment(result='miss')
+        rdf_graph = Graph()
+        rdf_graph.parse(file, format=util.guess_format(file))
+        Metrics.GRAPH_LOAD_SECONDS.observe(time.perf_counter() - start, source='parse')
+        GraphCache.saveEntry(pickle_file, rdf_graph, file)
 
     return rdf_graph
 
+def GetDataset(nidm_file_list):
+    '''
+    Returns a NIDMDataset for a list of NIDM files.  Datasets are cached in memory so the
+    union of the same files is only built once per run.
+
+    :param nidm_file_list: NIDMDataset or list of NIDM files
+    :return: NIDMDataset
+    '''
+    if isinstance(nidm_file_list, NIDMDataset):
+        return nidm_file_list
+    return GetDatasetCached(tuple(nidm_file_list), GRAPH_STORE, INFER_TYPES)
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetDatasetCached(nidm_file_list: tuple, graph_store, infer_types=False):
+    return NIDMDataset(nidm_file_list, infer_types=infer_types)
+
+def OpenDataset(nidm_file_list):
+    '''
+    Returns a single read-only graph over all of the given NIDM files so triple patterns
+    and SPARQL queries are answered in one pass instead of once per file
+
+    :param nidm_file_list: NIDMDataset, list of NIDM files, a single file or a Graph
+    :return: Graph
+    '''
+    if isinstance(nidm_file_list, rdflib.graph.Graph) or (isinstance(nidm_file_list, str) and not INFER_TYPES):
+        return OpenGraph(nidm_file_list)
+    if isinstance(nidm_file_list, str):
+        # the inferred types are added by the dataset
+        nidm_file_list = [nidm_file_list]
+    return GetDataset(nidm_file_list).graph
+
+def typePath(nidm_file_list):
+    '''
+    Returns the SPARQL path that matches a resource with the types it's declared with and
+    their superclasses.  Datasets that hold the inferred types (see GetInferredTypes) find
+    them with a plain rdf:type triple instead of expanding rdfs:subClassOf* in every query.
+
+    :param nidm_file_list: NIDMDataset, list of NIDM files, a single file or a Graph
+    :return: 'a' or 'a/rdfs:subClassOf*'
+    '''
+    if isinstance(nidm_file_list, str):
+        nidm_file_list = [nidm_file_list]
+    if not isinstance(nidm_file_list, rdflib.graph.Graph) and GetDataset(nidm_file_list).infer_types:
+        return 'a'
+    return 'a/rdfs:subClassOf*'
+
+def subclassClosure(graphs):
+    '''
+    :param graphs: graphs holding rdfs:subClassOf statements
+    :return: dictionary of class -> set of its direct and indirect superclasses
+    '''
+    parents = collections.defaultdict(set)
+    for rdf_graph in graphs:
+        for subclass, superclass in rdf_graph.subject_objects(Constants.RDFS['subClassOf']):
+            parents[subclass].add(superclass)
+
+    closure = {}
+    for cls in parents:
+        superclasses = set()
+        todo = list(parents[cls])
+        while todo:
+            superclass = todo.pop()
+            if superclass != cls and superclass not in superclasses:
+                superclasses.add(superclass)
+                todo.extend(parents.get(superclass, ()))
+        closure[cls] = superclasses
+    return closure
+
+def buildInferredTypes(rdf_graph, vocabularies):
+    '''
+    :param rdf_graph: graph of a NIDM file
+    :param vocabularies: graphs with more rdfs:subClassOf statements, e.g. the CDE graph
+    :return: Graph named INFERRED_TYPES with the rdf:type triples the subclasses of rdf_graph's
+        types imply, leaving out those already in rdf_graph
+    '''
+    isa = URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#type')
+    inferred = Graph(identifier=INFERRED_TYPES)
+    for cls, superclasses in subclassClosure([rdf_graph] + list(vocabularies)).items():
+        for s in rdf_graph.subjects(isa, cls):
+            # blank node labels can be renamed when datasets are combined, see unionGraph
+            if isinstance(s, rdflib.BNode):
+                continue
+            for superclass in superclasses:
+                if (s, isa, superclass) not in rdf_graph:
+                    inferred.add((s, isa, superclass))
+    return inferred
+
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
+def GetInferredTypes(nidm_file):
+    '''
+    Materializes the rdf:type closure over rdfs:subClassOf of a NIDM file, using the subclasses
+    declared in the file and in the CDE graph (see getCDEs).  NIDMDataset adds it to the union
+    of the files when INFER_TYPES (the PYNIDM_INFER_TYPES environment variable) is set, so
+    queries built with typePath don't expand rdfs:subClassOf* paths.  The graph is saved in
+    the graph cache, keyed on the fingerprints of the file and the CDE files.
+
+    :param nidm_file: NIDM file name
+    :return: Graph named INFERRED_TYPES
+    '''
+    cde_graph = getCDEs()
+    key = hashlib.md5((GraphCache.cacheKey(nidm_file) + str(getCDEs.key)).encode('utf-8')).hexdigest()
+    return GraphCache.cachedObject('type_closure', key, lambda: buildInferredTypes(OpenGraph(nidm_file), [cde_graph]))
+
+def clearMemoryCaches():
+    '''
+    Drops every query result cached in memory by the functions of this module and Navigate.
+    Cached results are checked against the fingerprints of their files (see MemoryCache), so
+    this is only needed to free memory or to see changes within MemoryCache.CHECK_INTERVAL.
+    The on-disk graph cache is keyed on file fingerprints and doesn't need clearing.
+    '''
+    MemoryCache.clearAll()
+
 def GetDerivativesDataForSubject(files, project, subject):
     return GetDerivativesDataForSubjectCache (tuple(files), project, subject)
 
-@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+@MemoryCache.memoize(maxsize=QUERY_CACHE_SIZE)
 def GetDerivativesDataForSubjectCache(files, project, subject):
     '''
     Searches for the subject in the supplied RDF .ttl files and returns
@@ -1198,12 +1729,11 @@ def GetDerivativesDataForSubjectCache(files, project, subject):
 
     data = {}
 
-    for nidm_file in files:
-        rdf_graph = OpenGraph(nidm_file)
-        for node in getDerivativesNodesForSubject(rdf_graph, subject):
-            collection = getStatsCollectionForNode(rdf_graph, node)
-            key = str(collection['URI']).split('/')[-1]
-            data[key] = collection
+    rdf_graph = OpenDataset(files)
+    for node in getDerivativesNodesForSubject(rdf_graph, subject):
+        collection = getStatsCollectionForNode(rdf_graph, node)
+        key = str(collection['URI']).split('/')[-1]
+        data[key] = collection
 
     return data
 
@@ -1238,14 +1768,20 @@ def getCDEs(file_list=None):
     if getCDEs.cache:
         return getCDEs.cache
 
-    hasher = hashlib.md5()
-    hasher.update(str(file_list).encode('utf-8'))
-    h = hasher.hexdigest()
+    if file_list and all(os.path.isfile(f) for f in file_list):
+        # key on the file fingerprints so edited CDE files don't keep serving the old graph
+        h = GraphCache.cacheKey(*file_list)
+    else:
+        hasher = hashlib.md5()
+        hasher.update(str(file_list).encode('utf-8'))
+        h = hasher.hexdigest()
 
-    cache_file_name = tempfile.gettempdir() + "/cde_graph.{}.pickle".format(h)
+    cache_file_name = GraphCache.entryPath('cde_graph', h, 'pickle')
+    # getCDECatalog saves the catalog of the graph under its own key
+    getCDEs.key = hashlib.md5(('catalog' + h).encode('utf-8')).hexdigest()
 
-    if path.isfile(cache_file_name):
-        rdf_graph = pickle.load(open(cache_file_name, "rb"))
+    rdf_graph = GraphCache.loadEntry(cache_file_name)
+    if rdf_graph is not None:
         getCDEs.cache = rdf_graph
         return rdf_graph
 
@@ -1279,10 +1815,10 @@ def getCDEs(file_list=None):
 
 
 
-    cache_file = open(cache_file_name , 'wb')
-    pickle.dump(rdf_graph, cache_file)
-    cache_file.close()
+    with GraphCache.entryLock(cache_file_name):
+        GraphCache.saveEntry(cache_file_name, rdf_graph)
 
     getCDEs.cache = rdf_graph
     return rdf_graph
-getCDEs.cache = None
\ No newline at end of file
+getCDEs.cache = None
+getCDEs.key = None
\ No newline at end of file
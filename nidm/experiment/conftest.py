@@ -0,0 +1,42 @@
+import os
+import time
+import pytest
+from nidm.core import Constants
+from nidm.experiment import GraphCache, Project, Query
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    '''
+    Keeps the graph cache entries of a test in its temporary directory
+    '''
+    monkeypatch.setattr(GraphCache, 'CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def cde_dir(monkeypatch):
+    '''
+    Reads the CDEs from the copy shipped with pynidm instead of downloading them, and makes
+    getCDEs and getCDECatalog load them again for this test only
+    '''
+    cde_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'core', 'cde_dir')
+    monkeypatch.setenv('CDE_DIR', cde_dir)
+    monkeypatch.setattr(Query.getCDEs, 'cache', None)
+    monkeypatch.setattr(Query.getCDEs, 'key', None)
+    monkeypatch.setattr(Query.getCDECatalog, 'cache', None)
+    return cde_dir
+
+
+@pytest.fixture
+def write_project():
+    '''
+    Returns a function writing a NIDM file that holds just a project
+    '''
+    def write(filename, uuid, name="Test"):
+        project = Project(uuid=uuid, attributes={Constants.NIDM_PROJECT_NAME: name})
+        with open(str(filename), 'w') as f:
+            f.write(project.serializeTurtle())
+        # make sure the fingerprint of a rewritten file changes even on file systems with coarse timestamps
+        os.utime(str(filename), ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+    return write
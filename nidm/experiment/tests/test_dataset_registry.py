@@ -0,0 +1,38 @@
+import os
+from nidm.core import Constants
+from nidm.experiment import Query
+from nidm.experiment.DatasetRegistry import DatasetRegistry
+
+
+def test_registry_refresh(tmp_path, cache_dir, write_project):
+    ttl_dir = tmp_path / "ttl"
+    (ttl_dir / "sub").mkdir(parents=True)
+    first = str(ttl_dir / "a.ttl")
+    write_project(first, "_registry_a")
+
+    registry = DatasetRegistry(str(ttl_dir / "**" / "*.ttl"), poll_interval=0)
+    registry.start()
+    assert registry.ready.is_set()
+    assert registry.files == (first,)
+    assert registry.status()['version'] == 1
+    assert not registry.refresh()
+
+    # added files are picked up
+    second = str(ttl_dir / "sub" / "b.ttl")
+    write_project(second, "_registry_b")
+    snapshot = registry.snapshot
+    assert registry.refresh()
+    assert registry.files == (first, second)
+    # a request that started before the swap keeps its files
+    assert snapshot.files == (first,)
+
+    # a rewritten file isn't answered from the in-memory caches
+    assert sorted(str(p) for p in Query.GetProjectsUUID(registry.files)) == [Constants.NIIRI + "_registry_a", Constants.NIIRI + "_registry_b"]
+    write_project(first, "_registry_c")
+    assert registry.refresh()
+    assert Constants.NIIRI + "_registry_c" in sorted(str(p) for p in Query.GetProjectsUUID(registry.files))
+
+    os.remove(second)
+    assert registry.refresh()
+    assert registry.files == (first,)
+    assert registry.status()['version'] == 4
@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+from rdflib import Graph
+
+from nidm.experiment import Filter
+from nidm.experiment.Filter import FilterOp, FilterTest
+
+
+def test_compile_filter():
+    node = Filter.compileFilter("instruments.AGE gt 12 and instruments.SITE eq 'Site A' or derivatives.fs_000003 in (1, 2)")
+    assert node == FilterOp('or', (
+        FilterOp('and', (FilterTest('instruments', 'AGE', 'gt', '12'), FilterTest('instruments', 'SITE', 'eq', 'Site A'))),
+        FilterTest('derivatives', 'fs_000003', 'in', ('1', '2'))))
+
+    # full URIs keep their dots, unknown categories never match
+    node = Filter.compileFilter("derivatives.http://purl.org/nidash/fsl#fsl_000032 le 3 and (AGE ge 1)")
+    assert node.args[0] == FilterTest('derivatives', 'http://purl.org/nidash/fsl#fsl_000032', 'le', '3')
+    assert node.args[1] == FilterTest(None, 'AGE', 'ge', '1')
+
+    with pytest.raises(ValueError):
+        Filter.compileFilter("instruments.AGE like 12")
+    with pytest.raises(ValueError):
+        Filter.compileFilter("(instruments.AGE gt 12")
+
+
+def test_evaluate_filter():
+    table = pd.DataFrame([
+        ('s1', 'instruments', 'AGE', 'AGE', '10'),
+        ('s1', 'instruments', 'SITE', 'SITE', 'Site A'),
+        ('s2', 'instruments', 'AGE', 'AGE', '30.5'),
+        ('s2', 'instruments', 'SITE', 'SITE', 'Site B'),
+        ('s3', 'instruments', 'AGE', 'AGE', 'nan'),
+        ('s3', 'derivatives', 'fs_000003', 'Volume', '1200'),
+    ], columns=Filter.TABLE_COLUMNS)
+    subjects = ['s1', 's2', 's3']
+
+    def synonyms(category, term):
+        return [term]
+
+    def matching(filter):
+        mask = Filter.evaluateFilter(Filter.compileFilter(filter), table, subjects, synonyms)
+        return [s for s, m in zip(subjects, mask) if m]
+
+    assert matching("instruments.AGE gt 12") == ['s2']
+    assert matching("instruments.AGE eq 10.0") == ['s1']
+    assert matching("instruments.AGE eq 'nan'") == ['s3']
+    assert matching("instruments.SITE eq 'Site A' or derivatives.fs_000003 ge 1200") == ['s1', 's3']
+    assert matching("instruments.SITE ne 'Site A' and instruments.AGE lt 40") == ['s2']
+    assert matching("instruments.SITE in ('Site A', 'Site B')") == ['s1', 's2']
+    assert matching("instrument.AGE le 10") == ['s1']
+    assert matching("derivatives.Volume eq 1200") == ['s3']
+    assert matching("AGE gt 0") == []
+
+
+def test_filter_to_sparql():
+    graph = Graph().parse(format='turtle', data='''
+        @prefix prov: <http://www.w3.org/ns/prov#> .
+        @prefix nidm: <http://purl.org/nidash/nidm#> .
+        @prefix ex: <http://example.org/> .
+        ex:acq1 a nidm:Acquisition ; prov:qualifiedAssociation [ prov:agent ex:s1 ] .
+        ex:acq2 a nidm:Acquisition ; prov:qualifiedAssociation [ prov:agent ex:s2 ] .
+        ex:acq3 a nidm:Acquisition ; prov:qualifiedAssociation [ prov:agent ex:s3 ] .
+        ex:inst1 prov:wasGeneratedBy ex:acq1 ; ex:age "10" ; ex:site "Site A" .
+        ex:inst2 prov:wasGeneratedBy ex:acq2 ; ex:age "30.5" ; ex:site "Site B" .
+        ex:inst3 prov:wasGeneratedBy ex:acq3 ; ex:age "nan" .
+    ''')
+
+    def elements(test):
+        return ['http://example.org/' + test.term.lower()]
+
+    def matching(filter):
+        pattern = Filter.filterToSparql(Filter.compileFilter(filter), elements)
+        if pattern is None:
+            return []
+        query = Filter.SPARQL_PREFIXES + 'SELECT DISTINCT ?subject WHERE {}'.format(pattern)
+        return sorted(str(row[0]).split('/')[-1] for row in graph.query(query))
+
+    assert matching("instruments.AGE gt 12") == ['s2']
+    assert matching("instruments.AGE lt 40") == ['s1', 's2']
+    assert matching("instruments.AGE eq 10.0") == ['s1']
+    assert matching("instruments.AGE eq 'nan'") == ['s3']
+    assert matching("instruments.SITE ne 'Site A' and instruments.AGE lt 40") == ['s2']
+    assert matching("instruments.SITE in ('Site A', 'Site B') or instruments.AGE ge 0") == ['s1', 's2']
+    assert matching("AGE gt 0 or instruments.SITE eq 'Site B'") == ['s2']
+    assert matching("AGE gt 0") == []
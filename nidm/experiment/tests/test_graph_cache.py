@@ -0,0 +1,233 @@
+import os
+import pytest
+
+from nidm.experiment import GraphCache, MemoryCache, Project, Query
+from nidm.core import Constants
+
+
+def test_cache_key_fingerprint(tmp_path, cache_dir, write_project):
+    nidm_file = str(tmp_path / "test_fingerprint.ttl")
+    write_project(nidm_file, "_123456", "Title_A")
+    key = GraphCache.cacheKey(nidm_file)
+
+    # same file, same key
+    assert GraphCache.cacheKey(nidm_file) == key
+
+    # rewriting the file changes mtime (and here the size) so the key changes
+    st = os.stat(nidm_file)
+    os.utime(nidm_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert GraphCache.cacheKey(nidm_file) != key
+
+
+def test_strict_cache_verifies_content(tmp_path, cache_dir, write_project):
+    nidm_file = str(tmp_path / "test_strict.ttl")
+    write_project(nidm_file, "_123456", "Title_A")
+    cache_file = str(tmp_path / "test_strict.cache")
+    with open(cache_file, 'w') as f:
+        f.write("entry")
+    GraphCache.writeContentHash(cache_file, nidm_file)
+
+    assert GraphCache.isValidEntry(cache_file, nidm_file, strict=False)
+    assert GraphCache.isValidEntry(cache_file, nidm_file, strict=True)
+
+    # change the content but keep size and mtime, only strict mode can notice
+    st = os.stat(nidm_file)
+    with open(nidm_file) as f:
+        content = f.read()
+    with open(nidm_file, 'w') as f:
+        f.write(content.replace("Title_A", "Title_B"))
+    os.utime(nidm_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert GraphCache.isValidEntry(cache_file, nidm_file, strict=False)
+    assert not GraphCache.isValidEntry(cache_file, nidm_file, strict=True)
+
+
+def test_OpenGraph_notices_rewritten_file(tmp_path, cache_dir, write_project):
+    nidm_file = str(tmp_path / "test_rewrite.ttl")
+    write_project(nidm_file, "_123456", "Title_A")
+    g = Query.OpenGraph(nidm_file)
+    assert "Title_A" in [str(o) for o in g.objects()]
+
+    write_project(nidm_file, "_123456", "Title_B")
+    Query.OpenGraph.cache_clear()
+    g = Query.OpenGraph(nidm_file)
+    assert "Title_B" in [str(o) for o in g.objects()]
+
+
+def test_cache_prune_and_clear(tmp_path, cache_dir, write_project):
+    write_project(str(tmp_path / "a.ttl"), "_123456", "Title_A")
+    write_project(str(tmp_path / "b.ttl"), "_123456", "Title_B")
+    first = GraphCache.entryPath('rdf_graph', GraphCache.cacheKey(str(tmp_path / "a.ttl")), 'pickle')
+    second = GraphCache.entryPath('rdf_graph', GraphCache.cacheKey(str(tmp_path / "b.ttl")), 'pickle')
+    GraphCache.saveEntry(first, "a" * 1000, str(tmp_path / "a.ttl"))
+    GraphCache.saveEntry(second, "b" * 1000, str(tmp_path / "b.ttl"))
+
+    # reading an entry makes it the most recently used one
+    st = os.stat(first)
+    os.utime(first, (st.st_atime - 100, st.st_mtime - 100))
+    assert GraphCache.loadEntry(first, str(tmp_path / "a.ttl")) == "a" * 1000
+    os.utime(second, (st.st_atime - 50, st.st_mtime - 50))
+
+    stats = GraphCache.cacheStats()
+    assert stats['entries'] == 2
+    assert stats['rdf_graph'] == 2
+
+    removed = GraphCache.prune(stats['bytes'] - 1)
+    assert removed == [second]
+    assert os.path.isfile(first)
+
+    assert GraphCache.clear() == 1
+    assert GraphCache.cacheStats()['entries'] == 0
+
+
+def test_cache_prunes_over_limit(tmp_path, cache_dir, write_project, monkeypatch):
+    monkeypatch.setattr(GraphCache, 'CACHE_MAX_BYTES', 2500)
+    pruned = []
+    prune = GraphCache.prune
+    monkeypatch.setattr(GraphCache, 'prune', lambda *args: pruned.append(prune(*args)))
+
+    entries = []
+    for name in ("a", "b", "c"):
+        write_project(str(tmp_path / (name + ".ttl")), "_123456", "Title")
+        entries.append(GraphCache.entryPath('rdf_graph', GraphCache.cacheKey(str(tmp_path / (name + ".ttl"))), 'pickle'))
+        GraphCache.saveEntry(entries[-1], name * 1000, str(tmp_path / (name + ".ttl")))
+        os.utime(entries[-1], (len(entries), len(entries)))
+
+    # the cache is only listed again once the third entry goes over the limit
+    assert pruned == [[entries[0]]]
+    # outside of strict mode no content hash is computed
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith(GraphCache.CONTENT_HASH_SUFFIX)]
+
+
+def test_strict_cache_sidecar_and_lock(tmp_path, cache_dir, write_project, monkeypatch):
+    nidm_file = str(tmp_path / "test_sidecar.ttl")
+    write_project(nidm_file, "_123456", "Title_A")
+    cache_file = GraphCache.entryPath('rdf_graph', GraphCache.cacheKey(nidm_file), 'pickle')
+
+    monkeypatch.setattr(GraphCache, 'STRICT_CACHE', True)
+    with GraphCache.entryLock(cache_file):
+        GraphCache.saveEntry(cache_file, "entry", nidm_file)
+    assert os.path.isfile(cache_file + GraphCache.CONTENT_HASH_SUFFIX)
+    assert GraphCache.loadEntry(cache_file, nidm_file) == "entry"
+
+    # another process may still be waiting on the lock file of a removed entry
+    GraphCache.removeEntry(cache_file)
+    assert not os.path.exists(cache_file) and not os.path.exists(cache_file + GraphCache.CONTENT_HASH_SUFFIX)
+    assert os.path.isfile(cache_file + GraphCache.LOCK_SUFFIX)
+
+
+def test_cache_entry_header(tmp_path, cache_dir):
+    cache_file = str(tmp_path / "rdf_graph.0123abcd.pickle")
+    with open(cache_file, 'wb') as f:
+        f.write(b"not a pickle")
+    # unreadable or unversioned entries are treated as a cache miss
+    assert GraphCache.loadEntry(cache_file) is None
+
+    GraphCache.saveEntry(cache_file, {'x': 1})
+    assert GraphCache.loadEntry(cache_file) == {'x': 1}
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith(GraphCache.TMP_SUFFIX)]
+
+
+def test_navigation_index_cached(tmp_path, cache_dir):
+    from nidm.experiment import Session, Navigate
+
+    project = Project(uuid="_nav_project", attributes={Constants.NIDM_PROJECT_NAME: "Nav"})
+    Session(project=project, uuid="_nav_session")
+    nidm_file = str(tmp_path / "nav.ttl")
+    with open(nidm_file, 'w') as f:
+        f.write(project.serializeTurtle())
+
+    files = (nidm_file,)
+    assert Navigate.getSessions(files, "_nav_project") == [Constants.NIIRI["_nav_session"]]
+    assert GraphCache.cacheStats()['nav_index'] == 1
+
+    # a new process would load the index from disk instead of walking the graph again
+    cache_file = GraphCache.entryPath('nav_index', GraphCache.cacheKey(nidm_file), 'pickle')
+    index = GraphCache.loadEntry(cache_file)
+    assert index.sessions[Constants.NIIRI["_nav_project"]] == [Constants.NIIRI["_nav_session"]]
+
+
+def test_data_element_catalog_cached(tmp_path, cache_dir):
+    nidm_file = str(tmp_path / "catalog.ttl")
+    with open(nidm_file, 'w') as f:
+        f.write('''
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+niiri:volume_de a nidm:DataElement ;
+    rdfs:label "left volume" ;
+    nidm:hasUnit "mm^3" ;
+    nidm:hasLaterality "Left" ;
+    nidm:datumType <http://uri.interlex.org/base/ilx_0738276> .
+niiri:not_a_data_element rdfs:label "other" .
+''')
+    graph = Query.OpenGraph(nidm_file)
+    info = Query.getDataTypeInfo(graph, 'volume_de')
+    assert (str(info['label']), str(info['hasUnit']), str(info['hasLaterality'])) == ('left volume', 'mm^3', 'Left')
+    assert info['datumType'] == 'ilx_0738276' and info['prefix'] == 'niiri'
+    # callers may change what they get back
+    info['label'] = 'changed'
+    assert str(Query.getDataTypeInfo(graph, Constants.NIIRI['volume_de'])['label']) == 'left volume'
+    assert str(Constants.NIIRI['not_a_data_element']) not in Query.getDataElementCatalog(graph)
+
+    # a new process would load the catalog from disk instead of scanning the graph again
+    assert GraphCache.cacheStats()['de_catalog'] >= 1
+    cache_file = GraphCache.entryPath('de_catalog', GraphCache.cacheKey(nidm_file), 'pickle')
+    assert list(GraphCache.loadEntry(cache_file)) == [str(Constants.NIIRI['volume_de'])]
+
+
+def writeSummaryFile(filename, project, subjects):
+    ttl = '''@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+@prefix sio: <http://semanticscience.org/ontology/sio.owl#> .
+@prefix ndar: <https://ndar.nih.gov/api/datadictionary/v2/dataelement/> .
+@prefix ncicb: <http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl#> .
+@prefix obo: <http://purl.obolibrary.org/obo/> .
+niiri:{p} a nidm:Project .
+niiri:{p}_session a nidm:Session ; dct:isPartOf niiri:{p} .
+niiri:{p}_age a nidm:DataElement ; nidm:isAbout ncicb:Age .
+niiri:{p}_gender a nidm:DataElement ; nidm:isAbout ndar:gender .
+niiri:{p}_hand a nidm:DataElement ; nidm:isAbout obo:handedness .
+'''.format(p=project)
+    for i, (age, gender, hand) in enumerate(subjects):
+        ttl += '''niiri:{p}_person{i} ndar:src_subject_id "{i}" .
+niiri:{p}_acq{i} dct:isPartOf niiri:{p}_session ;
+    prov:qualifiedAssociation [ prov:hadRole sio:Subject ; prov:agent niiri:{p}_person{i} ] .
+niiri:{p}_assessment{i} prov:wasGeneratedBy niiri:{p}_acq{i} ;
+    niiri:{p}_age "{age}" ; niiri:{p}_gender "{gender}" ; niiri:{p}_hand "{hand}" .
+'''.format(p=project, i=i, age=age, gender=gender, hand=hand)
+    with open(filename, 'w') as f:
+        f.write(ttl)
+
+
+def test_project_summaries_cached(tmp_path, cache_dir, monkeypatch):
+    first = str(tmp_path / "summary_a.ttl")
+    second = str(tmp_path / "summary_b.ttl")
+    writeSummaryFile(first, "_summary_a", [(21, '2', 'R'), (33, '1', 'R'), (25.5, '2', 'L')])
+    writeSummaryFile(second, "_summary_b", [(8, '1', 'L')])
+
+    built = []
+    build = Query.buildProjectSummaries
+    monkeypatch.setattr(Query, 'buildProjectSummaries', lambda file: built.append(file) or build(file))
+
+    projects = Query.GetProjectsComputedMetadata([first, second])['projects']
+    summary = projects['niiri:_summary_a']
+    assert summary[Query.matchPrefix(str(Constants.NIDM_NUMBER_OF_SUBJECTS))] == 3
+    assert (summary['age_min'], summary['age_max']) == (21.0, 33.0)
+    assert summary[Query.matchPrefix(str(Constants.NIDM_GENDER))] == ['2', '1']
+    assert summary[Query.matchPrefix(str(Constants.NIDM_HANDEDNESS))] == ['R', 'L']
+    assert projects['niiri:_summary_b']['age_min'] == 8.0
+    assert sorted(built) == sorted([first, second])
+    assert GraphCache.cacheStats()['project_summary'] == 2
+
+    # only the file that changed is summarized again
+    writeSummaryFile(second, "_summary_b", [(8, '1', 'L'), (12, '1', 'R')])
+    st = os.stat(second)
+    os.utime(second, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    MemoryCache.invalidateFiles([second])
+    projects = Query.GetProjectsComputedMetadata([first, second])['projects']
+    assert projects['niiri:_summary_b']['age_max'] == 12.0
+    assert projects['niiri:_summary_a']['age_max'] == 33.0
+    assert built[2:] == [second]
@@ -0,0 +1,71 @@
+import os
+import time
+from nidm.core import Constants
+from nidm.experiment import MemoryCache, Query
+
+
+def test_memoize(tmp_path):
+    calls = []
+
+    @MemoryCache.memoize(maxsize=2)
+    def readFile(file, suffix):
+        calls.append(file)
+        with open(file) as f:
+            return f.read() + suffix
+
+    first = str(tmp_path / "a.txt")
+    second = str(tmp_path / "b.txt")
+    for file in (first, second):
+        with open(file, 'w') as f:
+            f.write(os.path.basename(file))
+    try:
+        assert readFile(first, '!') == 'a.txt!'
+        assert readFile(first, '!') == 'a.txt!'
+        assert readFile(second, '!') == 'b.txt!'
+        assert calls == [first, second]
+        info = MemoryCache.stats()['test_memory_cache.readFile']
+        assert (info.hits, info.misses, info.currsize, info.maxsize) == (1, 2, 2, 2)
+
+        # only the results of the invalidated file are dropped
+        assert MemoryCache.invalidateFiles([first]) == 1
+        assert readFile(second, '!') == 'b.txt!'
+        assert readFile(first, '!') == 'a.txt!'
+        assert calls == [first, second, first]
+        assert readFile.cache_info().invalidations == 1
+
+        # a rewritten file is noticed once its fingerprint is checked again
+        with open(first, 'w') as f:
+            f.write('changed')
+        os.utime(first, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+        old_interval = MemoryCache.CHECK_INTERVAL
+        MemoryCache.CHECK_INTERVAL = 0
+        try:
+            assert readFile(first, '!') == 'changed!'
+        finally:
+            MemoryCache.CHECK_INTERVAL = old_interval
+        assert readFile.cache_info().invalidations == 2
+
+        MemoryCache.clearAll()
+        assert readFile.cache_info().currsize == 0
+    finally:
+        MemoryCache.CACHES.remove(readFile)
+
+
+def test_query_invalidation(tmp_path, cache_dir, write_project):
+    file = str(tmp_path / "memory.ttl")
+    other = str(tmp_path / "other.ttl")
+    write_project(file, "_memory_a")
+    write_project(other, "_memory_other")
+    assert [str(p) for p in Query.GetProjectsUUID([file])] == [Constants.NIIRI + "_memory_a"]
+    assert [str(p) for p in Query.GetProjectsUUID([other])] == [Constants.NIIRI + "_memory_other"]
+
+    # queries on the graph of a file are tagged with the file too
+    assert Query.OpenGraph(file).nidm_files == (file,)
+    assert Query.OpenDataset([file, other]).nidm_files == (file, other)
+
+    write_project(file, "_memory_b")
+    entries = Query.OpenGraph.cache_info().currsize
+    MemoryCache.invalidateFiles([file])
+    assert Query.OpenGraph.cache_info().currsize == entries - 1
+    assert [str(p) for p in Query.GetProjectsUUID([file])] == [Constants.NIIRI + "_memory_b"]
+    assert Query.GetProjectsUUID([other])
@@ -0,0 +1,44 @@
+from rdflib import Graph
+from nidm.experiment import Metrics, Query
+
+
+def test_metrics_render():
+    counter = Metrics.counter('nidm_test_total', 'Test counter', ('result',))
+    histogram = Metrics.histogram('nidm_test_seconds', 'Test histogram', ('route',), buckets=(0.1, 1))
+    try:
+        counter.increment(result='hit')
+        counter.increment(2, result='hit')
+        histogram.observe(0.05, route='a "b"')
+        histogram.observe(0.5, route='a "b"')
+        histogram.observe(5, route='a "b"')
+
+        lines = Metrics.render().splitlines()
+        assert '# TYPE nidm_test_total counter' in lines
+        assert 'nidm_test_total{result="hit"} 3.0' in lines
+        assert '# TYPE nidm_test_seconds histogram' in lines
+        assert 'nidm_test_seconds_bucket{route="a \\"b\\"",le="0.1"} 1' in lines
+        assert 'nidm_test_seconds_bucket{route="a \\"b\\"",le="1.0"} 2' in lines
+        assert 'nidm_test_seconds_bucket{route="a \\"b\\"",le="+Inf"} 3' in lines
+        assert 'nidm_test_seconds_sum{route="a \\"b\\""} 5.55' in lines
+        assert 'nidm_test_seconds_count{route="a \\"b\\""} 3' in lines
+    finally:
+        del Metrics.METRICS['nidm_test_total'], Metrics.METRICS['nidm_test_seconds']
+
+
+def test_query_metrics():
+    Metrics.reset()
+    graph = Graph().parse(format='turtle', data='''
+        @prefix ex: <http://example.org/> .
+        ex:a ex:b ex:c , ex:d .
+    ''')
+
+    def countObjects():
+        return Query.timedQuery(graph, 'SELECT ?o WHERE { ?s ?p ?o }')
+
+    assert len(list(countObjects())) == 2
+    text = Metrics.render()
+    assert 'nidm_sparql_query_seconds_count{function="countObjects"} 1' in text
+    assert 'nidm_sparql_result_rows_bucket{function="countObjects",le="1.0"} 0' in text
+    assert 'nidm_sparql_result_rows_bucket{function="countObjects",le="10.0"} 1' in text
+    # the memory caches are reported too
+    assert 'nidm_memory_cache_entries{function="Query.OpenGraph"}' in text
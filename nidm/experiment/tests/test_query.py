@@ -1,7 +1,9 @@
 import nidm.experiment.Navigate
 from nidm.experiment import Project, Session, AssessmentAcquisition, AssessmentObject, Acquisition, AcquisitionObject, Query
 from nidm.core import Constants
-from rdflib import Namespace,URIRef
+from nidm.experiment.NIDMDataset import NIDMDataset, unionGraph
+from rdflib import Namespace,URIRef,Graph,RDF,BNode
+from rdflib.compare import isomorphic
 import prov.model as pm
 from os import remove, path
 import tempfile
@@ -360,3 +362,304 @@ def test_custom_data_types():
     assert (str(valuetype3['label']) == 'age')
     assert (str(valuetype3['description']) == "Age of participant at scan")
     assert (str(valuetype3['isAbout']) == str(Constants.NIIRI['24d78sq']))
+
+
+@pytest.mark.parametrize("graph_store", ['sqlite', 'snapshot'])
+def test_graph_store(graph_store, tmp_path, cache_dir, monkeypatch):
+    kwargs={Constants.NIDM_PROJECT_NAME:"FBIRN_PhaseII",Constants.NIDM_PROJECT_IDENTIFIER:9610,Constants.NIDM_PROJECT_DESCRIPTION:"Test investigation"}
+    project = Project(uuid="_123456",attributes=kwargs)
+    session = Session(uuid="_13579",project=project)
+    acq = Acquisition(uuid="_15793",session=session)
+    person=acq.add_person(attributes=({Constants.NIDM_SUBJECTID:"9999"}))
+    acq.add_qualified_association(person=person,role=Constants.NIDM_PARTICIPANT)
+
+    nidm_file = str(tmp_path / "test_graph_store.ttl")
+    with open(nidm_file,'w') as f:
+        f.write(project.serializeTurtle())
+
+    monkeypatch.setattr(Query, 'GRAPH_STORE', graph_store)
+    Query.OpenGraph.cache_clear()
+    try:
+        rdf_graph = Query.OpenGraph(nidm_file)
+        parsed = Graph().parse(nidm_file, format='turtle')
+        assert len(rdf_graph) == len(parsed)
+        assert isomorphic(rdf_graph, parsed)
+        assert (URIRef(Constants.NIIRI + "_123456"), URIRef(Constants.RDFS['label']), None) not in rdf_graph
+        assert (URIRef(Constants.NIIRI + "_123456"), RDF.type, Constants.NIDM['Project']) in rdf_graph
+        assert len(list(rdf_graph.triples((None, RDF.type, None)))) == len(list(parsed.triples((None, RDF.type, None))))
+
+        project_list = Query.GetProjectsUUID([nidm_file])
+        assert URIRef(Constants.NIIRI + "_123456") in project_list
+        participant_list = Query.GetParticipantIDs([nidm_file])
+        assert (participant_list['ID'].str.contains('9999').any())
+    finally:
+        # graphs opened from this store must not be served to later tests
+        Query.OpenGraph.cache_clear()
+
+
+def test_snapshot_written_twice(tmp_path):
+    from nidm.experiment.GraphStore import writeSnapshot, OpenSnapshotGraph
+
+    nidm_file = str(tmp_path / "test_snapshot_race.ttl")
+    with open(nidm_file, 'w') as f:
+        f.write(Project(uuid="_123456", attributes={Constants.NIDM_PROJECT_NAME: "Race"}).serializeTurtle())
+    snapshot_dir = str(tmp_path / "rdf_graph.race.snapshot")
+    rdf_graph = OpenSnapshotGraph(nidm_file, snapshot_dir)
+
+    # a process that lost the race to write the snapshot uses the one already there
+    writeSnapshot(Graph().parse(nidm_file, format='turtle'), snapshot_dir)
+    assert isomorphic(OpenSnapshotGraph(nidm_file, snapshot_dir), rdf_graph)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["rdf_graph.race.snapshot", "test_snapshot_race.ttl"]
+
+    # but a directory that isn't a snapshot is not silently used
+    (tmp_path / "not_a_snapshot" / "junk").mkdir(parents=True)
+    with pytest.raises(OSError):
+        writeSnapshot(rdf_graph, str(tmp_path / "not_a_snapshot"))
+
+
+def test_dataset_union():
+    # the session is in one file and the acquisition that is part of it in another
+    with open("test_dataset_1.ttl", 'w') as f:
+        f.write('''
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+niiri:_ds_project a nidm:Project .
+niiri:_ds_session a nidm:Session ; dct:isPartOf niiri:_ds_project .
+''')
+    with open("test_dataset_2.ttl", 'w') as f:
+        f.write('''
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+niiri:_ds_acquisition a nidm:Acquisition ; dct:isPartOf niiri:_ds_session .
+''')
+
+    try:
+        dataset = NIDMDataset(["test_dataset_1.ttl", "test_dataset_2.ttl"])
+        query = '''
+            prefix dct: <http://purl.org/dc/terms/>
+            select ?acq ?project where { ?acq dct:isPartOf ?session . ?session dct:isPartOf ?project }
+        '''
+        df = Query.sparql_query_nidm(dataset, query)
+        assert len(df) == 1
+        assert df['project'][0] == URIRef(Constants.NIIRI + "_ds_project")
+
+        # plain file lists get the same union
+        assert len(Query.sparql_query_nidm(["test_dataset_1.ttl", "test_dataset_2.ttl"], query)) == 1
+
+        sessions = nidm.experiment.Navigate.getSessions(dataset, "_ds_project")
+        acquisitions = nidm.experiment.Navigate.getAcquisitions(dataset, sessions[0])
+        assert acquisitions == [URIRef(Constants.NIIRI + "_ds_acquisition")]
+    finally:
+        remove("test_dataset_1.ttl")
+        remove("test_dataset_2.ttl")
+
+
+def test_dataset_union_blank_nodes():
+    # blank node labels from separate parses can clash, they must stay distinct in the union
+    g1 = Graph()
+    g1.add((BNode('b0'), Constants.PROV['agent'], URIRef(Constants.NIIRI + "_agent1")))
+    g2 = Graph()
+    g2.add((BNode('b0'), Constants.PROV['agent'], URIRef(Constants.NIIRI + "_agent2")))
+
+    union = unionGraph([g1, g2])
+    assert len(union) == 2
+    assert len(set(union.subjects(Constants.PROV['agent'], None))) == 2
+
+
+def test_dataset_union_skips_stores(tmp_path, monkeypatch):
+    from nidm.experiment.GraphStore import OpenSQLiteGraph, SQLiteStore
+
+    nidm_file = str(tmp_path / "test_union_store.ttl")
+    with open(nidm_file, 'w') as f:
+        f.write(Project(uuid="_union_store", attributes={Constants.NIDM_PROJECT_NAME: "Union"}).serializeTurtle())
+    stored = OpenSQLiteGraph(nidm_file, str(tmp_path / "test_union_store.sqlite"))
+    g2 = Graph()
+    g2.add((BNode('b0'), Constants.PROV['agent'], URIRef(Constants.NIIRI + "_agent2")))
+
+    # combining the graphs must not read every triple of the store
+    triples = SQLiteStore.triples
+    def noScan(self, triple_pattern, context=None):
+        assert triple_pattern != (None, None, None)
+        return triples(self, triple_pattern, context)
+    monkeypatch.setattr(SQLiteStore, 'triples', noScan)
+    union = unionGraph([stored, g2])
+    assert (URIRef(Constants.NIIRI + "_union_store"), RDF.type, Constants.NIDM['Project']) in union
+    assert len(set(union.subjects(Constants.PROV['agent'], None))) == 1
+
+
+def test_sparql_query_jobs():
+    files = []
+    for i in range(3):
+        kwargs={Constants.NIDM_PROJECT_NAME:"FBIRN_PhaseII",Constants.NIDM_PROJECT_IDENTIFIER:9610,Constants.NIDM_PROJECT_DESCRIPTION:"Test investigation"}
+        project = Project(uuid="_jobs%d" % i,attributes=kwargs)
+        files.append("test_jobs%d.ttl" % i)
+        with open(files[-1],'w') as f:
+            f.write(project.serializeTurtle())
+
+    query = '''
+        PREFIX nidm:<http://purl.org/nidash/nidm#>
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        SELECT distinct ?uuid ?p Where { ?uuid rdf:type nidm:Project ; ?p ?o }
+    '''
+    try:
+        serial = Query.sparql_query_nidm(files, query)
+        parallel = Query.sparql_query_nidm(files, query, jobs=2)
+        assert list(parallel.columns) == ['uuid', 'p']
+        assert len(parallel) == len(serial)
+        assert set(map(tuple, parallel.values)) == set(map(tuple, serial.values))
+        assert URIRef(Constants.NIIRI + "_jobs2") in set(parallel['uuid'])
+    finally:
+        for f in files:
+            remove(f)
+
+
+def test_project_data_table(tmp_path, cache_dir, cde_dir):
+    # data elements that aren't in the file are looked up in the CDEs shipped with pynidm
+    nidm_file = str(tmp_path / "test_wide.ttl")
+    with open(nidm_file, 'w') as f:
+        f.write('''
+@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+@prefix sio: <http://semanticscience.org/ontology/sio.owl#> .
+@prefix ex: <http://example.org/> .
+niiri:_wide_project a nidm:Project .
+niiri:_wide_session a nidm:Session ; dct:isPartOf niiri:_wide_project .
+niiri:_wide_acq1 a nidm:Acquisition ; dct:isPartOf niiri:_wide_session ;
+    prov:qualifiedAssociation [ prov:agent niiri:_wide_s1 ; prov:hadRole sio:Subject ] .
+niiri:_wide_acq2 a nidm:Acquisition ; dct:isPartOf niiri:_wide_session ;
+    prov:qualifiedAssociation [ prov:agent niiri:_wide_s1 ; prov:hadRole sio:Subject ] .
+niiri:_wide_acq3 a nidm:Acquisition ; dct:isPartOf niiri:_wide_session ;
+    prov:qualifiedAssociation [ prov:agent niiri:_wide_s2 ; prov:hadRole sio:Subject ] .
+niiri:_wide_inst1 prov:wasGeneratedBy niiri:_wide_acq1 ; ex:age "10" ; ex:site "CMU" .
+niiri:_wide_inst2 prov:wasGeneratedBy niiri:_wide_acq2 ; ex:age "20" .
+niiri:_wide_inst3 prov:wasGeneratedBy niiri:_wide_acq3 ; ex:age "unknown" ; ex:site "NYU" .
+''')
+
+    table = Query.GetProjectDataTable([nidm_file], "_wide_project")
+    age = 'http://example.org/age'
+    assert table.elements.loc[age, 'category'] == 'instruments'
+    assert table.elements.loc[age, 'key'] == 'age'
+
+    # one row per instrument, so both of _wide_s1's ages are kept
+    assert sorted(table.values[age].dropna()) == ['10', '20', 'unknown']
+    assert sorted(table.numbers.loc['_wide_s1', age]) == [10.0, 20.0]
+    assert table.numbers.loc[['_wide_s2'], age].isna().all()
+    assert list(table.values.loc[['_wide_s2'], 'http://example.org/site']) == ['NYU']
+
+
+def test_resolve_uuid():
+    kwargs={Constants.NIDM_PROJECT_NAME:"FBIRN_PhaseII",Constants.NIDM_PROJECT_IDENTIFIER:9610,Constants.NIDM_PROJECT_DESCRIPTION:"Test investigation"}
+    project = Project(uuid="_uuid_project",attributes=kwargs)
+    session = Session(uuid="_uuid_session",project=project)
+    acq = Acquisition(uuid="_uuid_acq_1",session=session)
+    acq2 = Acquisition(uuid="_uuid_acq_2",session=session)
+
+    person=acq.add_person(uuid="_uuid_person_1", attributes=({Constants.NIDM_SUBJECTID:"9999"}))
+    acq.add_qualified_association(person=person,role=Constants.NIDM_PARTICIPANT)
+    person2=acq2.add_person(uuid="_uuid_person_2", attributes=({Constants.NIDM_SUBJECTID:"8888"}))
+    acq2.add_qualified_association(person=person2,role=Constants.NIDM_PARTICIPANT)
+
+    with open("test_uuid.ttl",'w') as f:
+        f.write(project.serializeTurtle())
+
+    try:
+        index = Query.GetUUIDIndex(["test_uuid.ttl"])
+        assert list(index) == sorted(index)
+        assert "_uuid_person_1" in index and "_uuid_session" in index
+
+        assert Query.resolveUUID(["test_uuid.ttl"], "_uuid_person_1") == Constants.NIIRI["_uuid_person_1"]
+        assert Query.resolveUUID(["test_uuid.ttl"], Constants.NIIRI["_uuid_person_2"]) == Constants.NIIRI["_uuid_person_2"]
+        assert Query.resolveUUID(["test_uuid.ttl"], "_uuid_pro") == Constants.NIIRI["_uuid_project"]
+        assert Query.resolveUUID(["test_uuid.ttl"], "_uuid_nobody") is None
+        with pytest.raises(Query.AmbiguousUUIDError):
+            Query.resolveUUID(["test_uuid.ttl"], "_uuid_person_")
+
+        # participants can be asked for by the start of their UUID
+        details = Query.GetParticipantDetails(["test_uuid.ttl"], "_uuid_project", "_uuid_person_2")
+        assert details['uuid'] == "_uuid_person_2" and details['id'] == "8888"
+        assert details['activity'] == ["_uuid_acq_2"]
+        assert Query.GetParticipantDetails(["test_uuid.ttl"], "_uuid_project", "_uuid_person_1")['id'] == "9999"
+        assert Query.GetParticipantDetails(["test_uuid.ttl"], "_uuid_project", "_uuid_nobody")['uuid'] == ""
+    finally:
+        remove("test_uuid.ttl")
+
+
+def test_synonym_index(tmp_path, cache_dir):
+    ttl = '''@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+niiri:_syn_project a nidm:Project .
+niiri:_syn_session a nidm:Session ; dct:isPartOf niiri:_syn_project .
+niiri:_syn_age a nidm:DataElement ; rdfs:label "Age at scan" ; nidm:source_variable "AGE_AT_SCAN" ;
+    nidm:isAbout <http://uri.interlex.org/ilx_0100400> .
+niiri:_syn_sex a nidm:DataElement ; rdfs:label "Sex" ; nidm:source_variable "SEX" .
+'''
+    file = str(tmp_path / "test_synonyms.ttl")
+    with open(file, 'w') as f:
+        f.write(ttl)
+
+    index = Query.GetSynonymIndex([file], "_syn_project")
+    age = Constants.NIIRI["_syn_age"]
+    assert index.terms["AGE_AT_SCAN"] == [str(age)]
+    assert index.normalized_terms["ageatscan"] == [str(age)]
+    assert index.terms["ilx_0100400"] == [str(age)]
+
+    synonyms = Query.GetDatatypeSynonyms([file], "_syn_project", "AGE_AT_SCAN")
+    assert "Age at scan" in synonyms and str(age) in synonyms
+    # case, whitespace and underscores don't matter
+    assert Query.GetDatatypeSynonyms([file], "_syn_project", " age_at_Scan ") == synonyms
+    assert Query.GetDatatypeSynonyms([file], "_syn_project", "sex") == Query.GetDatatypeSynonyms([file], "_syn_project", "SEX")
+    assert Query.GetDatatypeSynonyms([file], "_syn_project", "AGE_AT_SCN") == ["AGE_AT_SCN"]
+
+    old_score = Query.FUZZY_FIELD_SCORE
+    Query.FUZZY_FIELD_SCORE = 80
+    try:
+        assert Query.GetDatatypeSynonyms([file], "_syn_project", "AGE_AT_SCN") == synonyms
+        assert Query.GetDatatypeSynonyms([file], "_syn_project", "handedness") == ["handedness"]
+    finally:
+        Query.FUZZY_FIELD_SCORE = old_score
+
+
+def test_inferred_types(tmp_path, cache_dir, cde_dir, monkeypatch):
+    ttl = '''@prefix niiri: <http://iri.nidash.org/> .
+@prefix nidm: <http://purl.org/nidash/nidm#> .
+@prefix prov: <http://www.w3.org/ns/prov#> .
+@prefix ndar: <https://ndar.nih.gov/api/datadictionary/v2/dataelement/> .
+@prefix fs: <https://surfer.nmr.mgh.harvard.edu/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+fs:DataElement rdfs:subClassOf nidm:DataElement .
+niiri:_infer_volume rdfs:subClassOf fs:DataElement .
+fs:fs_000003 a fs:DataElement ; rdfs:label "Brain Segmentation Volume" ;
+    nidm:measureOf <http://uri.interlex.org/base/ilx_0112559> ; nidm:datumType <http://uri.interlex.org/base/ilx_0738276> .
+niiri:_infer_element a niiri:_infer_volume ; rdfs:label "Other Volume" ;
+    nidm:measureOf <http://uri.interlex.org/base/ilx_0112559> ; nidm:datumType <http://uri.interlex.org/base/ilx_0738276> .
+niiri:_infer_person ndar:src_subject_id "S1" .
+niiri:_infer_act a prov:Activity ;
+    prov:qualifiedAssociation [ prov:agent [ nidm:NIDM_0000164 <https://surfer.nmr.mgh.harvard.edu/> ] ] ,
+        [ prov:agent niiri:_infer_person ] .
+niiri:_infer_stats prov:wasGeneratedBy niiri:_infer_act ; fs:fs_000003 "1419501" ; niiri:_infer_element "12" .
+'''
+    file = str(tmp_path / "test_infer.ttl")
+    with open(file, 'w') as f:
+        f.write(ttl)
+
+    isa = URIRef("http://www.w3.org/1999/02/22-rdf-syntax-ns#type")
+    inferred = Query.GetInferredTypes(file)
+    assert inferred.identifier == Query.INFERRED_TYPES
+    assert (Constants.NIIRI["_infer_element"], isa, Constants.NIDM["DataElement"]) in inferred
+    assert (Constants.NIIRI["_infer_element"], isa, URIRef("https://surfer.nmr.mgh.harvard.edu/DataElement")) in inferred
+    # types stated in the file aren't repeated
+    assert (Constants.NIIRI["_infer_element"], isa, Constants.NIIRI["_infer_volume"]) not in inferred
+
+    assert Query.typePath(file) == 'a/rdfs:subClassOf*'
+    volumes = Query.GetBrainVolumes(file)
+    monkeypatch.setattr(Query, 'INFER_TYPES', True)
+    assert Query.typePath(file) == 'a'
+    assert (Constants.NIIRI["_infer_element"], isa, Constants.NIDM["DataElement"]) in Query.OpenDataset(file)
+    inferred_volumes = Query.GetBrainVolumes(file)
+    assert sorted(map(str, inferred_volumes['volume'])) == sorted(map(str, volumes['volume'])) == ['12', '1419501']
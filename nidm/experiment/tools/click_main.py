@@ -5,3 +5,4 @@ from nidm.experiment.tools import nidm_visualize
 from nidm.experiment.tools import nidm_concat
 from nidm.experiment.tools import nidm_merge
 from nidm.experiment.tools import nidm_convert
+from nidm.experiment.tools import nidm_cache
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#**************************************************************************************
+#**************************************************************************************
+#  nidm_cache.py
+#  License: GPL
+#**************************************************************************************
+#**************************************************************************************
+# Filename: nidm_cache.py
+#
+# Program description:  Tools for inspecting and managing the on-disk graph cache used
+#   by the query tools and the REST API
+#
+#**************************************************************************************
+# System requirements:  Python 3.X
+# Libraries: click, tabulate
+#**************************************************************************************
+#**************************************************************************************
+
+import click
+from tabulate import tabulate
+from nidm.experiment.tools.click_base import cli
+from nidm.experiment import GraphCache
+from nidm.experiment.Query import OpenGraph, getCDEs
+from nidm.experiment.Navigate import getNavigationIndex
+
+
+@cli.group()
+@click.option("--cache_dir", "-d", required=False,
+              help="Cache directory to use. Defaults to the PYNIDM_CACHE_DIR environment variable or pynidm_cache in the system temp dir")
+def cache(cache_dir):
+    """
+    Inspect and manage the on-disk NIDM graph cache.
+    """
+    if cache_dir:
+        GraphCache.CACHE_DIR = cache_dir
+
+
+@cache.command()
+@click.option("--list_entries", "-l", is_flag=True, help="Also list every cache entry")
+def stats(list_entries):
+    """
+    Show the size and number of entries in the cache.
+    """
+    stats = GraphCache.cacheStats()
+    click.echo(tabulate([[key, value] for key, value in stats.items()]))
+    if list_entries:
+        rows = [[e['kind'], e['bytes'], e['path']] for e in GraphCache.listEntries()]
+        click.echo()
+        click.echo(tabulate(rows, headers=["Kind", "Bytes", "Path"]))
+
+
+@cache.command()
+@click.option("--max_bytes", "-m", required=False,
+              help="Byte budget to prune down to (e.g. 500M, 8G). Defaults to PYNIDM_CACHE_MAX_BYTES")
+def prune(max_bytes):
+    """
+    Evict the least recently used entries until the cache fits in the byte budget.
+    """
+    removed = GraphCache.prune(GraphCache.parseSize(max_bytes) if max_bytes else None)
+    for f in removed:
+        click.echo("removed {}".format(f))
+    click.echo("{} entries removed".format(len(removed)))
+
+
+@cache.command()
+@click.option("--nidm_file_list", "-nl", required=True,
+              help="A comma separated list of NIDM files with full path")
+@click.option("--cde_file_list", "-nc", required=False,
+              help="A comma separated list of NIDM CDE files with full path")
+def warm(nidm_file_list, cde_file_list):
+    """
+    Parse NIDM files into the cache ahead of time.
+    """
+    for nidm_file in nidm_file_list.split(','):
+        OpenGraph(nidm_file)
+        click.echo("cached {}".format(nidm_file))
+    getNavigationIndex(tuple(nidm_file_list.split(',')))
+    click.echo("cached navigation index")
+    if cde_file_list:
+        getCDEs(cde_file_list.split(','))
+        click.echo("cached CDE graph")
+
+
+@cache.command()
+def clear():
+    """
+    Remove every entry from the cache.
+    """
+    count = GraphCache.clear()
+    click.echo("{} entries removed".format(count))
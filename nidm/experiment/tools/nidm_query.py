@@ -42,9 +42,28 @@ import click
 from click_option_group import optgroup, RequiredMutuallyExclusiveOptionGroup
 from nidm.experiment.tools.click_base import cli
 from nidm.experiment.tools.rest import RestParser
+from nidm.experiment.tools import rest_export
 from json import dumps, loads
 
 
+def writeExport(result, output_file):
+    """
+    Writes the table of an export query to a file, or a CSV table to the standard output
+    """
+    if not isinstance(result, rest_export.Export):
+        # the query failed
+        raise click.ClickException(result['error'] if isinstance(result, dict) and 'error' in result else str(result))
+    if output_file is None:
+        if result.format != 'csv':
+            raise click.UsageError("Writing {} needs an --output_file".format(result.format))
+        for chunk in result.chunks:
+            sys.stdout.write(chunk.decode('utf-8'))
+        return
+    with open(output_file, 'wb') as f:
+        for chunk in result.chunks:
+            f.write(chunk)
+
+
 @cli.command()
 @click.option("--nidm_file_list", "-nl", required=True,
               help="A comma separated list of NIDM files with full path")
@@ -73,9 +92,15 @@ from json import dumps, loads
               help="Optional output file (CSV) to store results of query")
 @click.option("-j/-no_j", required=False, default=False,
               help="Return result of a uri query as JSON")
+@click.option("--export", "-e", required=False, type=click.Choice(list(rest_export.FORMATS)),
+              help="Write the fields of a --get_fields query to the output file as a typed table in this format, "
+                   "a column per field and a row per subject")
+@click.option("--jobs", required=False, type=int, default=1,
+              help="Number of worker processes used to run a SPARQL query file against each NIDM file separately. "
+                   "With more than 1 job, joins across files are not found")
 @click.option('-v', '--verbosity', required=False, help="Verbosity level 0-5, 0 is default", default="0")
 
-def query(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, verbosity):
+def query(nidm_file_list, cde_file_list, query_file, output_file, get_participants, get_instruments, get_instrument_vars, get_dataelements, get_brainvols,get_dataelements_brainvols, get_fields, uri, j, export, jobs, verbosity):
     """
     This function provides query support for NIDM graphs.
     """
@@ -143,6 +168,21 @@ def query(nidm_file_list, cde_file_list, query_file, output_file, get_participan
             datael.to_csv(output_file)
         else:
             print(datael.to_string())
+    elif get_fields and export:
+        if output_file is None:
+            raise click.UsageError("--export needs an --output_file")
+        restParser = RestParser(verbosity_level=int(verbosity))
+        projects = GetProjectsUUID(nidm_file_list.split(','))
+        for project in projects:
+            project = project.toPython().split("/")[-1]
+            uri = "/projects/{}/export?fields={}&format={}".format(project, get_fields, export)
+            # a file for each project if there are several
+            if len(projects) > 1:
+                base, extension = os.path.splitext(output_file)
+                writeExport(restParser.run(nidm_file_list.split(','), uri), "{}_{}{}".format(base, project, extension))
+            else:
+                writeExport(restParser.run(nidm_file_list.split(','), uri), output_file)
+
     elif get_fields:
         # fields only query.  We'll do it with the rest api
         restParser = RestParser(verbosity_level=int(verbosity))
@@ -178,7 +218,9 @@ def query(nidm_file_list, cde_file_list, query_file, output_file, get_participan
         else:
             restParser.setOutputFormat(RestParser.CLI_FORMAT)
         df = restParser.run(nidm_file_list.split(','), uri)
-        if (output_file is not None):
+        if isinstance(df, rest_export.Export):
+            writeExport(df, output_file)
+        elif (output_file is not None):
             if j:
                 with open(output_file,"w+") as f:
                     f.write(dumps(df))
@@ -206,7 +248,7 @@ def query(nidm_file_list, cde_file_list, query_file, output_file, get_participan
             print(brainvol.to_string())
     elif query_file:
 
-        df = sparql_query_nidm(nidm_file_list.split(','),query_file,output_file)
+        df = sparql_query_nidm(nidm_file_list.split(','),query_file,output_file,jobs=jobs)
 
         if ((output_file) is None):
 
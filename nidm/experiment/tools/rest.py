@@ -1,27 +1,35 @@
 import nidm.experiment.Navigate
 from nidm.experiment import Query
+from nidm.experiment import Filter
+from nidm.experiment import GraphCache
+from nidm.experiment import Metrics
 from nidm.core import Constants
 import json
 import re
 from urllib import parse
 import pprint
 import os
-from tempfile import gettempdir
 from tabulate import tabulate
 from copy import copy, deepcopy
 from urllib.parse import urlparse, parse_qs
 from  nidm.experiment import Navigate
+from nidm.experiment.tools.rest_cache import ResponseCache
+from nidm.experiment.tools import rest_export
 
 
-from numpy import std, mean, median
+from numpy import std, mean, median, isnan
+import pandas as pd
 import functools
+import collections
+import bisect
+import time
 import operator
 
-from joblib import Memory
-memory = Memory(gettempdir(), verbose=0)
-USE_JOBLIB_CACHE = False
-
 import simplejson
+import base64
+
+# shared by all the RestParsers of a process
+RESPONSE_CACHE = ResponseCache()
 
 def convertListtoDict(lst):
     '''
@@ -37,10 +45,13 @@ class RestParser:
     OBJECT_FORMAT = 0
     JSON_FORMAT = 1
     CLI_FORMAT = 2
+    # newline delimited JSON, results are returned as a generator of lines
+    NDJSON_FORMAT = 3
 
-    def __init__(self, verbosity_level = 0, output_format = 0):
+    def __init__(self, verbosity_level = 0, output_format = 0, response_cache = RESPONSE_CACHE):
         self.verbosity_level = verbosity_level
         self.output_format = output_format
+        self.response_cache = response_cache
         self.restLog ("Setting output format {}".format(self.output_format), 4)
 
     def setOutputFormat(self, output_format):
@@ -189,6 +200,17 @@ class RestParser:
             else:
                 return self.format(result)
 
+    def batchFormat(self, result):
+        if self.output_format == self.CLI_FORMAT:
+            table = tabulate(result['columns'], headers="keys")
+            if result['not_found']:
+                table += "\n\nSubjects not found: {}".format(", ".join(result['not_found']))
+            return table
+        if self.output_format == self.NDJSON_FORMAT:
+            columns = result['columns']
+            return self.streamFormat(dict(zip(columns.keys(), row)) for row in zip(*columns.values()))
+        return self.format(result)
+
     def formatDerivatives(self, derivative):
         self.restLog("formatting derivatives in format {}".format(self.output_format), 5)
         if self.output_format == self.CLI_FORMAT:
@@ -334,36 +356,42 @@ class RestParser:
             return uri[uri.rfind('/') + 1:]
 
 
+    def fieldColumns(self, elements, field, type):
+        '''
+        Finds the columns of a project data table holding a field
+
+        :param elements: elements of a Query.ProjectDataTable
+        :param field: instrument key, or derivative label or URI tail
+        :param type: STAT_TYPE_INSTRUMENTS or STAT_TYPE_DERIVATIVES
+        :return: list of column names
+        '''
+        if type == self.STAT_TYPE_INSTRUMENTS:
+            return list(elements.index[(elements['category'] == 'instruments') & (elements['key'] == field)])
+        # derivatives can be asked for by label or by the tail of their URI
+        if type == self.STAT_TYPE_DERIVATIVES:
+            return list(elements.index[(elements['category'] == 'derivatives') & ((elements['label'] == field) | (elements['key'] == field))])
+        return []
+
     def addFieldStats(self, result, project, subjects, field, type):
         '''
-        Geneerates basic stats on a group of subjects and adds it to the result
+        Geneerates basic stats on a group of subjects and adds it to the result.  The values are read
+        from the project's wide data table and the stats computed on them in one vectorized pass.
         :param result:
         :param subjects:
         :param field:
         :return:
         '''
-        values = []
-        for s in subjects:
-            if type == self.STAT_TYPE_INSTRUMENTS:
-                data = Query.GetParticipantInstrumentData(tuple(self.nidm_files), project, s)
-                for i in data:
-                    if field in data[i]:
-                        values.append( float(data[i][field]) )
-            # derivatives are of the form [UUID]['values'][URI]{datumType, label, values, units}
-            if type == self.STAT_TYPE_DERIVATIVES:
-                data = Query.GetDerivativesDataForSubject(tuple(self.nidm_files), project, s)
-                for deriv in data:
-                    for URI in data[deriv]['values']:
-                        measures = data[deriv]['values'][URI]
-                        if field == measures['label'] or field == self.getTailOfURI(URI):
-                            values.append( float(measures['value']) )
+        table = Query.GetProjectDataTable(self.nidm_files, project)
+        columns = self.fieldColumns(table.elements, field, type)
+        values = table.numbers.loc[table.numbers.index.isin([str(s) for s in subjects]), columns].to_numpy().ravel()
+        values = values[~isnan(values)]
 
         if len(values) > 0:
             med = median(values)
             avg = mean(values)
             st = std(values)
-            mn = min(values)
-            mx = max(values)
+            mn = values.min()
+            mx = values.max()
         else:
             med = avg = st = mn = mx = None
         result[field] = {"max": mx, "min": mn, "median": med, "mean": avg, "standard_deviation": st}
@@ -386,41 +414,196 @@ class RestParser:
             result['field_values'] = []
             # get all the synonyms for all the fields
             field_synonyms = functools.reduce( operator.iconcat, [ Query.GetDatatypeSynonyms(self.nidm_files, id, x) for x in self.query['fields'] ], [])
-            for sub in result['subjects']['uuid']:
-
-                for activity in Navigate.getActivities(self.nidm_files, sub):
-                    activity = Navigate.getActivityData(self.nidm_files, activity)
-                    for data_element in activity.data:
-                        if data_element.dataElement in field_synonyms:
-                            result['field_values'].append(data_element._replace(subject=sub))
-
+            table = Query.GetProjectDataTable(self.nidm_files, id)
+            elements = table.elements[table.elements['data_element'].isin(field_synonyms)]
+
+            if self.paginated() or self.output_format == self.NDJSON_FORMAT:
+                if len(elements) == 0:
+                    raise ValueError("Supplied field not found. (" + ", ".join(self.query['fields']) + ")")
+                page, next_cursor = self.pageOfSubjects(result['subjects']['uuid'])
+                field_values = self.fieldValues(table, elements, page, ordered=True)
+                if self.output_format == self.NDJSON_FORMAT:
+                    return self.streamFormat(field_values)
+                return self.format({'field_values': list(field_values), 'next': next_cursor})
+
+            result['field_values'].extend(self.fieldValues(table, elements, result['subjects']['uuid']))
             if len(result['field_values']) == 0:
                 raise ValueError("Supplied field not found. (" + ", ".join(self.query['fields']) + ")")
 
         return self.projectSummaryFormat(result)
 
 
+    def fieldValues(self, table, elements, subjects, ordered=False):
+        '''
+        Generates the values of data elements for some subjects, one subject at a time
+
+        :param table: Query.ProjectDataTable of the project
+        :param elements: rows of table.elements to return
+        :param subjects: subject UUIDs
+        :param ordered: generate the subjects in UUID order instead of the table's order
+        :return: generator of Navigate.ValueType
+        '''
+        values = table.values.loc[table.values.index.isin(subjects), elements.index]
+        if ordered:
+            values = values.sort_index(kind='stable')
+        for sub, row in zip(values.index, values.itertuples(index=False)):
+            for element, value in zip(elements.itertuples(), row):
+                if isinstance(value, str):
+                    if element.category == 'instruments':
+                        value = Query.trimWellKnownURIPrefix(value)
+                    data_element = Navigate.makeValueTypeFromDataTypeInfo(value, dict(element.data_type_info))
+                    yield data_element._replace(subject=sub)
+
     def subjectsList(self):
         match = re.match(r"^/?projects/([^/]+)/subjects/?$", self.command)
         project = match.group((1))
         self.restLog("Returning all agents matching filter '{}' for project {}".format(self.query['filter'], project), 2)
-        # result = Query.GetParticipantUUIDsForProject(self.nidm_files, project, self.query['filter'], None)
-        all_subjects = Navigate.getSubjects(self.nidm_files, project)
-        result = {}
-        result['uuid'] = []
-        result['subject id'] = []
-        for sub_uuid in all_subjects:
-            if Query.CheckSubjectMatchesFilter(self.nidm_files,project, sub_uuid, self.query['filter']):
-                uuid_string = (str(sub_uuid)).split('/')[-1]  # srip off the http://whatever/whatever/
-                result['uuid'].append(uuid_string)
-                sid = Navigate.getSubjectIDfromUUID(self.nidm_files, sub_uuid)
-                result['subject id'].append(str(sid))
-        return self.format(result)
+        result = Query.GetProjectSubjectsMatchingFilter(self.nidm_files, project, self.query['filter'], acquisitions_only=True)
+        if not self.paginated() and self.output_format != self.NDJSON_FORMAT:
+            return self.format(result)
+
+        subject_ids = dict(zip(result['uuid'], result['subject id']))
+        page, next_cursor = self.pageOfSubjects(result['uuid'])
+        if self.output_format == self.NDJSON_FORMAT:
+            return self.streamFormat({'uuid': sub, 'subject id': subject_ids[sub]} for sub in page)
+        return self.format({'uuid': page, 'subject id': [subject_ids[sub] for sub in page], 'next': next_cursor})
+
+    def batchSubjects(self, project):
+        '''
+        Finds the subjects asked for with the subjects query parameter, by UUID or by subject id
+
+        :return: (dictionary of UUID -> subject id of the project's subjects, UUIDs asked for, subjects not found)
+        '''
+        participants = Query.GetParticipantUUIDsForProject(self.nidm_files, project_id=project, filter=self.query['filter'])
+        subject_ids = dict(zip(participants['uuid'], participants['subject id']))
+        if not self.query['subjects']:
+            return subject_ids, list(subject_ids), []
+
+        uuids_by_id = dict((sid, sub) for sub, sid in subject_ids.items())
+        uuids = []
+        not_found = []
+        for sub in self.query['subjects']:
+            if sub in subject_ids or sub in uuids_by_id:
+                uuids.append(sub if sub in subject_ids else uuids_by_id[sub])
+            else:
+                not_found.append(sub)
+        return subject_ids, uuids, not_found
+
+    def batchFields(self, project, elements):
+        '''
+        Finds the columns of a project data table holding the fields query parameter, every data
+        element if no fields were asked for
+
+        :param elements: elements of a Query.ProjectDataTable
+        :return: list of (field, list of column names)
+        '''
+        if not self.query['fields']:
+            return [(key, [column]) for column, key in zip(elements.index, elements['key'])]
+
+        fields = []
+        for field in self.query['fields']:
+            bits = field.split('.', 1)
+            stat_type = self.getStatType(bits[0]) if len(bits) > 1 else self.STAT_TYPE_OTHER
+            if stat_type != self.STAT_TYPE_OTHER:
+                columns = self.fieldColumns(elements, bits[1], stat_type)
+            else:
+                synonyms = Query.GetDatatypeSynonyms(self.nidm_files, project, field)
+                columns = list(elements.index[elements['data_element'].isin(synonyms) | (elements['key'] == field) | (elements['label'] == field)])
+            if len(columns) == 0:
+                raise ValueError("Supplied field not found. ({})".format(field))
+            fields.append((field, columns))
+        return fields
+
+    def batchValues(self, table, uuids, fields):
+        '''
+        Reads the value strings of some fields for some subjects from a project data table
+
+        :return: OrderedDict of field -> list of values, str or None, in the order of uuids
+        '''
+        # a subject with several instruments or stats collections has a row for each, keep the
+        # first value of each column
+        requested = list(collections.OrderedDict.fromkeys(column for field, columns in fields for column in columns))
+        values = table.values[requested].groupby(level=0, sort=False).first().reindex(uuids)
+        for column in requested:
+            if table.elements.loc[column, 'category'] == 'instruments':
+                values[column] = values[column].map(lambda v: Query.trimWellKnownURIPrefix(v) if isinstance(v, str) else v)
+
+        result = collections.OrderedDict()
+        for field, columns in fields:
+            if field not in result:
+                # the first of the field's columns that has a value
+                column = values[columns].bfill(axis=1).iloc[:, 0]
+                result[field] = [value if isinstance(value, str) else None for value in column]
+        return result
+
+    def projectBatch(self):
+        '''
+        Returns the values of several fields for several subjects of a project at once, as columns
+        with a row per subject.  Everything is read from the project's data table in one pass.
+        Fields can be given as in statistics queries (instruments.AGE, derivatives.fs_000003) or
+        like the fields of a project summary, subjects by UUID or by subject id.  Without subjects
+        all of the project's subjects are returned, without fields all of its data elements.
+        '''
+        match = re.match(r"^/?projects/([^/]+)/batch/?$", self.command)
+        project = parse.unquote(str(match.group(1)))
+        self.restLog("Returning fields {} of {} subjects of project {}".format(self.query['fields'], len(self.query['subjects']), project), 2)
+
+        subject_ids, uuids, not_found = self.batchSubjects(project)
+        table = Query.GetProjectDataTable(self.nidm_files, project)
+        fields = self.batchFields(project, table.elements)
+
+        result = collections.OrderedDict([('uuid', uuids), ('subject id', [subject_ids[sub] for sub in uuids])])
+        for field, values in self.batchValues(table, uuids, fields).items():
+            result.setdefault(field, values)
+
+        return self.batchFormat({'columns': result, 'not_found': not_found})
+
+    def projectExport(self):
+        '''
+        Exports fields of a project's subjects as a typed table with a row per subject, see
+        rest_export.  Fields and subjects are picked as for projectBatch and the format with the
+        format query parameter (csv, arrow or parquet).  Whatever the output format of the parser,
+        the result is a rest_export.Export whose chunks are written while they are sent.
+        '''
+        match = re.match(r"^/?projects/([^/]+)/export/?$", self.command)
+        project = parse.unquote(str(match.group(1)))
+        format = self.query['format'] or 'csv'
+        if format not in rest_export.FORMATS:
+            return self.format({"error": "format must be one of {}".format(", ".join(rest_export.FORMATS))})
+        if format != 'csv' and rest_export.pyarrow is None:
+            return self.format({"error": "Exporting {} needs the pyarrow package".format(format)})
+        self.restLog("Exporting fields {} of project {} as {}".format(self.query['fields'], project, format), 2)
+
+        subject_ids, uuids, not_found = self.batchSubjects(project)
+        table = Query.GetProjectDataTable(self.nidm_files, project)
+        fields = self.batchFields(project, table.elements)
+
+        frame = collections.OrderedDict([('uuid', uuids), ('subject id', [str(subject_ids[sub]) for sub in uuids])])
+        metadata = {}
+        for field, values in self.batchValues(table, uuids, fields).items():
+            if field in frame:
+                continue
+            values = pd.Series(values, dtype=object)
+            numbers = pd.to_numeric(values, errors='coerce')
+            # a column of numbers (and missing values written as nan) is exported as numbers
+            missing = values.isna() | values.str.strip().str.lower().isin(['', 'nan'])
+            frame[field] = numbers.astype('float64') if (~missing).any() and numbers[~missing].notna().all() else values
+            columns = next(columns for name, columns in fields if name == field)
+            info = table.elements.loc[columns[0], 'data_type_info'] or {}
+            units = [(table.elements.loc[column, 'data_type_info'] or {}).get('hasUnit') for column in columns]
+            metadata[field] = {'unit': next((unit for unit in units if unit), None), 'label': info.get('label'),
+                               'data_element': info.get('dataElement')}
+
+        return rest_export.makeExport(pd.DataFrame(frame), format, metadata, self.getTailOfURI(project))
 
     def projectSubjectSummary(self):
         match = re.match(r"^/?projects/([^/]+)/subjects/([^/]+)/?$", self.command)
         self.restLog("Returning info about subject {}".format(match.group(2)), 2)
-        return self.subjectSummaryFormat(Query.GetParticipantDetails(self.nidm_files, match.group(1), match.group(2)))
+        try:
+            details = Query.GetParticipantDetails(self.nidm_files, match.group(1), match.group(2))
+        except Query.AmbiguousUUIDError as e:
+            return self.format({"error": str(e)})
+        return self.subjectSummaryFormat(details)
 
     def subjectSummary(self):
         match = re.match(r"^/?subjects/([^/]+)/?$", self.command)
@@ -478,7 +661,7 @@ class RestParser:
         try:
             self.restLog("parsing command " + command, 1)
             self.restLog("Files to read:" + str(nidm_files), 1)
-            self.restLog("Using {} as the graph cache directory".format(gettempdir()), 1)
+            self.restLog("Using {} as the graph cache directory".format(GraphCache.CACHE_DIR), 1)
 
             self.nidm_files = tuple(nidm_files)
             u = urlparse(command)
@@ -496,33 +679,143 @@ class RestParser:
             else:
                 self.query['fields'] = []
 
-            return self.route()
+            if 'subjects' in self.query:
+                self.query['subjects'] = str.split(self.query['subjects'][0], ',')
+            else:
+                self.query['subjects'] = []
+
+            self.query['format'] = self.query['format'][0] if 'format' in self.query else None
+
+            try:
+                self.parsePagination()
+            except (TypeError, ValueError):
+                return self.format({"error": "limit and offset must be non-negative integers and cursor a value returned as next."})
+
+            start = time.perf_counter()
+            self.response_cache_result = 'off'
+            try:
+                return self.cachedRoute(command)
+            finally:
+                Metrics.REST_REQUEST_SECONDS.observe(time.perf_counter() - start, route=self.routeName() or 'none',
+                                                     response_cache=self.response_cache_result)
+        except Filter.FilterSyntaxError as e:
+            return self.format({"error": str(e)})
         except ValueError:
             return (self.format({"error": "One of the supplied field terms was not found."}))
 
 
 
-    def route(self):
-
-        if re.match(r"^/?projects/?$", self.command): return self.projects()
-
-        if re.match(r"^/?statistics/projects/[^/]+$", self.command): return self.projectStats()
+    def run_batch(self, nidm_files, project, subjects=None, fields=None, filter=None):
+        '''
+        Gets the values of several fields for several subjects in one call instead of a call for
+        each subject and instrument
+
+        :param nidm_files: list of NIDM files
+        :param project: project UUID
+        :param subjects: list of subject UUIDs or subject ids, all the project's subjects if None
+        :param fields: list of fields, e.g. instruments.AGE_AT_SCAN or fs_000003, every data element if None
+        :param filter: optional filter on the subjects, as in other queries
+        :return: {'columns': {'uuid': [...], 'subject id': [...], field: [...], ...}, 'not_found': [subjects that aren't in the project]}
+            in the parser's output format
+        '''
+        params = []
+        if subjects:
+            params.append(('subjects', ','.join(str(sub) for sub in subjects)))
+        if fields:
+            params.append(('fields', ','.join(fields)))
+        if filter:
+            params.append(('filter', filter))
+        return self.run(nidm_files, "/projects/{}/batch?{}".format(parse.quote(str(project)), parse.urlencode(params)))
+
+    def cachedRoute(self, command):
+        '''
+        Answers the command from the response cache if it can, otherwise routes it and caches the result
+        '''
+        # streamed results are generated while they are sent and can't be kept
+        if self.response_cache is None or self.output_format == self.NDJSON_FORMAT or self.routeName() == 'projectExport':
+            return self.route()
 
-        if re.match(r"^/?projects/[^/]+$", self.command): return self.projectSummary()
+        key = self.response_cache.key(self.nidm_files, command, self.output_format)
+        hit, response = self.response_cache.get(key)
+        self.response_cache_result = 'hit' if hit else 'miss'
+        if hit:
+            self.restLog("Returning cached response", 2)
+            return response if isinstance(response, str) else deepcopy(response)
 
-        if re.match(r"^/?subjects/[^/]+$", self.command): return self.subjectSummary()
+        response = self.route()
+        self.response_cache.put(key, response if isinstance(response, str) else deepcopy(response))
+        return response
 
-        if re.match(r"^/?projects/[^/]+/subjects/?$", self.command): return self.subjectsList()
+    def parsePagination(self):
+        '''
+        Normalizes the limit, offset and cursor query parameters
+        '''
+        for param in ('limit', 'offset'):
+            if param in self.query:
+                self.query[param] = int(self.query[param][0])
+                if self.query[param] < 0:
+                    raise ValueError("{} can't be negative".format(param))
+                if param == 'limit' and self.query[param] == 0:
+                    # a page has to hold at least one subject for its cursor to move on
+                    raise ValueError("limit can't be 0")
+            else:
+                self.query[param] = None
+        if 'cursor' in self.query:
+            self.query['cursor'] = base64.urlsafe_b64decode(self.query['cursor'][0].encode('ascii')).decode('utf-8')
+        else:
+            self.query['cursor'] = None
 
-        if re.match(r"^/?projects/[^/]+/subjects/[^/]+/?$", self.command): return self.projectSubjectSummary()
+    def paginated(self):
+        return any(self.query.get(param) is not None for param in ('limit', 'offset', 'cursor'))
 
-        if re.match(r"^/?projects/[^/]+/subjects/[^/]+/instruments/?$", self.command): return self.instrumentsList()
+    def pageOfSubjects(self, subjects):
+        '''
+        Applies the limit, offset and cursor query parameters to a list of subjects.  Pages are
+        taken in UUID order so they don't depend on the order query results come back in.
 
-        if re.match(r"^/?projects/[^/]+/subjects/[^/]+/instruments/[^/]+/?$", self.command): return self.instrumentSummary()
+        :param subjects: subject UUIDs
+        :return: (UUIDs on the page, cursor of the next page or None)
+        '''
+        subjects = sorted(set(str(sub) for sub in subjects))
+        if self.query['cursor'] is not None:
+            subjects = subjects[bisect.bisect_right(subjects, self.query['cursor']):]
+        if self.query['offset']:
+            subjects = subjects[self.query['offset']:]
+        if self.query['limit'] is None or len(subjects) <= self.query['limit']:
+            return subjects, None
+        page = subjects[:self.query['limit']]
+        return page, base64.urlsafe_b64encode(page[-1].encode('utf-8')).decode('ascii')
+
+    # command patterns and the methods answering them, in the order they are tried
+    ROUTES = [
+        (r"^/?projects/?$", 'projects'),
+        (r"^/?statistics/projects/[^/]+$", 'projectStats'),
+        (r"^/?projects/[^/]+$", 'projectSummary'),
+        (r"^/?subjects/[^/]+$", 'subjectSummary'),
+        (r"^/?projects/[^/]+/subjects/?$", 'subjectsList'),
+        (r"^/?projects/[^/]+/batch/?$", 'projectBatch'),
+        (r"^/?projects/[^/]+/export/?$", 'projectExport'),
+        (r"^/?projects/[^/]+/subjects/[^/]+/?$", 'projectSubjectSummary'),
+        (r"^/?projects/[^/]+/subjects/[^/]+/instruments/?$", 'instrumentsList'),
+        (r"^/?projects/[^/]+/subjects/[^/]+/instruments/[^/]+/?$", 'instrumentSummary'),
+        (r"^/?projects/[^/]+/subjects/[^/]+/derivatives/?$", 'derivativesList'),
+        (r"^/?projects/[^/]+/subjects/[^/]+/derivatives/[^/]+/?$", 'derivativeSummary'),
+    ]
+
+    def routeName(self):
+        '''
+        :return: name of the method answering the current command, or None if there isn't one
+        '''
+        for pattern, name in self.ROUTES:
+            if re.match(pattern, self.command):
+                return name
+        return None
 
-        if re.match(r"^/?projects/[^/]+/subjects/[^/]+/derivatives/?$", self.command): return self.derivativesList()
+    def route(self):
 
-        if re.match(r"^/?projects/[^/]+/subjects/[^/]+/derivatives/[^/]+/?$", self.command): return self.derivativeSummary()
+        name = self.routeName()
+        if name is not None:
+            return getattr(self, name)()
 
         self.restLog("NO MATCH!", 2)
 
@@ -535,7 +828,20 @@ class RestParser:
 
 
 
+    def streamFormat(self, rows):
+        '''
+        Formats rows as newline delimited JSON while they are generated
+
+        :param rows: iterable of JSON serializable rows
+        :return: generator of lines
+        '''
+        for row in rows:
+            yield simplejson.dumps(row) + "\n"
+
     def format(self, result, headers = [""]):
+        if self.output_format == RestParser.NDJSON_FORMAT:
+            return self.streamFormat(result if type(result) == list else [result])
+
         if self.output_format == RestParser.JSON_FORMAT:
             json_str = simplejson.dumps(result, indent=2)
             return json_str
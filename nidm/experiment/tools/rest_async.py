@@ -0,0 +1,406 @@
+'''
+Asynchronous ASGI front end for the NIDM REST API
+
+The app answers the same routes as rest-server.py, but RestParser queries never run on the event
+loop.  Each request is dispatched to one of two bounded worker pools, one for heavy requests
+(statistics and requests for fields) and one for everything else, so browsing stays responsive
+while stats queries run.  A pool only queues a limited number of requests beyond the ones it is
+running and answers the rest with 503 straight away.  Every request has a timeout, and a request
+that times out or whose client disconnects is cancelled if it hasn't started running yet.
+
+It is a plain ASGI application without framework dependencies, so it can be served by any ASGI
+server, e.g.
+
+    uvicorn nidm.experiment.tools.rest_async:app --host 0.0.0.0 --port 5000
+
+The NIDM files are found and kept loaded by a DatasetRegistry, see PYNIDM_TTL_FILES below.
+'''
+import os
+import re
+import sys
+import asyncio
+import logging
+import itertools
+from urllib.parse import unquote
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from nidm.experiment import Query, GraphCache, Metrics
+from nidm.experiment.DatasetRegistry import DatasetRegistry
+from nidm.experiment.tools.rest import RestParser, RESPONSE_CACHE
+from nidm.experiment.tools import rest_http, rest_export
+
+# glob pattern of the NIDM files to serve
+TTL_FILES = os.environ.get('PYNIDM_TTL_FILES', '/opt/project/ttl/**/*.ttl')
+# 'thread' or 'process' workers, processes run queries in parallel but each one loads the graphs
+POOL_KIND = os.environ.get('PYNIDM_REST_POOL', 'thread')
+WORKERS = int(os.environ.get('PYNIDM_REST_WORKERS', 4))
+HEAVY_WORKERS = int(os.environ.get('PYNIDM_REST_HEAVY_WORKERS', 2))
+# requests that may wait for a worker in each pool before new ones are turned away
+MAX_QUEUE = int(os.environ.get('PYNIDM_REST_MAX_QUEUE', 16))
+# seconds a request may take, including the time it waits for a worker
+TIMEOUT = float(os.environ.get('PYNIDM_REST_TIMEOUT', 120))
+
+# lines of a streamed response read from the worker at a time
+STREAM_CHUNK = 100
+
+HEAVY_PATH = re.compile(r'^/?(statistics/|projects/[^/]+/(batch|export))')
+HEAVY_QUERY = re.compile(r'(^|&)fields=')
+
+
+class Overloaded(Exception):
+    pass
+
+
+def runRestQuery(files, command):
+    '''
+    Runs a REST API command in a pool worker
+
+    :param files: tuple of NIDM files
+    :param command: REST API path and query string
+    :return: JSON text of the result
+    '''
+    restParser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    return rest_http.dumpResult(restParser.run(files, command))
+
+
+def runRestBatch(files, project, batch):
+    '''
+    Runs a batch request in a pool worker
+
+    :param batch: keyword arguments for RestParser.run_batch
+    :return: JSON text of the result
+    '''
+    restParser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    return rest_http.dumpResult(restParser.run_batch(files, project, **batch))
+
+
+def streamRestQuery(files, command):
+    '''
+    Starts a REST API command with newline delimited JSON output in a pool thread
+
+    :return: generator of lines
+    '''
+    return RestParser(output_format=RestParser.NDJSON_FORMAT).run(files, command)
+
+
+def runRestStream(files, command):
+    '''
+    Runs a REST API command with newline delimited JSON output in a pool process, generators
+    can't be sent back from there
+
+    :return: text of all the lines
+    '''
+    return ''.join(streamRestQuery(files, command))
+
+
+def streamRestExport(files, command):
+    '''
+    Starts a REST API export in a pool thread
+
+    :return: rest_export.Export, or the JSON text of an error
+    '''
+    result = RestParser(output_format=RestParser.OBJECT_FORMAT).run(files, command)
+    return result if isinstance(result, rest_export.Export) else rest_http.dumpResult(result)
+
+
+def runRestExport(files, command):
+    '''
+    Runs a REST API export in a pool process, with the chunks of the table joined
+
+    :return: rest_export.Export, or the JSON text of an error
+    '''
+    result = streamRestExport(files, command)
+    if isinstance(result, rest_export.Export):
+        return result._replace(chunks=b''.join(result.chunks))
+    return result
+
+
+def readLines(lines, count=STREAM_CHUNK):
+    '''
+    :return: the next count lines of a generator joined, '' once it is exhausted
+    '''
+    return ''.join(itertools.islice(lines, count))
+
+
+class QueryPool(object):
+    '''
+    A worker pool that holds at most max_queue requests beyond the ones it is running
+    '''
+
+    def __init__(self, workers, max_queue, kind='thread'):
+        self.workers = workers
+        self.max_queue = max_queue
+        if kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=Query.initQueryWorker,
+                                                initargs=(Query.GRAPH_STORE, GraphCache.CACHE_DIR, Query.INFER_TYPES))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nidm-rest')
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, timeout, function, *args):
+        '''
+        Runs function(*args) in the pool
+
+        :raises Overloaded: if the pool's queue is full
+        :raises asyncio.TimeoutError: if the result isn't ready within timeout seconds
+        '''
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                raise Overloaded()
+            self.pending += 1
+        future = self.executor.submit(function, *args)
+        # a request still waiting for a worker is dropped if its asyncio future is cancelled
+        future.add_done_callback(self._done)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class NIDMRestApp(object):
+    '''
+    ASGI application serving the REST API for the files of a DatasetRegistry
+    '''
+
+    def __init__(self, registry, workers=WORKERS, heavy_workers=HEAVY_WORKERS, max_queue=MAX_QUEUE,
+                 timeout=TIMEOUT, pool_kind=POOL_KIND):
+        self.registry = registry
+        self.workers = workers
+        self.heavy_workers = heavy_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pool_kind = pool_kind
+        self.pools = None
+        registry.listeners.append(lambda snapshot: RESPONSE_CACHE.clear())
+
+    def start(self):
+        if self.pools is None:
+            self.pools = {'light': QueryPool(self.workers, self.max_queue, self.pool_kind),
+                          'heavy': QueryPool(self.heavy_workers, self.max_queue, self.pool_kind)}
+            self.registry.start(background=True)
+
+    def stop(self):
+        if self.pools is not None:
+            self.registry.stop()
+            for pool in self.pools.values():
+                pool.shutdown()
+            self.pools = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            # servers without lifespan support start us on the first request
+            self.start()
+            response = await self.handle(scope, receive)
+            if response is not None:
+                headers = dict(scope.get('headers', []))
+                accept_encoding = headers.get(b'accept-encoding', b'').decode('latin-1')
+                await self.respond(send, accept_encoding, *response, head=scope['method'] == 'HEAD')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def respond(self, send, accept_encoding, status, body, headers=(), head=False):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        streamed = hasattr(body, '__aiter__')
+        if not any(name == b'content-type' for name, value in headers):
+            headers.insert(0, (b'content-type', (rest_http.NDJSON_TYPE if streamed else 'application/json').encode('latin-1')))
+
+        if head:
+            # the headers a GET would get, a streamed body is never read
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if streamed:
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            async for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if status == 304:
+            body = b''
+        else:
+            if not isinstance(body, str):
+                body = rest_http.dumpResult(body)
+            body, encoding = rest_http.encodeBody(body, accept_encoding)
+            if encoding:
+                headers.append((b'content-encoding', encoding.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def handle(self, scope, receive):
+        '''
+        Answers one request
+
+        :return: (status, body, headers), or None if the client went away
+        '''
+        path = scope['path']
+        query = scope.get('query_string', b'').decode('latin-1')
+        batch_match = rest_http.BATCH_PATH.match(path)
+        if scope['method'] == 'POST' and batch_match:
+            return await self.handleBatch(unquote(batch_match.group(1)), receive)
+        if scope['method'] not in ('GET', 'HEAD'):
+            return 405, {'error': 'Only GET requests are supported, and POST requests to /projects/[Project-UUID]/batch'}
+        if path in ('', '/'):
+            return 200, {'message': 'You probably want to start at /projects  See instructions at PyNIDM/docker/README.md for details on the API and loading data.'}
+        if path == '/ready':
+            status = self.registry.status()
+            return (200 if status['ready'] else 503), status
+        if path == '/metrics':
+            return 200, Metrics.render(), [('Content-Type', Metrics.CONTENT_TYPE)]
+        if not self.registry.ready.is_set():
+            return 503, {'error': 'NIDM files are still being loaded, see /ready'}, [('Retry-After', '5')]
+
+        snapshot = self.registry.snapshot
+        files = snapshot.files
+        if len(files) == 0:
+            return 200, {'error': 'No NIDM files found. You may need to add NIDM ttl files to ~/PyNIDM/ttl'}
+
+        command = '{}?{}'.format(path, query) if query else path
+        headers = dict(scope.get('headers', []))
+        stream = rest_http.wantsStream(headers.get(b'accept', b'').decode('latin-1'))
+        etag = rest_http.entityTag(snapshot, command, stream=stream)
+        validators = rest_http.responseHeaders(etag, rest_http.lastModified(snapshot))
+        if rest_http.notModified(snapshot, etag, headers.get(b'if-none-match', b'').decode('latin-1'),
+                                 headers.get(b'if-modified-since', b'').decode('latin-1')):
+            return 304, None, validators
+
+        pool = self.pools['heavy' if HEAVY_PATH.match(path) or HEAVY_QUERY.search(query) else 'light']
+        if rest_http.EXPORT_PATH.match(path):
+            function = streamRestExport if self.pool_kind == 'thread' else runRestExport
+        elif stream:
+            function = streamRestQuery if self.pool_kind == 'thread' else runRestStream
+        else:
+            function = runRestQuery
+        response = await self.dispatch(pool, receive, command, function, files, command)
+        if response is not None and response[0] == 200:
+            result = response[1]
+            if isinstance(result, rest_export.Export):
+                return 200, self.streamChunks(pool, result.chunks), validators + rest_export.exportHeaders(result)
+            result = self.streamLines(pool, result) if stream else result
+            return 200, result, validators
+        return response
+
+    async def handleBatch(self, project, receive):
+        '''
+        Answers a POST request to the batch route
+        '''
+        body = await self.readBody(receive)
+        if body is None:
+            return None
+        if not self.registry.ready.is_set():
+            return 503, {'error': 'NIDM files are still being loaded, see /ready'}, [('Retry-After', '5')]
+        try:
+            batch = rest_http.parseBatchRequest(body)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        return await self.dispatch(self.pools['heavy'], receive, 'batch for project ' + project,
+                                   runRestBatch, self.registry.files, project, batch)
+
+    async def dispatch(self, pool, receive, description, function, *args):
+        '''
+        Runs function(*args) in a pool, giving up if the client disconnects first
+
+        :return: (status, body[, headers]), or None if the client went away
+        '''
+        task = asyncio.ensure_future(pool.run(self.timeout, function, *args))
+        disconnect = asyncio.ensure_future(self.waitForDisconnect(receive))
+        try:
+            await asyncio.wait([task, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+        if not task.done():
+            task.cancel()
+            return None
+
+        try:
+            return 200, task.result()
+        except Overloaded:
+            return 503, {'error': 'The server is busy, try again later'}, [('Retry-After', '1')]
+        except asyncio.TimeoutError:
+            return 504, {'error': 'The query took longer than {} seconds'.format(self.timeout)}
+        except Exception as e:
+            logging.exception("Error running REST command %s", description)
+            return 500, {'error': str(e)}
+
+    async def readBody(self, receive):
+        '''
+        :return: the request body, or None if the client disconnected
+        '''
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+
+    async def streamLines(self, pool, lines):
+        '''
+        Reads the lines of a streamed response in the pool's threads, a few at a time
+
+        :param lines: generator of lines, or their text from a process pool
+        '''
+        if isinstance(lines, str):
+            yield lines
+            return
+        while True:
+            chunk = await asyncio.wrap_future(pool.executor.submit(readLines, lines))
+            if not chunk:
+                return
+            yield chunk
+
+    async def streamChunks(self, pool, chunks):
+        '''
+        Reads the chunks of an export in the pool's threads, one at a time
+
+        :param chunks: generator of bytes, or all of them from a process pool
+        '''
+        if isinstance(chunks, bytes):
+            yield chunks
+            return
+        while True:
+            chunk = await asyncio.wrap_future(pool.executor.submit(next, chunks, b''))
+            if not chunk:
+                return
+            yield chunk
+
+    async def waitForDisconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+
+app = NIDMRestApp(DatasetRegistry(TTL_FILES))
+
+
+def main():
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("Serving the REST API asynchronously needs an ASGI server, e.g. pip install uvicorn")
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PYNIDM_REST_PORT', 5000)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Response cache for RestParser
+
+Results are cached per REST command, keyed on the normalized path, the sorted query parameters,
+the output format and a fingerprint of the NIDM files (GraphCache.cacheKey, which only stat()s
+them), so an edited file is never answered from the cache.  Recent responses are kept in an
+in-memory LRU.  With RESPONSE_CACHE_DISK they are also pickled into the graph cache directory,
+where they are shared between processes and evicted along with the other GraphCache entries.
+Entries expire after RESPONSE_CACHE_TTL seconds, and clear() drops them all, e.g. when a
+DatasetRegistry reloads its files.
+'''
+import os
+import re
+import time
+import hashlib
+import threading
+import collections
+from urllib.parse import urlparse, parse_qsl
+from nidm.experiment import GraphCache
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('PYNIDM_RESPONSE_CACHE_SIZE', 256))
+# seconds, 0 keeps responses until they are evicted or the files change
+RESPONSE_CACHE_TTL = float(os.environ.get('PYNIDM_RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_DISK = os.environ.get('PYNIDM_RESPONSE_CACHE_DISK', '').lower() not in ('', '0', 'false', 'no')
+
+
+def normalizeCommand(command):
+    '''
+    Normalizes a REST command so equivalent spellings share a cache entry
+
+    :param command: REST path with an optional query string
+    :return: (path, tuple of sorted query parameters)
+    '''
+    u = urlparse(command)
+    path = '/' + re.sub('/+', '/', u.path).strip('/')
+    return path, tuple(sorted(parse_qsl(u.query, keep_blank_values=True)))
+
+
+class ResponseCache(object):
+    '''
+    Two tier (memory, optional disk) cache of RestParser results
+    '''
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, disk=RESPONSE_CACHE_DISK):
+        '''
+        :param size: number of responses kept in memory, 0 disables the cache
+        :param ttl: seconds a response is kept, 0 for no limit
+        :param disk: also keep responses in the graph cache directory
+        '''
+        self.size = size
+        self.ttl = ttl
+        self.disk = disk
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, nidm_files, command, output_format):
+        '''
+        :return: the cache key of a command, or None if the files can't be fingerprinted
+        '''
+        try:
+            fingerprint = GraphCache.cacheKey(*nidm_files)
+        except (OSError, TypeError):
+            # in-memory graphs or missing files
+            return None
+        return normalizeCommand(command) + (output_format, fingerprint)
+
+    def diskPath(self, key):
+        return GraphCache.entryPath('rest_response', hashlib.md5(repr(key).encode('utf-8')).hexdigest(), 'pickle')
+
+    def get(self, key):
+        '''
+        :return: (True, response) on a hit, (False, None) on a miss
+        '''
+        if key is None or not self.size:
+            return False, None
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and (not entry[0] or entry[0] > now):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+        if self.disk:
+            entry = GraphCache.loadEntry(self.diskPath(key))
+            if entry is not None and entry[0] == key and (not entry[1] or entry[1] > now):
+                self.store(key, entry[2], entry[1])
+                with self._lock:
+                    self.hits += 1
+                return True, entry[2]
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, response):
+        if key is None or not self.size:
+            return
+        expires = time.time() + self.ttl if self.ttl else 0
+        self.store(key, response, expires)
+        if self.disk:
+            GraphCache.saveEntry(self.diskPath(key), (key, expires, response))
+
+    def store(self, key, response, expires):
+        with self._lock:
+            self.entries[key] = (expires, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drops every cached response from memory and disk
+        '''
+        with self._lock:
+            self.entries.clear()
+        if self.disk:
+            for entry in GraphCache.listEntries():
+                if entry['kind'] == 'rest_response':
+                    GraphCache.removeEntry(entry['path'])
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,118 @@
+'''
+Typed table exports of the field values of a project
+
+RestParser answers /projects/[Project-UUID]/export with an Export: a table with a row per
+subject and a column per field, written a chunk of EXPORT_CHUNK rows at a time so large
+projects are sent while they are being written.  Columns whose values are all numbers are
+float64, the rest strings.  The arrow (Arrow IPC stream) and parquet formats need the pyarrow
+package and keep the unit, label and data element of each field as column metadata, csv
+works without it but only has the field names.
+'''
+import io
+import os
+import collections
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows written at a time, and rows per parquet row group
+EXPORT_CHUNK = int(os.environ.get('PYNIDM_EXPORT_CHUNK', 1000))
+# format -> (content type, file extension)
+FORMATS = collections.OrderedDict([
+    ('csv', ('text/csv; charset=utf-8', 'csv')),
+    ('arrow', ('application/vnd.apache.arrow.stream', 'arrows')),
+    ('parquet', ('application/vnd.apache.parquet', 'parquet')),
+])
+
+Export = collections.namedtuple('Export', ['format', 'content_type', 'filename', 'chunks'])
+
+
+def makeExport(frame, format, metadata, name, chunk=EXPORT_CHUNK):
+    '''
+    :param frame: dataframe of the table, float64 and object (str or None) columns
+    :param format: one of FORMATS
+    :param metadata: dictionary of column -> dictionary of metadata
+    :param name: file name without extension
+    :return: Export, its chunks are generated as they are sent
+    '''
+    content_type, extension = FORMATS[format]
+    if format == 'csv':
+        chunks = csvChunks(frame, chunk)
+    elif format == 'arrow':
+        chunks = arrowChunks(frame, metadata, chunk)
+    else:
+        chunks = parquetChunks(frame, metadata, chunk)
+    # writers may not have written anything yet, and an empty chunk would end a stream
+    return Export(format, content_type, '{}.{}'.format(name, extension), (data for data in chunks if data))
+
+
+def exportHeaders(export):
+    '''
+    :return: list of (name, value) headers for an export response
+    '''
+    return [('Content-Type', export.content_type),
+            ('Content-Disposition', 'attachment; filename="{}"'.format(export.filename))]
+
+
+def csvChunks(frame, chunk=EXPORT_CHUNK):
+    '''
+    :return: generator of the bytes of the CSV text, the header first
+    '''
+    yield frame.iloc[:0].to_csv(index=False).encode('utf-8')
+    for start in range(0, len(frame), chunk):
+        yield frame.iloc[start:start + chunk].to_csv(index=False, header=False).encode('utf-8')
+
+
+def arrowSchema(frame, metadata):
+    '''
+    :return: pyarrow.Schema of the table, with the metadata of each column
+    '''
+    fields = []
+    for column in frame.columns:
+        type = pyarrow.float64() if frame[column].dtype.kind == 'f' else pyarrow.string()
+        field_metadata = dict((key, str(value)) for key, value in metadata.get(column, {}).items() if value is not None)
+        fields.append(pyarrow.field(str(column), type, metadata=field_metadata or None))
+    return pyarrow.schema(fields)
+
+
+def drain(sink):
+    '''
+    :return: the bytes written to a BytesIO since it was last drained
+    '''
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def arrowChunks(frame, metadata, chunk=EXPORT_CHUNK):
+    '''
+    :return: generator of the bytes of an Arrow IPC stream with a record batch per chunk of rows
+    '''
+    schema = arrowSchema(frame, metadata)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for start in range(0, len(frame), chunk):
+            writer.write_batch(pyarrow.RecordBatch.from_pandas(frame.iloc[start:start + chunk], schema=schema, preserve_index=False))
+            yield drain(sink)
+    yield drain(sink)
+
+
+def parquetChunks(frame, metadata, chunk=EXPORT_CHUNK):
+    '''
+    :return: generator of the bytes of a parquet file with a row group per chunk of rows
+    '''
+    schema = arrowSchema(frame, metadata)
+    sink = io.BytesIO()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for start in range(0, len(frame), chunk):
+            writer.write_table(pyarrow.Table.from_pandas(frame.iloc[start:start + chunk], schema=schema, preserve_index=False))
+            yield drain(sink)
+        if len(frame) == 0:
+            writer.write_table(schema.empty_table())
+    # the footer is written when the writer is closed
+    yield drain(sink)
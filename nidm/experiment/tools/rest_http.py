@@ -0,0 +1,184 @@
+'''
+HTTP helpers shared by the REST servers: validators for conditional requests and compression
+
+Every response carries a weak ETag computed from the fingerprints of the NIDM files a
+DatasetRegistry has loaded and the normalized command, plus a Last-Modified date from the time
+those files were loaded.  A client that polls with If-None-Match (or If-Modified-Since) gets a
+304 without the command being run again.  Bodies are compressed with brotli (if the brotli
+package is installed) or gzip when the client accepts it, and with PYNIDM_REST_COMPACT the
+JSON is written without indentation.  Clients that accept application/x-ndjson get list
+results as newline delimited JSON, streamed while they are generated.
+'''
+import os
+import re
+import gzip
+import hashlib
+import email.utils
+import simplejson
+from nidm.experiment.tools.rest_cache import normalizeCommand
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# write JSON without indentation or spaces
+COMPACT_JSON = os.environ.get('PYNIDM_REST_COMPACT', '').lower() not in ('', '0', 'false', 'no')
+# smaller bodies aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+NDJSON_TYPE = 'application/x-ndjson'
+# the only route that accepts POST requests
+BATCH_PATH = re.compile(r'^/?projects/([^/]+)/batch/?$')
+# tables exported as csv, arrow or parquet rather than JSON
+EXPORT_PATH = re.compile(r'^/?projects/([^/]+)/export/?$')
+
+
+def dumpResult(result, compact=COMPACT_JSON):
+    '''
+    :return: JSON text of a RestParser result
+    '''
+    if compact:
+        return simplejson.dumps(result, separators=(',', ':'))
+    return simplejson.dumps(result, indent=2)
+
+
+def parseBatchRequest(body):
+    '''
+    Reads the JSON body of a batch request, {"subjects": [...], "fields": [...], "filter": "..."}
+    with every key optional
+
+    :param body: str or bytes
+    :return: keyword arguments for RestParser.run_batch
+    :raises ValueError: if the body isn't a valid batch request
+    '''
+    try:
+        request = simplejson.loads(body) if body else {}
+    except simplejson.JSONDecodeError:
+        raise ValueError("The request body must be JSON")
+    if not isinstance(request, dict):
+        raise ValueError("The request body must be a JSON object")
+
+    batch = {}
+    for key in ('subjects', 'fields'):
+        value = request.get(key)
+        if value is not None:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError("{} must be a list of strings".format(key))
+            batch[key] = value
+    if request.get('filter') is not None:
+        if not isinstance(request['filter'], str):
+            raise ValueError("filter must be a string")
+        batch['filter'] = request['filter']
+    return batch
+
+
+def wantsStream(accept):
+    '''
+    :param accept: Accept header, or None
+    :return: True if the client asked for newline delimited JSON
+    '''
+    return bool(accept) and NDJSON_TYPE in accept
+
+
+def entityTag(snapshot, command, compact=COMPACT_JSON, stream=False):
+    '''
+    Weak ETag of a command's response, it changes whenever one of the files does
+
+    :param snapshot: RegistrySnapshot of the files the command runs on
+    :param command: REST API path and query string
+    :param stream: the response is newline delimited JSON
+    '''
+    hasher = hashlib.md5()
+    hasher.update(repr((sorted(snapshot.fingerprints.items()), normalizeCommand(command), compact, stream)).encode('utf-8'))
+    # weak, the bodies of the different content encodings are equivalent rather than identical
+    return 'W/"{}"'.format(hasher.hexdigest())
+
+
+def lastModified(snapshot):
+    '''
+    :return: HTTP date the snapshot was loaded, or None
+    '''
+    if snapshot.loaded is None:
+        return None
+    return email.utils.formatdate(int(snapshot.loaded), usegmt=True)
+
+
+def notModified(snapshot, etag, if_none_match=None, if_modified_since=None):
+    '''
+    Checks the validators a client sent, If-None-Match takes precedence over If-Modified-Since
+
+    :return: True if the client's copy of the response is still current
+    '''
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        opaque = etag[2:] if etag.startswith('W/') else etag
+        return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == opaque for tag in tags)
+    if if_modified_since and snapshot.loaded is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since.timestamp() >= int(snapshot.loaded)
+    return False
+
+
+def chooseEncoding(accept_encoding):
+    '''
+    Picks the content encoding for a response
+
+    :param accept_encoding: Accept-Encoding header, or None
+    :return: 'br', 'gzip' or None for an uncompressed response
+    '''
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        weight = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[parts[0].strip().lower()] = weight
+
+    available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = None
+    for encoding in available:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > 0 and (best is None or weight > best[1]):
+            best = (encoding, weight)
+    return best[0] if best else None
+
+
+def encodeBody(body, accept_encoding):
+    '''
+    Compresses a response body if the client accepts it and it is large enough
+
+    :param body: str or bytes
+    :param accept_encoding: Accept-Encoding header, or None
+    :return: (bytes, content encoding or None)
+    '''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    encoding = chooseEncoding(accept_encoding) if len(body) >= MIN_COMPRESS_SIZE else None
+    if encoding == 'br':
+        return brotli.compress(body), encoding
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6), encoding
+    return body, None
+
+
+def responseHeaders(etag, last_modified, encoding=None):
+    '''
+    :return: list of (name, value) headers for a response
+    '''
+    # clients keep the response but check it's still current before using it again
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache'), ('Vary', 'Accept, Accept-Encoding')]
+    if last_modified:
+        headers.append(('Last-Modified', last_modified))
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    return headers
@@ -0,0 +1,141 @@
+'''
+Prefork launcher for the NIDM REST API
+
+The master process loads every NIDM file of a DatasetRegistry (the parsed graphs, their union
+and the navigation index), moves everything it has allocated out of the garbage collector's
+reach with gc.freeze() and only then forks the workers.  The workers share the parsed graphs
+with the master copy-on-write instead of each unpickling its own copy, so N workers don't need
+N times the memory.  Each worker logs its memory use at INFO level when it starts.
+
+The workers serve a WSGI application, e.g. the Flask app of rest-server.py, on a socket they
+all accept from.  A worker that dies is replaced.  Workers keep watching the files on their own,
+so after a file changes each worker loads its own copy of the new graphs until the server is
+restarted.
+'''
+import os
+import gc
+import signal
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+# how long the master waits for workers to exit after asking them to stop
+STOP_TIMEOUT = 10
+
+
+def memoryUsage(pid='self'):
+    '''
+    Memory used by a process, in bytes, from /proc/<pid>/smaps_rollup
+
+    :param pid: process id, or 'self'
+    :return: dictionary with rss, pss (shared pages split between the processes using them),
+        shared and private, or just rss where smaps_rollup isn't available
+    '''
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            fields = dict((line.split(':')[0], int(line.split()[1]) * 1024) for line in f if line.endswith('kB\n'))
+        return {'rss': fields['Rss'], 'pss': fields['Pss'],
+                'shared': fields['Shared_Clean'] + fields['Shared_Dirty'],
+                'private': fields['Private_Clean'] + fields['Private_Dirty']}
+    except (IOError, KeyError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux
+        return {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def formatMemory(usage):
+    return ', '.join('{} {:.1f} MB'.format(key, value / 1024.0 ** 2) for key, value in sorted(usage.items()))
+
+
+def listen(host, port, backlog=128):
+    '''
+    Opens the socket the workers accept connections from
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def runWorker(app, registry, sock):
+    from werkzeug.serving import make_server
+
+    # threads don't survive the fork, start watching the files again
+    registry.start()
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    logger.info("Worker %d ready: %s", os.getpid(), formatMemory(memoryUsage()))
+    server.serve_forever()
+
+
+def forkWorker(app, registry, sock):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            runWorker(app, registry, sock)
+        except Exception:
+            logger.exception("Worker %d failed", os.getpid())
+        finally:
+            os._exit(1)
+    return pid
+
+
+def serve(app, registry, sock, workers):
+    '''
+    Loads the registry's files, then forks the workers and keeps them running until the master
+    gets SIGTERM or SIGINT
+
+    :param app: WSGI application
+    :param registry: DatasetRegistry the application serves, not started yet
+    :param sock: listening socket, see listen
+    :param workers: number of worker processes
+    '''
+    # load without starting the watcher thread, the workers watch the files
+    registry.refresh()
+    if not registry.ready.is_set():
+        raise RuntimeError("Could not load the NIDM files: {}".format(registry.error))
+
+    # frozen objects are never scanned again, so collections in the workers don't touch
+    # (and copy) the pages holding the graphs
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    logger.info("Loaded %d NIDM files in the master: %s", len(registry.files), formatMemory(memoryUsage()))
+
+    children = set()
+    stopping = []
+
+    def signalChildren(signum):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(signum)
+            signalChildren(signal.SIGTERM)
+            signal.alarm(STOP_TIMEOUT)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, lambda signum, frame: signalChildren(signal.SIGKILL))
+
+    for i in range(workers):
+        children.add(forkWorker(app, registry, sock))
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.warning("Worker %d exited with status %d, starting a new one", pid, status)
+            children.add(forkWorker(app, registry, sock))
+    signal.alarm(0)
+    sock.close()
@@ -10,7 +10,9 @@ from nidm.experiment.tools.rest import RestParser
 import os
 from pathlib import Path
 from rdflib import Graph, util, URIRef
+import io
 import json
+import pandas as pd
 
 
 from prov.model import ProvAgent
@@ -211,6 +213,55 @@ def test_uri_projects_subjects_1():
     assert test_p2_subject_uuids[0] in result['uuid']
     assert test_p2_subject_uuids[1] in result['uuid']
 
+def test_uri_filter_syntax_error():
+    restParser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    result = restParser.run([REST_TEST_FILE], '/projects/p2/subjects?filter=instruments.AGE_AT_SCAN gt')
+    assert result == {'error': 'Unexpected end of filter'}
+    result = restParser.run([REST_TEST_FILE], '/projects/p2/subjects?filter=instruments.AGE_AT_SCAN between 1')
+    assert result == {'error': "Unknown filter operator 'between'"}
+
+def test_uri_projects_subjects_pages():
+    restParser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    result = restParser.run([REST_TEST_FILE], '/projects/p2/subjects?limit=1')
+    assert len(result['uuid']) == 1 and len(result['subject id']) == 1
+    assert result['next'] is not None
+
+    second = restParser.run([REST_TEST_FILE], '/projects/p2/subjects?limit=1&cursor={}'.format(result['next']))
+    assert second['next'] is None
+    assert sorted(result['uuid'] + second['uuid']) == sorted(test_p2_subject_uuids)
+    assert restParser.run([REST_TEST_FILE], '/projects/p2/subjects?offset=1')['uuid'] == second['uuid']
+    assert 'error' in restParser.run([REST_TEST_FILE], '/projects/p2/subjects?limit=-1')
+    assert 'error' in restParser.run([REST_TEST_FILE], '/projects/p2/subjects?limit=0')
+
+    restParser.setOutputFormat(RestParser.NDJSON_FORMAT)
+    lines = [json.loads(line) for line in restParser.run([REST_TEST_FILE], '/projects/p2/subjects')]
+    assert sorted(line['uuid'] for line in lines) == sorted(test_p2_subject_uuids)
+
+def test_project_batch():
+    restParser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    subjects = restParser.run([REST_TEST_FILE], '/projects/p2/subjects')
+    result = restParser.run_batch([REST_TEST_FILE], 'p2', subjects=subjects['uuid'] + ['nobody'], fields=['Age'])
+
+    columns = result['columns']
+    assert columns['uuid'] == subjects['uuid']
+    assert len(columns['subject id']) == len(subjects['uuid'])
+    assert sorted(columns['Age']) == ['6', '7']
+    assert result['not_found'] == ['nobody']
+    # subjects can be given by subject id too
+    by_id = restParser.run_batch([REST_TEST_FILE], 'p2', subjects=columns['subject id'], fields=['Age'])
+    assert by_id['columns'] == columns
+    assert 'error' in restParser.run_batch([REST_TEST_FILE], 'p2', fields=['not_real_field'])
+
+def test_project_export():
+    restParser = RestParser(output_format=RestParser.OBJECT_FORMAT)
+    export = restParser.run([REST_TEST_FILE], '/projects/p2/export?fields=Age&format=csv')
+    assert export.filename == 'p2.csv'
+    table = pd.read_csv(io.BytesIO(b''.join(export.chunks)))
+    assert list(table.columns) == ['uuid', 'subject id', 'Age']
+    # the ages are numbers
+    assert sorted(table['Age']) == [6.0, 7.0]
+    assert 'error' in restParser.run([REST_TEST_FILE], '/projects/p2/export?fields=Age&format=xml')
+
 def test_uri_subjects():
     global cmu_test_subject_uuid
 
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import simplejson
+import pytest
+from nidm.experiment.DatasetRegistry import DatasetRegistry
+from nidm.experiment.tools.rest_async import NIDMRestApp, QueryPool, Overloaded
+
+
+def send(app, path, query=b'', headers=(), method='GET', body=None):
+    messages = []
+    requests = [{'type': 'http.request', 'body': body}] if body is not None else []
+
+    async def receive():
+        if requests:
+            return requests.pop(0)
+        # the client never disconnects
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': list(headers)}
+    asyncio.run(app(scope, receive, send))
+    return messages[0]['status'], dict(messages[0]['headers']), b''.join(m['body'] for m in messages[1:])
+
+
+def request(app, path, query=b''):
+    status, headers, body = send(app, path, query)
+    return status, simplejson.loads(body)
+
+
+def test_async_app(tmp_path, cache_dir, write_project):
+    write_project(tmp_path / "async.ttl", "_async_project", "Async")
+
+    app = NIDMRestApp(DatasetRegistry(str(tmp_path / "*.ttl"), poll_interval=0))
+    try:
+        app.start()
+        assert app.registry.ready.wait(60)
+        assert request(app, '/ready')[0] == 200
+        status, headers, body = send(app, '/metrics')
+        assert status == 200 and headers[b'content-type'].startswith(b'text/plain')
+        assert request(app, '/projects') == (200, ['_async_project'])
+        assert request(app, '/projects', b'x=1')[0] == 200
+        assert b'nidm_rest_request_seconds_count{route="projects"' in send(app, '/metrics')[2]
+
+        # polling with the ETag doesn't run the query again
+        etag = send(app, '/projects')[1][b'etag']
+        assert send(app, '/projects', headers=[(b'if-none-match', etag)]) == (304, send(app, '/projects')[1], b'')
+        assert send(app, '/projects', headers=[(b'if-none-match', b'W/"other"')])[0] == 200
+
+        status, headers, body = send(app, '/projects', headers=[(b'accept', b'application/x-ndjson')])
+        assert headers[b'content-type'] == b'application/x-ndjson'
+        assert body.decode('utf-8').splitlines() == ['"_async_project"']
+
+        status, headers, body = send(app, '/projects/_async_project/batch', method='POST', body=b'{"subjects": ["nobody"]}')
+        assert status == 200
+        assert simplejson.loads(body) == {'columns': {'uuid': [], 'subject id': []}, 'not_found': ['nobody']}
+        assert send(app, '/projects/_async_project/batch', method='POST', body=b'{"fields": "AGE"}')[0] == 400
+        assert send(app, '/projects', method='POST', body=b'{}')[0] == 405
+        assert send(app, '/projects', method='HEAD') == (200, send(app, '/projects')[1], b'')
+        status, headers, body = send(app, '/projects/_async_project/export', method='HEAD')
+        assert status == 200 and headers[b'content-type'].startswith(b'text/csv') and body == b''
+
+        status, headers, body = send(app, '/projects/_async_project/export')
+        assert status == 200 and headers[b'content-type'].startswith(b'text/csv')
+        assert headers[b'content-disposition'] == b'attachment; filename="_async_project.csv"'
+        assert body == b'uuid,subject id\n'
+    finally:
+        app.stop()
+
+
+def test_query_pool_limits():
+    release = threading.Event()
+    pool = QueryPool(workers=1, max_queue=1)
+
+    async def run():
+        running = asyncio.ensure_future(pool.run(60, release.wait))
+        queued = asyncio.ensure_future(pool.run(0.1, release.wait))
+        await asyncio.sleep(0.05)
+        # one running and one waiting fill the pool
+        with pytest.raises(Overloaded):
+            await pool.run(60, release.wait)
+        # the waiting request times out and is dropped before it runs
+        with pytest.raises(asyncio.TimeoutError):
+            await queued
+        release.set()
+        assert await running
+        assert pool.pending == 0
+
+    try:
+        asyncio.run(run())
+    finally:
+        release.set()
+        pool.shutdown()
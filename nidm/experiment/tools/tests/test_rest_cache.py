@@ -0,0 +1,57 @@
+import time
+from nidm.experiment import MemoryCache
+from nidm.experiment.tools.rest import RestParser
+from nidm.experiment.tools.rest_cache import ResponseCache, normalizeCommand
+
+
+def test_normalize_command():
+    assert normalizeCommand('projects//abc/?b=2&a=1') == ('/projects/abc', (('a', '1'), ('b', '2')))
+    assert normalizeCommand('/projects/abc?a=1&b=2') == normalizeCommand('projects/abc/?b=2&a=1')
+    assert normalizeCommand('/projects') != normalizeCommand('/projects?fields=AGE')
+
+
+def test_response_cache(tmp_path, cache_dir, write_project):
+    file = str(tmp_path / "cache.ttl")
+    write_project(file, "_cache_project", "Cache")
+
+    cache = ResponseCache(size=2, ttl=0, disk=False)
+    key = cache.key([file], '/projects?b=1&a=2', RestParser.OBJECT_FORMAT)
+    assert key == cache.key([file], 'projects/?a=2&b=1', RestParser.OBJECT_FORMAT)
+    assert key != cache.key([file], '/projects?a=2&b=1', RestParser.JSON_FORMAT)
+    assert cache.key([str(tmp_path / "missing.ttl")], '/projects', 0) is None
+
+    # least recently used entries are evicted
+    cache.put(('a',), 1)
+    cache.put(('b',), 2)
+    assert cache.get(('a',)) == (True, 1)
+    cache.put(('c',), 3)
+    assert cache.get(('b',)) == (False, None)
+    assert cache.get(('a',)) == (True, 1)
+
+    # expired entries are misses
+    cache = ResponseCache(size=2, ttl=0.01, disk=False)
+    cache.put(('a',), 1)
+    time.sleep(0.05)
+    assert cache.get(('a',)) == (False, None)
+
+    # the disk tier survives the memory tier and clear() removes it
+    cache = ResponseCache(size=2, ttl=0, disk=True)
+    cache.put(key, ['x'])
+    assert ResponseCache(size=2, ttl=0, disk=True).get(key) == (True, ['x'])
+    cache.clear()
+    assert ResponseCache(size=2, ttl=0, disk=True).get(key) == (False, None)
+
+    # the parser answers repeated commands from the cache, and stops once the file changes
+    cache = ResponseCache(size=8, ttl=0, disk=False)
+    parser = RestParser(output_format=RestParser.OBJECT_FORMAT, response_cache=cache)
+    assert parser.run([file], '/projects') == ['_cache_project']
+    result = parser.run([file], '/projects/')
+    assert result == ['_cache_project']
+    assert cache.stats()['hits'] == 1
+    result.append('changed')
+    assert parser.run([file], '/projects') == ['_cache_project']
+
+    write_project(file, "_other_project", "Other")
+    # as a DatasetRegistry does when it notices the change
+    MemoryCache.invalidateFiles([file])
+    assert parser.run([file], '/projects') == ['_other_project']
@@ -0,0 +1,43 @@
+import io
+import pandas as pd
+import pytest
+from nidm.experiment.tools import rest_export
+
+
+def makeFrame(rows):
+    return pd.DataFrame({'uuid': ['s{}'.format(i) for i in range(rows)],
+                         'AGE': pd.Series([float(i) if i % 3 else None for i in range(rows)], dtype='float64'),
+                         'SITE': pd.Series(['CMU' if i % 2 else None for i in range(rows)], dtype=object)})
+
+
+def test_csv_export():
+    frame = makeFrame(25)
+    export = rest_export.makeExport(frame, 'csv', {'AGE': {'unit': 'years'}}, 'project', chunk=10)
+    assert export.filename == 'project.csv'
+    assert ('Content-Type', 'text/csv; charset=utf-8') in rest_export.exportHeaders(export)
+    chunks = list(export.chunks)
+    # the header and a chunk for every 10 rows
+    assert len(chunks) == 4
+    table = pd.read_csv(io.BytesIO(b''.join(chunks)))
+    assert list(table.columns) == ['uuid', 'AGE', 'SITE']
+    assert table['AGE'].dtype == 'float64'
+    assert table['AGE'].isna().sum() == 9 and table['AGE'].sum() == frame['AGE'].sum()
+
+    assert list(rest_export.makeExport(frame.iloc[:0], 'csv', {}, 'project').chunks) == [b'uuid,AGE,SITE\n']
+
+
+@pytest.mark.parametrize('format', ['arrow', 'parquet'])
+def test_arrow_export(format):
+    pyarrow = pytest.importorskip('pyarrow')
+    frame = makeFrame(25)
+    export = rest_export.makeExport(frame, format, {'AGE': {'unit': 'years', 'label': None}}, 'project', chunk=10)
+    data = b''.join(export.chunks)
+    if format == 'arrow':
+        table = pyarrow.ipc.open_stream(data).read_all()
+    else:
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(data))
+    assert table.num_rows == 25
+    assert table.schema.field('AGE').type == pyarrow.float64()
+    assert table.schema.field('SITE').type == pyarrow.string()
+    assert table.schema.field('AGE').metadata == {b'unit': b'years'}
+    assert table.column('AGE').null_count == 9
@@ -0,0 +1,59 @@
+import gzip
+import pytest
+import simplejson
+from nidm.experiment.DatasetRegistry import RegistrySnapshot
+from nidm.experiment.tools import rest_http
+
+
+def test_conditional_requests():
+    snapshot = RegistrySnapshot(files=('a.ttl',), fingerprints={'a.ttl': ('/a.ttl', 10, 1, 2)}, version=1, loaded=1600000000.5)
+    changed = snapshot._replace(fingerprints={'a.ttl': ('/a.ttl', 12, 3, 2)})
+
+    etag = rest_http.entityTag(snapshot, '/projects?b=1&a=2')
+    assert etag.startswith('W/"')
+    assert etag == rest_http.entityTag(snapshot, 'projects/?a=2&b=1')
+    assert etag != rest_http.entityTag(changed, '/projects?b=1&a=2')
+    assert etag != rest_http.entityTag(snapshot, '/projects?b=1&a=2', compact=not rest_http.COMPACT_JSON)
+
+    assert rest_http.notModified(snapshot, etag, etag)
+    assert rest_http.notModified(snapshot, etag, 'W/"x", ' + etag[2:])
+    assert rest_http.notModified(snapshot, etag, '*')
+    assert not rest_http.notModified(snapshot, etag, 'W/"x"')
+    assert not rest_http.notModified(snapshot, etag)
+
+    last_modified = rest_http.lastModified(snapshot)
+    assert last_modified == 'Sun, 13 Sep 2020 12:26:40 GMT'
+    assert rest_http.notModified(snapshot, etag, if_modified_since=last_modified)
+    assert not rest_http.notModified(snapshot, etag, if_modified_since='Sun, 13 Sep 2020 12:26:39 GMT')
+    assert not rest_http.notModified(snapshot, etag, if_modified_since='yesterday')
+    # If-None-Match wins
+    assert not rest_http.notModified(snapshot, etag, 'W/"x"', last_modified)
+
+
+def test_compression():
+    assert rest_http.chooseEncoding(None) is None
+    assert rest_http.chooseEncoding('identity') is None
+    assert rest_http.chooseEncoding('gzip;q=0, *;q=0') is None
+    assert rest_http.chooseEncoding('deflate, gzip;q=0.5') == 'gzip'
+    assert rest_http.chooseEncoding('br;q=1.0, gzip;q=0.8') == ('br' if rest_http.brotli else 'gzip')
+    assert rest_http.chooseEncoding('*') == ('br' if rest_http.brotli else 'gzip')
+
+    result = [{'subject': str(i), 'value': i} for i in range(200)]
+    assert simplejson.loads(rest_http.dumpResult(result, compact=True)) == result
+    assert len(rest_http.dumpResult(result, compact=True)) < len(rest_http.dumpResult(result, compact=False))
+
+    body, encoding = rest_http.encodeBody(rest_http.dumpResult(result), 'gzip')
+    assert encoding == 'gzip' and simplejson.loads(gzip.decompress(body)) == result
+    assert rest_http.encodeBody('[]', 'gzip') == (b'[]', None)
+    assert ('Content-Encoding', 'gzip') in rest_http.responseHeaders('W/"x"', None, 'gzip')
+
+
+def test_parse_batch_request():
+    assert rest_http.parseBatchRequest(b'') == {}
+    assert rest_http.parseBatchRequest('{"subjects": ["s1"], "fields": ["AGE"], "filter": "AGE gt 1", "x": 1}') == \
+        {'subjects': ['s1'], 'fields': ['AGE'], 'filter': 'AGE gt 1'}
+    for body in ('[1]', 'not json', '{"subjects": "s1"}', '{"fields": [1]}', '{"filter": 1}'):
+        with pytest.raises(ValueError):
+            rest_http.parseBatchRequest(body)
+    assert rest_http.BATCH_PATH.match('projects/p1/batch').group(1) == 'p1'
+    assert not rest_http.BATCH_PATH.match('/projects/p1/subjects')
@@ -0,0 +1,40 @@
+import os
+import time
+import signal
+import multiprocessing
+import urllib.request
+from nidm.experiment.DatasetRegistry import DatasetRegistry
+from nidm.experiment.tools import rest_prefork
+
+
+def pidApp(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode()]
+
+
+def test_prefork_workers(tmp_path, cache_dir, write_project):
+    write_project(tmp_path / "prefork.ttl", "_prefork_project", "Prefork")
+
+    sock = rest_prefork.listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    registry = DatasetRegistry(str(tmp_path / "*.ttl"), poll_interval=0)
+    master = multiprocessing.get_context('fork').Process(target=rest_prefork.serve, args=(pidApp, registry, sock, 2))
+    master.start()
+    sock.close()
+    try:
+        pids = set()
+        deadline = time.time() + 60
+        while len(pids) < 2 and time.time() < deadline:
+            try:
+                pids.add(urllib.request.urlopen('http://127.0.0.1:{}/'.format(port), timeout=5).read())
+            except OSError:
+                time.sleep(0.1)
+        # requests are answered by both workers, not the master
+        assert len(pids) == 2
+        assert str(master.pid).encode() not in pids
+    finally:
+        os.kill(master.pid, signal.SIGTERM)
+        master.join(30)
+    assert master.exitcode == 0
+
+    assert rest_prefork.memoryUsage()['rss'] > 0
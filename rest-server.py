@@ -1,15 +1,33 @@
+import argparse
+import logging
+import threading
+from urllib import parse
 from flask import Flask, request
 from flask_restful import Resource, Api
-import glob
-from nidm.experiment.tools.rest import RestParser
+from nidm.experiment.tools.rest import RestParser, RESPONSE_CACHE
+from nidm.experiment.DatasetRegistry import DatasetRegistry
+from nidm.experiment import Metrics
+from nidm.experiment.tools import rest_prefork, rest_http, rest_export
 from flask_cors import CORS
-import simplejson
 
-def getTTLFiles():
-    files = []
-    for filename in glob.glob('/opt/project/ttl/**/*.ttl', recursive=True):
-        files.append(filename)
-    return files
+# the files are loaded once at startup and reloaded in the background when they change
+registry = DatasetRegistry('/opt/project/ttl/**/*.ttl')
+# responses computed from the old files can't be asked for again
+registry.listeners.append(lambda snapshot: RESPONSE_CACHE.clear())
+registry_started = False
+registry_lock = threading.Lock()
+
+def startRegistry():
+    '''
+    Starts loading the files in the background the first time it is called, so the app also
+    serves data when a WSGI server (e.g. gunicorn rest-server:app) imports it.  Forking servers
+    fork before the first request, so every worker process watches the files itself.
+    '''
+    global registry_started
+    with registry_lock:
+        if not registry_started:
+            registry_started = True
+            registry.start(background=True)
 
 class NIDMRest(Resource):
     def get(self, all):
@@ -19,28 +37,93 @@ class NIDMRest(Resource):
             query_bits.append("{}={}".format(a, request.args.get(a)))
         query = "&".join(query_bits)
 
-        files = getTTLFiles()
+        if not registry.ready.is_set():
+            return ({'error' : 'NIDM files are still being loaded, see {}ready'.format(request.url_root)}, 503)
+        snapshot = registry.snapshot
+        files = snapshot.files
         if len(files) == 0:
             return ({'error' : 'No NIDM files found. You may need to add NIDM ttl files to ~/PyNIDM/ttl'})
-        restParser = RestParser(output_format=RestParser.OBJECT_FORMAT, verbosity_level=5)
 
-        json_str = simplejson.dumps(restParser.run(files, "{}?{}".format(all, query)), indent=2)
-        response = app.response_class(response=json_str, status=200, mimetype='application/json')
+        # dashboards poll the same URLs, answer them without running the query while the files are unchanged
+        command = "{}?{}".format(all, query)
+        stream = rest_http.wantsStream(request.headers.get('Accept'))
+        etag = rest_http.entityTag(snapshot, command, stream=stream)
+        last_modified = rest_http.lastModified(snapshot)
+        if rest_http.notModified(snapshot, etag, request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+            return app.response_class(status=304, headers=rest_http.responseHeaders(etag, last_modified))
+
+        restParser = RestParser(output_format=RestParser.NDJSON_FORMAT if stream else RestParser.OBJECT_FORMAT, verbosity_level=5)
+        result = restParser.run(files, command)
+        if isinstance(result, rest_export.Export):
+            # the table is sent while the rest of it is written
+            return app.response_class(response=result.chunks, status=200,
+                                      headers=rest_http.responseHeaders(etag, last_modified) + rest_export.exportHeaders(result))
+        if stream:
+            # rows are sent while the rest are generated
+            return app.response_class(response=result, status=200, mimetype=rest_http.NDJSON_TYPE,
+                                      headers=rest_http.responseHeaders(etag, last_modified))
+
+        body, encoding = rest_http.encodeBody(rest_http.dumpResult(result), request.headers.get('Accept-Encoding'))
+        response = app.response_class(response=body, status=200, mimetype='application/json',
+                                      headers=rest_http.responseHeaders(etag, last_modified, encoding))
 
         return response
 
+    def post(self, all):
+        match = rest_http.BATCH_PATH.match(all)
+        if not match:
+            return ({'error' : 'Only /projects/[Project-UUID]/batch accepts POST requests'}, 405)
+        if not registry.ready.is_set():
+            return ({'error' : 'NIDM files are still being loaded, see {}ready'.format(request.url_root)}, 503)
+        try:
+            batch = rest_http.parseBatchRequest(request.get_data())
+        except ValueError as e:
+            return ({'error' : str(e)}, 400)
+
+        restParser = RestParser(output_format=RestParser.OBJECT_FORMAT, verbosity_level=5)
+        result = restParser.run_batch(registry.files, parse.unquote(match.group(1)), **batch)
+        body, encoding = rest_http.encodeBody(rest_http.dumpResult(result), request.headers.get('Accept-Encoding'))
+        headers = [('Vary', 'Accept-Encoding')] + ([('Content-Encoding', encoding)] if encoding else [])
+        return app.response_class(response=body, status=200, mimetype='application/json', headers=headers)
+
 class Instructions(Resource):
     def get(self):
 
         return ({'message' : 'You probably want to start at {}projects  See instructions at PyNIDM/docker/README.md for details on the API and loading data.'.format(request.url_root)})
 
+class Ready(Resource):
+    def get(self):
+        status = registry.status()
+        return (status, 200 if status['ready'] else 503)
+
+class MetricsText(Resource):
+    def get(self):
+        return app.response_class(response=Metrics.render(), status=200, content_type=Metrics.CONTENT_TYPE)
 
 
 app = Flask(__name__)
 CORS(app)
 api = Api(app)
 api.add_resource(Instructions, '/')
+api.add_resource(Ready, '/ready')
+api.add_resource(MetricsText, '/metrics')
 api.add_resource(NIDMRest, '/<path:all>')
+app.before_request(startRegistry)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='HTTP server for the PyNIDM REST API')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes. With more than one the files are loaded once and shared between the workers')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # shows the memory each worker reports when it starts
+        logging.basicConfig(level=logging.INFO)
+        # the master loads the files and each worker starts watching them
+        registry_started = True
+        rest_prefork.serve(app, registry, rest_prefork.listen('0.0.0.0', args.port), args.workers)
+    else:
+        startRegistry()
+        # the reloader would load the files again in a second process
+        app.run(debug=True, use_reloader=False, host='0.0.0.0', port=args.port)
@@ -22,6 +22,7 @@ opts = dict(name=NAME,
             packages=PACKAGES,
             scripts=SCRIPTS,
             install_requires=INSTALL_REQUIRES,
+            extras_require=EXTRAS_REQUIRE,
             #requires=INSTALL_REQUIRES,
             entry_points='''
                [console_scripts]